@@ -0,0 +1,88 @@
+#==========================================================================
+# Aardvark asyncio interface
+#--------------------------------------------------------------------------
+# asyncio front end for the blocking calls in aardvark_py.
+#
+# Every call on an Aardvark handle is run on a single worker thread owned
+# by that handle, so calls on one handle are serialized in the order they
+# were awaited while the event loop keeps running.  Calls on different
+# handles run in parallel.
+#
+# Requires Python 3.7 or later.
+#
+#   aa = AardvarkAsync(handle)
+#   (count, data_in) = await aa.i2c_read(0x3c, AA_I2C_NO_FLAGS, 4)
+#   await aa.aclose()
+#==========================================================================
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from aardvark_py import *
+
+
+#==========================================================================
+# CLASSES
+#==========================================================================
+class AardvarkAsync(object):
+    ''' asyncio wrapper for one open Aardvark handle.
+    All calls made through this object run on its own worker thread, one
+    at a time.  Create a single AardvarkAsync per handle; two wrappers
+    around the same handle would not be serialized against each other. '''
+    def __init__(self, handle, loop=None):
+        self.handle = handle
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def call(self, aa_func, *args):
+        ''' run aa_func(handle, *args) off the event loop and return an
+        awaitable for its result '''
+        loop = self.loop or asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor,
+            functools.partial(aa_func, self.handle, *args))
+
+    def i2c_read(self, slave_addr, flags, data_in):
+        ''' awaitable aa_i2c_read: (int return, u08[] data_in) '''
+        return self.call(aa_i2c_read, slave_addr, flags, data_in)
+
+    def i2c_write(self, slave_addr, flags, data_out):
+        ''' awaitable aa_i2c_write: int return '''
+        return self.call(aa_i2c_write, slave_addr, flags, data_out)
+
+    def i2c_write_read(self, slave_addr, flags, out_data, in_data):
+        ''' awaitable aa_i2c_write_read:
+        (int return, u16 num_written, u08[] in_data, u16 num_read) '''
+        return self.call(aa_i2c_write_read, slave_addr, flags, out_data, in_data)
+
+    def gpio_change(self, timeout):
+        ''' awaitable aa_gpio_change: int return.
+        The handle is busy until the GPIO lines change or <timeout> ms
+        pass, so other calls on this handle wait behind it. '''
+        return self.call(aa_gpio_change, timeout)
+
+    async def aclose(self, close_handle=False):
+        ''' stop the worker thread once queued calls have finished, and
+        close the Aardvark handle too if <close_handle> is set.  The wait
+        for queued calls runs off the event loop. '''
+        if close_handle:
+            self.executor.submit(aa_close, self.handle)
+        loop = self.loop or asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.executor.shutdown)
+
+
+async def aa_open_async(port_number, loop=None):
+    ''' open the Aardvark on <port_number> without blocking the event loop.
+    Returns an AardvarkAsync, or the negative error code from aa_open. '''
+    loop = loop or asyncio.get_running_loop()
+    handle = await loop.run_in_executor(None, aa_open, port_number)
+    if handle <= 0:
+        return handle
+    return AardvarkAsync(handle, loop)
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -56,24 +56,53 @@ AA_REQ_SW_VERSION = 0x050a   # v5.10
 
 import os
 import sys
-try:
-    import aardvark as api
-except ImportError, ex1:
-    import imp, platform
-    ext = platform.system() == 'Windows' and '.dll' or '.so'
+
+# The native library is loaded on the first call into it rather than at
+# import time, so modules that only use the constants and helpers here
+# never pay for loading it.  Until then api is a placeholder, and
+# AA_LIBRARY_LOADED stays True so that the wrappers below go ahead and
+# make that first call.
+AA_SW_VERSION      = 0
+AA_REQ_API_VERSION = 0
+AA_LIBRARY_LOADED  = True
+
+# Setting AARDVARK_SIM in the environment loads the simulator in
+# aardvark_sim.py in place of the native library.
+def _aa_load_library ():
+    global api, AA_SW_VERSION, AA_REQ_API_VERSION, AA_LIBRARY_LOADED
     try:
-        api = imp.load_dynamic('aardvark', 'aardvark' + ext)
-    except ImportError, ex2:
-        import_err_msg  = 'Error importing aardvark%s\n' % ext
-        import_err_msg += '  Architecture of aardvark%s may be wrong\n' % ext
-        import_err_msg += '%s\n%s' % (ex1, ex2)
-        raise ImportError(import_err_msg)
-
-AA_SW_VERSION      = api.py_version() & 0xffff
-AA_REQ_API_VERSION = (api.py_version() >> 16) & 0xffff
-AA_LIBRARY_LOADED  = \
-    ((AA_SW_VERSION >= AA_REQ_SW_VERSION) and \
-     (AA_API_VERSION >= AA_REQ_API_VERSION))
+        if os.environ.get('AARDVARK_SIM') and 'aardvark' not in sys.modules:
+            import aardvark_sim
+            sys.modules['aardvark'] = aardvark_sim.AardvarkSim()
+        import aardvark as lib
+    except ImportError as ex1:
+        import imp, platform
+        ext = platform.system() == 'Windows' and '.dll' or '.so'
+        try:
+            lib = imp.load_dynamic('aardvark', 'aardvark' + ext)
+        except ImportError as ex2:
+            import_err_msg  = 'Error importing aardvark%s\n' % ext
+            import_err_msg += '  Architecture of aardvark%s may be wrong\n' % ext
+            import_err_msg += '%s\n%s' % (ex1, ex2)
+            raise ImportError(import_err_msg)
+
+    AA_SW_VERSION      = lib.py_version() & 0xffff
+    AA_REQ_API_VERSION = (lib.py_version() >> 16) & 0xffff
+    AA_LIBRARY_LOADED  = \
+        ((AA_SW_VERSION >= AA_REQ_SW_VERSION) and \
+         (AA_API_VERSION >= AA_REQ_API_VERSION))
+    api = lib
+    return lib
+
+class _AardvarkLazyApi (object):
+    # Placeholder for the native module until the first call into it
+    def __getattr__ (self, name):
+        lib = _aa_load_library()
+        if not AA_LIBRARY_LOADED:
+            return lambda *args: AA_INCOMPATIBLE_LIBRARY
+        return getattr(lib, name)
+
+api = _AardvarkLazyApi()
 
 from array import array, ArrayType
 import struct
@@ -82,16 +111,16 @@ import struct
 #==========================================================================
 # HELPER FUNCTIONS
 #==========================================================================
-def array_u08 (n):  return array('B', '\0'*n)
-def array_u16 (n):  return array('H', '\0\0'*n)
-def array_u32 (n):  return array('I', '\0\0\0\0'*n)
-def array_u64 (n):  return array('K', '\0\0\0\0\0\0\0\0'*n)
-def array_s08 (n):  return array('b', '\0'*n)
-def array_s16 (n):  return array('h', '\0\0'*n)
-def array_s32 (n):  return array('i', '\0\0\0\0'*n)
-def array_s64 (n):  return array('L', '\0\0\0\0\0\0\0\0'*n)
-def array_f32 (n):  return array('f', '\0\0\0\0'*n)
-def array_f64 (n):  return array('d', '\0\0\0\0\0\0\0\0'*n)
+def array_u08 (n):  return array('B', [0]) * n
+def array_u16 (n):  return array('H', [0]) * n
+def array_u32 (n):  return array('I', [0]) * n
+def array_u64 (n):  return array('K', [0]) * n
+def array_s08 (n):  return array('b', [0]) * n
+def array_s16 (n):  return array('h', [0]) * n
+def array_s32 (n):  return array('i', [0]) * n
+def array_s64 (n):  return array('L', [0]) * n
+def array_f32 (n):  return array('f', [0]) * n
+def array_f64 (n):  return array('d', [0]) * n
 
 
 #==========================================================================
@@ -716,6 +745,39 @@ def aa_i2c_write_read (aardvark, slave_addr, flags, out_data, in_data):
     return (_ret_, num_written, in_data, num_read)
 
 
+# Fast path variants of aa_i2c_read, aa_i2c_write and aa_i2c_write_read
+# for tight polling loops.
+#
+# These take caller-owned, preallocated array('B') buffers together with
+# the number of bytes to transfer, and pass them straight to the library:
+# there is no argument checking, no conversion and no allocation per
+# call.  The caller must pass arrays of typecode 'B' that are at least
+# as long as the given byte counts.  Data read is left in the caller's
+# buffer; only the counts are returned.
+def aa_i2c_read_into (aardvark, slave_addr, flags, data_in, num_bytes):
+    """usage: int return = aa_i2c_read_into(Aardvark aardvark, u16 slave_addr, AardvarkI2cFlags flags, u08[] data_in, u16 num_bytes)"""
+
+    if not AA_LIBRARY_LOADED: return AA_INCOMPATIBLE_LIBRARY
+    # Call API function
+    return api.py_aa_i2c_read(aardvark, slave_addr, flags, num_bytes, data_in)
+
+
+def aa_i2c_write_from (aardvark, slave_addr, flags, data_out, num_bytes):
+    """usage: int return = aa_i2c_write_from(Aardvark aardvark, u16 slave_addr, AardvarkI2cFlags flags, u08[] data_out, u16 num_bytes)"""
+
+    if not AA_LIBRARY_LOADED: return AA_INCOMPATIBLE_LIBRARY
+    # Call API function
+    return api.py_aa_i2c_write(aardvark, slave_addr, flags, num_bytes, data_out)
+
+
+def aa_i2c_write_read_into (aardvark, slave_addr, flags, out_data, out_num_bytes, in_data, in_num_bytes):
+    """usage: (int return, u16 num_written, u16 num_read) = aa_i2c_write_read_into(Aardvark aardvark, u16 slave_addr, AardvarkI2cFlags flags, u08[] out_data, u16 out_num_bytes, u08[] in_data, u16 in_num_bytes)"""
+
+    if not AA_LIBRARY_LOADED: return AA_INCOMPATIBLE_LIBRARY
+    # Call API function
+    return api.py_aa_i2c_write_read(aardvark, slave_addr, flags, out_num_bytes, out_data, in_num_bytes, in_data)
+
+
 # Enable/Disable the Aardvark as an I2C slave device
 def aa_i2c_slave_enable (aardvark, addr, maxTxBytes, maxRxBytes):
     """usage: int return = aa_i2c_slave_enable(Aardvark aardvark, u08 addr, u16 maxTxBytes, u16 maxRxBytes)"""
@@ -901,6 +963,16 @@ def aa_i2c_monitor_read (aardvark, data):
     return (_ret_, data)
 
 
+# Fast path variant of aa_i2c_monitor_read, like aa_i2c_read_into: the
+# monitor data is read into the caller's preallocated array('H').
+def aa_i2c_monitor_read_into (aardvark, data, num_words):
+    """usage: int return = aa_i2c_monitor_read_into(Aardvark aardvark, u16[] data, u16 num_words)"""
+
+    if not AA_LIBRARY_LOADED: return AA_INCOMPATIBLE_LIBRARY
+    # Call API function
+    return api.py_aa_i2c_monitor_read(aardvark, num_words, data)
+
+
 # Configure the I2C pullup resistors.
 # This is only supported on hardware versions >= 2.00
 AA_I2C_PULLUP_NONE = 0x00
@@ -1009,6 +1081,17 @@ def aa_spi_write (aardvark, data_out, data_in):
     return (_ret_, data_in)
 
 
+# Fast path variant of aa_spi_write, like aa_i2c_read_into: the caller
+# passes preallocated array('B') buffers with the number of bytes to
+# send and to receive, and the data read is left in data_in.
+def aa_spi_write_into (aardvark, data_out, out_num_bytes, data_in, in_num_bytes):
+    """usage: int return = aa_spi_write_into(Aardvark aardvark, u08[] data_out, u16 out_num_bytes, u08[] data_in, u16 in_num_bytes)"""
+
+    if not AA_LIBRARY_LOADED: return AA_INCOMPATIBLE_LIBRARY
+    # Call API function
+    return api.py_aa_spi_write(aardvark, out_num_bytes, data_out, in_num_bytes, data_in)
+
+
 # Enable/Disable the Aardvark as an SPI slave device
 def aa_spi_slave_enable (aardvark):
     """usage: int return = aa_spi_slave_enable(Aardvark aardvark)"""
@@ -1210,3 +1293,261 @@ def aa_gpio_change (aardvark, timeout):
     return api.py_aa_gpio_change(aardvark, timeout)
 
 
+
+
+#==========================================================================
+# PROFILING
+#==========================================================================
+# Optional instrumentation of every call into the native library, and so
+# of every aa_* entry point above.  aa_profile_enable() puts a recording
+# proxy in front of api, and swaps each aa_* entry point for a timing
+# wrapper, here and in the modules passed to it, so the time spent in
+# the Python wrappers themselves (marshaling the arguments and results)
+# is recorded apart from the native calls, and the native calls are
+# recorded under the entry point that made them.  Modules that imported
+# the entry points with "from aardvark_py import *" must be passed to
+# have their calls timed this way; calls through references held
+# elsewhere (e.g. in functools.partial) still have their native calls
+# recorded, under the native function's name.  While profiling is
+# disabled api is the library itself and the entry points are the
+# plain functions, so they cost nothing extra.
+#
+#   profile = aa_profile_enable(trace=True, modules=[plx8619dbg])
+#   ...
+#   aa_profile_disable()
+#   print(profile.report())
+#   profile.export_trace("trace.json")
+import collections
+import json
+import threading
+import time
+
+# Where the native calls that transfer data return the count actually
+# transferred: None for the return value itself, else the positions in
+# the returned tuple to add up.  Counts are taken from the results
+# rather than the requested lengths, so NACKed and short transfers
+# count only what got through.
+AA_PROFILE_BYTE_RESULTS = {
+    'py_aa_i2c_read':               None,
+    'py_aa_i2c_read_ext':           (1,),
+    'py_aa_i2c_write':              None,
+    'py_aa_i2c_write_ext':          (1,),
+    'py_aa_i2c_write_read':         (1, 2),
+    'py_aa_i2c_slave_set_response': None,
+    'py_aa_i2c_slave_read':         (0,),
+    'py_aa_i2c_slave_read_ext':     (2,),
+    'py_aa_i2c_monitor_read':       None,
+    'py_aa_spi_write':              None,
+    'py_aa_spi_slave_set_response': None,
+    'py_aa_spi_slave_read':         None,
+    }
+
+def _aa_profile_bytes (positions, ret):
+    if positions is None:
+        nbytes = ret
+    elif isinstance(ret, tuple):
+        nbytes = sum(ret[i] for i in positions)
+    else:
+        # an error code in place of the tuple
+        nbytes = 0
+    if not isinstance(nbytes, int):
+        return 0
+    return max(nbytes, 0)
+
+# Latency histogram buckets: bucket i counts calls that took less than
+# 2**i microseconds (and at least 2**(i-1)); the last one counts the rest
+AA_PROFILE_BUCKETS = 24
+
+class AardvarkCallStats:
+    def __init__ (self):
+        self.calls    = 0
+        self.bytes    = 0
+        self.time     = 0.0
+        self.max_time = 0.0
+        self.latency  = [0] * AA_PROFILE_BUCKETS
+        self.statuses = collections.defaultdict(int)
+        # calls of the aa_* entry point of this name, and the time spent
+        # in it outside the native library
+        self.wrapper_calls = 0
+        self.wrapper_time  = 0.0
+
+class AardvarkProfile:
+    """Per-function statistics of the native calls made while profiling,
+    keyed by the aa_* name, and of the time spent in the aa_* entry
+    points outside the native calls.  With trace set, each native call
+    is also kept as an event, up to maxevents of the most recent."""
+    def __init__ (self, trace=False, maxevents=100000):
+        self.stats  = collections.defaultdict(AardvarkCallStats)
+        self.events = None
+        if trace:
+            self.events = collections.deque(maxlen=maxevents)
+        self.start  = time.time()
+        self.lock   = threading.Lock()
+        # per-thread time spent in native calls (and nested entry points)
+        # since the innermost entry point was entered
+        self.local  = threading.local()
+        # modules whose entry points were swapped for timing wrappers
+        self.modules = []
+
+    def record (self, name, start, elapsed, nbytes, ret):
+        # Status is the first value returned by calls that return a
+        # tuple, else negative returns are errors and the rest are 0
+        if isinstance(ret, tuple):
+            status = ret[0]
+        elif isinstance(ret, int):
+            status = min(ret, 0)
+        else:
+            status = 0
+        bucket = min(int(elapsed * 1e6).bit_length(), AA_PROFILE_BUCKETS - 1)
+        with self.lock:
+            s = self.stats[name]
+            s.calls += 1
+            s.bytes += nbytes
+            s.time  += elapsed
+            s.max_time = max(s.max_time, elapsed)
+            s.latency[bucket] += 1
+            s.statuses[status] += 1
+            if self.events is not None:
+                self.events.append((name, start, elapsed, nbytes, status,
+                                    threading.current_thread().ident))
+
+    def record_wrapper (self, name, elapsed):
+        with self.lock:
+            s = self.stats[name]
+            s.wrapper_calls += 1
+            s.wrapper_time  += elapsed
+
+    def report (self):
+        """Return a table of the statistics, the most time consuming
+        functions first"""
+        lines = ["%-28s %8s %10s %10s %10s %10s %10s  %s" % ("function",
+            "calls", "bytes", "total ms", "mean us", "max us", "wrap us",
+            "statuses")]
+        with self.lock:
+            stats = sorted(self.stats.items(),
+                           key=lambda kv: -(kv[1].time + kv[1].wrapper_time))
+            for (name, s) in stats:
+                statuses = " ".join("%d:%d" % kv for kv in sorted(s.statuses.items()))
+                mean = s.calls and s.time / s.calls or 0.0
+                wrap = s.wrapper_calls and s.wrapper_time / s.wrapper_calls or 0.0
+                lines.append("%-28s %8d %10d %10.1f %10.1f %10.1f %10.1f  %s" % (
+                    name, max(s.calls, s.wrapper_calls), s.bytes,
+                    1e3 * (s.time + s.wrapper_time), 1e6 * mean,
+                    1e6 * s.max_time, 1e6 * wrap, statuses))
+        return "\n".join(lines)
+
+    def export_trace (self, filename):
+        """Write the recorded events as a Chrome trace event file, for
+        chrome://tracing or Perfetto"""
+        with self.lock:
+            events = [{"name": name, "ph": "X", "pid": 0, "tid": tid,
+                       "ts": 1e6 * (start - self.start), "dur": 1e6 * elapsed,
+                       "args": {"bytes": nbytes, "status": status}}
+                      for (name, start, elapsed, nbytes, status, tid)
+                      in (self.events or ())]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+class _AardvarkProfiledApi (object):
+    # Proxy for the native module that records each call in a profile
+    def __init__ (self, lib, profile):
+        self.lib     = lib
+        self.profile = profile
+
+    def __getattr__ (self, name):
+        func     = getattr(self.lib, name)
+        profile  = self.profile
+        local    = profile.local
+        counted  = name in AA_PROFILE_BYTE_RESULTS
+        positions = AA_PROFILE_BYTE_RESULTS.get(name)
+        aa_name  = name[3:]
+        def profiled (*args):
+            start = time.time()
+            ret = func(*args)
+            elapsed = time.time() - start
+            local.inner = getattr(local, 'inner', 0.0) + elapsed
+            nbytes = counted and _aa_profile_bytes(positions, ret) or 0
+            # record under the entry point that made the call, if timed
+            profile.record(getattr(local, 'entry', None) or aa_name, start,
+                           elapsed, nbytes, ret)
+            return ret
+        # Cache the wrapper so later calls skip __getattr__
+        setattr(self, name, profiled)
+        return profiled
+
+def _aa_profile_wrap (name, func, profile):
+    # Timing wrapper for the entry point <func>: records the time spent
+    # in it less that spent in the native calls it made
+    local = profile.local
+    def wrapper (*args, **kwargs):
+        outer = getattr(local, 'inner', 0.0)
+        entry = getattr(local, 'entry', None)
+        local.inner = 0.0
+        local.entry = name
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            profile.record_wrapper(name, elapsed - local.inner)
+            local.inner = outer + elapsed
+            local.entry = entry
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__  = func.__doc__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+def _aa_profile_entry_points ():
+    # The aa_* functions of this module other than the profiling ones
+    this = sys.modules[__name__]
+    return dict((name, func) for (name, func) in vars(this).items()
+                if name.startswith('aa_') and callable(func)
+                and getattr(func, '__module__', None) == __name__
+                and not name.startswith('aa_profile_'))
+
+def _aa_profile_swap (swaps, modules):
+    # Rebind the entry points of this module, and those of <modules>
+    # that imported them, from the keys of <swaps> to their values
+    for module in [sys.modules[__name__]] + list(modules):
+        for (attr, value) in list(vars(module).items()):
+            if attr.startswith('aa_') and callable(value) \
+                    and value in swaps:
+                setattr(module, attr, swaps[value])
+
+def aa_profile_enable (trace=False, maxevents=100000, modules=()):
+    """usage: AardvarkProfile return = aa_profile_enable(bool trace, int maxevents, module[] modules)
+
+    Start recording the calls into the native library in a new profile,
+    which is returned, and time the aa_* entry points here and in the
+    given modules.  This loads the library if it is not loaded yet."""
+    global api
+    lib = api
+    if isinstance(lib, _AardvarkProfiledApi):
+        lib = lib.lib
+    elif isinstance(lib, _AardvarkLazyApi):
+        lib = _aa_load_library()
+    if isinstance(api, _AardvarkProfiledApi):
+        aa_profile_disable()
+    profile = AardvarkProfile(trace, maxevents)
+    profile.modules = list(modules)
+    api = _AardvarkProfiledApi(lib, profile)
+    _aa_profile_swap(dict((func, _aa_profile_wrap(name, func, profile))
+                          for (name, func) in _aa_profile_entry_points().items()),
+                     profile.modules)
+    return profile
+
+def aa_profile_disable ():
+    """usage: AardvarkProfile return = aa_profile_disable()
+
+    Stop profiling and return the profile that was being recorded, or
+    None if profiling was not enabled."""
+    global api
+    if not isinstance(api, _AardvarkProfiledApi):
+        return None
+    profile = api.profile
+    api = api.lib
+    _aa_profile_swap(dict((func, func.__wrapped__) for func in
+                          _aa_profile_entry_points().values()
+                          if hasattr(func, '__wrapped__')),
+                     profile.modules)
+    return profile
@@ -0,0 +1,494 @@
+#==========================================================================
+# Simulated Aardvark with a PLX switch attached
+#--------------------------------------------------------------------------
+# A stand-in for the native aardvark module, for running plx8619dbg,
+# plxread and the other tools without hardware.
+#
+# The simulated switch answers the PLX I2C register protocol (the
+# PLX_CMD_READ and PLX_CMD_WRITE command frames built by plx_command)
+# from a register file keyed by (port, addr).  Every transaction takes
+# the time of a USB round trip plus the I2C bus time of its bytes at
+# the configured bitrate, so timings are reproducible.
+#
+#   sim = aardvark_sim.install(AardvarkSim(regs={(0, 0x078): 0x30110000}))
+#   handle = aa_open(0)
+#   ...
+#   print(sim.transactions, sim.wire_time)
+#
+# Setting the environment variable AARDVARK_SIM=1 makes aardvark_py
+# load a default AardvarkSim in place of the native library, which lets
+# the command line tools run unchanged.
+#==========================================================================
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import collections
+import sys
+import time
+
+import aardvark_py
+from aardvark_py import AA_API_VERSION, AA_REQ_SW_VERSION, AA_OK, \
+    AA_UNABLE_TO_OPEN, AA_INVALID_HANDLE, AA_PORT_NOT_FREE, \
+    AA_UNABLE_TO_LOAD_FUNCTION, \
+    AA_FEATURE_I2C, AA_FEATURE_GPIO, AA_FEATURE_I2C_MONITOR, \
+    AA_I2C_STATUS_OK, AA_I2C_STATUS_SLA_NACK, AA_ASYNC_NO_DATA, \
+    AA_ASYNC_I2C_MONITOR, AA_I2C_MONITOR_NACK, AA_I2C_MONITOR_CMD_START, \
+    AA_I2C_MONITOR_CMD_STOP
+
+
+#==========================================================================
+# CONSTANTS
+#==========================================================================
+PLX_CMD_WRITE = 0x3
+PLX_CMD_READ = 0x4
+
+# Latency model defaults: Aardvark USB round trip per transaction, and
+# I2C clocks per START/STOP and per byte (8 data bits plus ACK)
+AA_SIM_USB_RTT = 0.001  # s
+AA_SIM_START_BITS = 1
+AA_SIM_STOP_BITS = 1
+AA_SIM_BYTE_BITS = 9
+
+AA_SIM_UNIQUE_ID = 2237000000
+
+# Default register file: a PEX 8619 in the x4 x4 x1 ... port
+# configuration with ports 0 and 1 up at x4 5.0 GT/s
+PLX_SIM_REGS = {
+    (0, 0x574): 0x00000002,     # port configuration
+    (0, 0x668): 0x00000003,     # ports 0 and 1 enabled
+    (0, 0x66c): 0x0000028a,     # ports 0 and 1 x4 5.0 GT/s
+    (0, 0x1f4): 0x000000ff,     # lanes 0-7 up
+    (0, 0x200): 0xff000000,     # receivers detected on lanes 0-7
+    (0, 0x078): 0x20420000,     # link status: x4 5.0 GT/s, DLL active
+    (1, 0x078): 0x20420000,
+    }
+
+
+#==========================================================================
+# CLASSES
+#==========================================================================
+class AA_SimEeprom(object):
+    ''' A 24Cxx serial EEPROM at i2c address <device>, for use as the
+    eeprom of an AardvarkSim.  It does not ack for <write_cycle> seconds
+    of simulated time after each page write, like the real part. '''
+    def __init__(self, size=8192, page_size=32, addr_bytes=2, device=0x50,
+            write_cycle=0.005):
+        self.mem = bytearray(b'\xff' * size)
+        self.page_size = page_size
+        self.addr_bytes = addr_bytes
+        self.device = device
+        self.write_cycle = write_cycle
+        # parts with one address byte take the upper address bits in
+        # the i2c address
+        self.blocks = addr_bytes == 1 and max(1, size // 256) or 1
+        self.ptr = 0
+        self.ready = 0.0
+
+    def owns(self, slave_addr):
+        return (slave_addr & ~(self.blocks - 1)) == self.device
+
+    def busy(self, now):
+        return now < self.ready
+
+    def write(self, slave_addr, data, num_bytes, now):
+        if num_bytes < self.addr_bytes:
+            return
+        if self.addr_bytes == 1:
+            addr = ((slave_addr & (self.blocks - 1)) << 8) | data[0]
+        else:
+            addr = (data[0] << 8) | data[1]
+        self.ptr = addr % len(self.mem)
+        if num_bytes > self.addr_bytes:
+            # page writes wrap around within the page
+            base = self.ptr - self.ptr % self.page_size
+            for i in range(num_bytes - self.addr_bytes):
+                offset = (self.ptr - base + i) % self.page_size
+                self.mem[base + offset] = data[self.addr_bytes + i]
+            self.ready = now + self.write_cycle
+
+    def read(self, data, num_bytes):
+        for i in range(num_bytes):
+            data[i] = self.mem[self.ptr]
+            self.ptr = (self.ptr + 1) % len(self.mem)
+
+
+class AardvarkSim(object):
+    ''' Simulated aardvark module: <nadapters> adapters, each wired to a
+    PLX switch at i2c address <device> (None answers any address).
+
+    regs is the switch's register file, a dict of (port, addr) to the
+    32-bit value (default: a copy of PLX_SIM_REGS); registers missing
+    from it read as <default>.  All adapters share the one register
+    file.
+
+    eeprom is an optional AA_SimEeprom on the same bus.
+
+    While any adapter has its bus monitor enabled, the transactions of
+    the others are recorded for it to read, and monitor_feed() adds
+    traffic from other bus masters.
+
+    Each transaction adds usb_rtt plus its bus time to wire_time and,
+    with <sleep> set, actually takes that long.  With sleep unset the
+    simulator runs as fast as Python allows while wire_time still
+    accounts for the time real hardware would have taken.
+
+    The GPIO lines only read back what was set, and nothing is wired to
+    SPI: the SPI and I2C slave functions return
+    AA_UNABLE_TO_LOAD_FUNCTION. '''
+    def __init__(self, regs=None, device=None, default=0, nadapters=1,
+            usb_rtt=AA_SIM_USB_RTT, sleep=True, eeprom=None):
+        if regs is None:
+            regs = dict(PLX_SIM_REGS)
+        self.regs = regs
+        self.device = device
+        self.default = default
+        self.nadapters = nadapters
+        self.usb_rtt = usb_rtt
+        self.sleep = sleep
+        self.eeprom = eeprom
+        self.monitors = set()
+        self.bus = collections.deque()
+        self.bitrate = 100
+        self.gpio_direction = 0
+        self.gpio_pullup = 0
+        self.gpio_out = 0
+        self.handles = {}
+        self.transactions = 0
+        self.wire_time = 0.0
+
+    #----------------------------------------------------------------------
+    # Latency model and protocol
+    #----------------------------------------------------------------------
+    def bus_time(self, *segments):
+        ''' return the time of one transaction of the given segments, each
+        a number of data bytes sent after a (repeated) START and the
+        address byte '''
+        bits = AA_SIM_STOP_BITS
+        for nbytes in segments:
+            bits += AA_SIM_START_BITS + AA_SIM_BYTE_BITS * (1 + nbytes)
+        return self.usb_rtt + bits / (self.bitrate * 1000.0)
+
+    def transact(self, *segments):
+        t = self.bus_time(*segments)
+        self.transactions += 1
+        self.wire_time += t
+        if self.sleep:
+            time.sleep(t)
+
+    def is_eeprom(self, slave_addr):
+        return self.eeprom is not None and self.eeprom.owns(slave_addr)
+
+    def acks(self, handle, slave_addr):
+        if handle not in self.handles:
+            return False
+        if self.is_eeprom(slave_addr):
+            return not self.eeprom.busy(self.wire_time)
+        return self.device is None or slave_addr == self.device
+
+    def command(self, handle, data, num_bytes):
+        ''' act on a PLX command frame written to the switch '''
+        if num_bytes < 4:
+            return
+        cmd = data[0] & 0x7
+        port = ((data[1] & 0xf) << 1) | (data[2] >> 7)
+        byte_enables = (data[2] >> 2) & 0xf
+        addr = ((data[2] & 0x3) << 10) | (data[3] << 2)
+        if cmd == PLX_CMD_READ:
+            self.handles[handle] = self.regs.get((port, addr), self.default)
+        elif cmd == PLX_CMD_WRITE and num_bytes >= 8:
+            val = (data[4] << 24) | (data[5] << 16) | (data[6] << 8) | data[7]
+            mask = 0
+            for i in range(4):
+                if byte_enables & (1 << i):
+                    mask |= 0xff << (8 * i)
+            old = self.regs.get((port, addr), self.default)
+            self.regs[(port, addr)] = (old & ~mask) | (val & mask)
+
+    def fill(self, handle, data, num_bytes):
+        ''' return the data phase of a read: the latched register MSB
+        first, then 0xff '''
+        val = self.handles[handle]
+        for i in range(num_bytes):
+            if i < 4:
+                data[i] = (val >> (8 * (3 - i))) & 0xff
+            else:
+                data[i] = 0xff
+
+    def monitor_feed(self, words):
+        ''' add bus monitor words to what monitoring adapters read '''
+        if self.monitors:
+            self.bus.extend(words)
+
+    def monitor_segment(self, words, slave_addr, read, acked, data, num_bytes):
+        words.append(AA_I2C_MONITOR_CMD_START)
+        words.append(((slave_addr << 1) | read)
+            | (not acked and AA_I2C_MONITOR_NACK or 0))
+        for i in range(num_bytes):
+            words.append(data[i])
+        # the master NACKs the last byte it reads
+        if read and num_bytes:
+            words[-1] |= AA_I2C_MONITOR_NACK
+
+    def monitor_transaction(self, slave_addr, acked, out_data=None,
+            out_num_bytes=0, in_data=None, in_num_bytes=None):
+        if not self.monitors:
+            return
+        words = []
+        if out_data is not None:
+            self.monitor_segment(words, slave_addr, 0, acked, out_data,
+                acked and out_num_bytes or 0)
+        if in_data is not None and (acked or out_data is None):
+            self.monitor_segment(words, slave_addr, 1, acked, in_data,
+                acked and in_num_bytes or 0)
+        words.append(AA_I2C_MONITOR_CMD_STOP)
+        self.bus.extend(words)
+
+    def write_data(self, handle, slave_addr, data, num_bytes):
+        if self.is_eeprom(slave_addr):
+            self.eeprom.write(slave_addr, data, num_bytes, self.wire_time)
+        else:
+            self.command(handle, data, num_bytes)
+
+    def read_data(self, handle, slave_addr, data, num_bytes):
+        if self.is_eeprom(slave_addr):
+            self.eeprom.read(data, num_bytes)
+        else:
+            self.fill(handle, data, num_bytes)
+
+    #----------------------------------------------------------------------
+    # aardvark module interface
+    #----------------------------------------------------------------------
+    def py_version(self):
+        return (AA_API_VERSION << 16) | AA_REQ_SW_VERSION
+
+    def py_aa_find_devices(self, num_devices, devices):
+        for i in range(min(num_devices, self.nadapters)):
+            devices[i] = i | (i + 1 in self.handles and AA_PORT_NOT_FREE or 0)
+        return self.nadapters
+
+    def py_aa_find_devices_ext(self, num_devices, num_ids, devices, unique_ids):
+        self.py_aa_find_devices(num_devices, devices)
+        for i in range(min(num_ids, self.nadapters)):
+            unique_ids[i] = AA_SIM_UNIQUE_ID + i
+        return self.nadapters
+
+    def py_aa_open(self, port_number):
+        handle = port_number + 1
+        if port_number < 0 or port_number >= self.nadapters \
+                or handle in self.handles:
+            return AA_UNABLE_TO_OPEN
+        self.handles[handle] = self.default
+        return handle
+
+    def py_aa_close(self, aardvark):
+        if self.handles.pop(aardvark, None) is None:
+            return AA_INVALID_HANDLE
+        return 1
+
+    def py_aa_port(self, aardvark):
+        return aardvark - 1
+
+    def py_aa_unique_id(self, aardvark):
+        return AA_SIM_UNIQUE_ID + aardvark - 1
+
+    def py_aa_features(self, aardvark):
+        return AA_FEATURE_I2C | AA_FEATURE_GPIO | AA_FEATURE_I2C_MONITOR
+
+    def py_aa_status_string(self, status):
+        return "simulated status %d" % status
+
+    def py_aa_configure(self, aardvark, config):
+        return config & 0x3
+
+    def py_aa_target_power(self, aardvark, power_mask):
+        return power_mask
+
+    def py_aa_i2c_pullup(self, aardvark, pullup_mask):
+        return pullup_mask
+
+    def py_aa_i2c_bus_timeout(self, aardvark, timeout_ms):
+        return timeout_ms
+
+    def py_aa_i2c_bitrate(self, aardvark, bitrate_khz):
+        if bitrate_khz > 0:
+            self.bitrate = min(bitrate_khz, 800)
+        return self.bitrate
+
+    def py_aa_sleep_ms(self, milliseconds):
+        if self.sleep:
+            time.sleep(milliseconds / 1000.0)
+        return milliseconds
+
+    def py_aa_i2c_write_ext(self, aardvark, slave_addr, flags, num_bytes,
+            data_out):
+        if not self.acks(aardvark, slave_addr):
+            self.transact(0)
+            self.monitor_transaction(slave_addr, False, data_out, num_bytes)
+            return (AA_I2C_STATUS_SLA_NACK, 0)
+        self.transact(num_bytes)
+        self.write_data(aardvark, slave_addr, data_out, num_bytes)
+        self.monitor_transaction(slave_addr, True, data_out, num_bytes)
+        return (AA_I2C_STATUS_OK, num_bytes)
+
+    def py_aa_i2c_write(self, aardvark, slave_addr, flags, num_bytes,
+            data_out):
+        return self.py_aa_i2c_write_ext(aardvark, slave_addr, flags,
+            num_bytes, data_out)[1]
+
+    def py_aa_i2c_read_ext(self, aardvark, slave_addr, flags, num_bytes,
+            data_in):
+        if not self.acks(aardvark, slave_addr):
+            self.transact(0)
+            self.monitor_transaction(slave_addr, False, in_data=data_in)
+            return (AA_I2C_STATUS_SLA_NACK, 0)
+        self.transact(num_bytes)
+        self.read_data(aardvark, slave_addr, data_in, num_bytes)
+        self.monitor_transaction(slave_addr, True, in_data=data_in,
+            in_num_bytes=num_bytes)
+        return (AA_I2C_STATUS_OK, num_bytes)
+
+    def py_aa_i2c_read(self, aardvark, slave_addr, flags, num_bytes, data_in):
+        return self.py_aa_i2c_read_ext(aardvark, slave_addr, flags,
+            num_bytes, data_in)[1]
+
+    def py_aa_i2c_write_read(self, aardvark, slave_addr, flags,
+            out_num_bytes, out_data, in_num_bytes, in_data):
+        if not self.acks(aardvark, slave_addr):
+            self.transact(0)
+            self.monitor_transaction(slave_addr, False, out_data,
+                out_num_bytes)
+            return (AA_I2C_STATUS_SLA_NACK, 0, 0)
+        self.transact(out_num_bytes, in_num_bytes)
+        self.write_data(aardvark, slave_addr, out_data, out_num_bytes)
+        self.read_data(aardvark, slave_addr, in_data, in_num_bytes)
+        self.monitor_transaction(slave_addr, True, out_data, out_num_bytes,
+            in_data, in_num_bytes)
+        return (AA_I2C_STATUS_OK, out_num_bytes, in_num_bytes)
+
+    def py_aa_i2c_monitor_enable(self, aardvark):
+        self.monitors.add(aardvark)
+        return AA_OK
+
+    def py_aa_i2c_monitor_disable(self, aardvark):
+        self.monitors.discard(aardvark)
+        if not self.monitors:
+            self.bus.clear()
+        return AA_OK
+
+    def py_aa_i2c_monitor_read(self, aardvark, num_words, data):
+        n = 0
+        bus = self.bus
+        while n < num_words and bus:
+            data[n] = bus.popleft()
+            n += 1
+        return n
+
+    def py_aa_async_poll(self, aardvark, timeout):
+        deadline = time.time() + timeout / 1000.0
+        while True:
+            if aardvark in self.monitors and self.bus:
+                return AA_ASYNC_I2C_MONITOR
+            if timeout >= 0 and time.time() >= deadline:
+                return AA_ASYNC_NO_DATA
+            time.sleep(0.001)
+
+    def py_aa_gpio_direction(self, aardvark, direction_mask):
+        self.gpio_direction = direction_mask
+        return AA_OK
+
+    def py_aa_gpio_pullup(self, aardvark, pullup_mask):
+        self.gpio_pullup = pullup_mask
+        return AA_OK
+
+    def py_aa_gpio_set(self, aardvark, value):
+        self.gpio_out = value
+        return AA_OK
+
+    def py_aa_gpio_get(self, aardvark):
+        # inputs float to their pullups
+        return (self.gpio_out & self.gpio_direction) | \
+            (self.gpio_pullup & ~self.gpio_direction)
+
+    def py_aa_gpio_change(self, aardvark, timeout):
+        # nothing else drives the lines, so they never change
+        self.py_aa_sleep_ms(timeout)
+        return self.py_aa_gpio_get(aardvark)
+
+    #----------------------------------------------------------------------
+    # Not simulated
+    #----------------------------------------------------------------------
+    def py_aa_open_ext(self, port_number):
+        return (AA_UNABLE_TO_LOAD_FUNCTION, 7 * (0,))
+
+    def py_aa_version(self, aardvark):
+        return (AA_UNABLE_TO_LOAD_FUNCTION, 6 * (0,))
+
+    def py_aa_log(self, aardvark, level, handle):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_i2c_free_bus(self, aardvark):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_i2c_slave_enable(self, aardvark, addr, maxTxBytes, maxRxBytes):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_i2c_slave_disable(self, aardvark):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_i2c_slave_set_response(self, aardvark, num_bytes, data_out):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_i2c_slave_write_stats(self, aardvark):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_i2c_slave_write_stats_ext(self, aardvark):
+        return (AA_UNABLE_TO_LOAD_FUNCTION, 0)
+
+    def py_aa_i2c_slave_read(self, aardvark, num_bytes, data_in):
+        return (AA_UNABLE_TO_LOAD_FUNCTION, 0)
+
+    def py_aa_i2c_slave_read_ext(self, aardvark, num_bytes, data_in):
+        return (AA_UNABLE_TO_LOAD_FUNCTION, 0, 0)
+
+    def py_aa_spi_bitrate(self, aardvark, bitrate_khz):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_configure(self, aardvark, cpol, cpha, bitorder):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_master_ss_polarity(self, aardvark, polarity):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_write(self, aardvark, out_num_bytes, data_out,
+            in_num_bytes, data_in):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_slave_enable(self, aardvark):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_slave_disable(self, aardvark):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_slave_set_response(self, aardvark, num_bytes, data_out):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+    def py_aa_spi_slave_read(self, aardvark, num_bytes, data_in):
+        return AA_UNABLE_TO_LOAD_FUNCTION
+
+
+#==========================================================================
+# FUNCTIONS
+#==========================================================================
+def install(sim=None):
+    ''' make aardvark_py use <sim> (default: a new AardvarkSim) in place
+    of the native library, and return it '''
+    if sim is None:
+        sim = AardvarkSim()
+    sys.modules['aardvark'] = sim
+    aardvark_py._aa_load_library()
+    return sim
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,76 @@
+#	 Utility to check PEX8734 EEPROM binaries
+#
+# Parses each image back into its register entries and checks the
+# signature, byte count and CRC.  Directories are searched for .bin
+# files, so a whole image library can be audited at once.
+#
+# usage: eeprom_check.py [-v] image.bin|directory ...
+#
+#	-v	list the register entries of each image
+
+
+import mmap
+import os
+import sys
+
+from eeprom_gen import PLX_Image
+
+
+def image_paths(paths):
+	"""Yield the image files named by paths, searching directories"""
+	for path in paths:
+		if not os.path.isdir(path):
+			yield path
+			continue
+		for (dirpath, dirnames, filenames) in os.walk(path):
+			dirnames.sort()
+			for name in sorted(filenames):
+				if name.endswith(".bin"):
+					yield os.path.join(dirpath, name)
+
+
+def check_image(path):
+	"""Parse the image file at path, memory-mapped, into a PLX_Image"""
+	with open(path, mode="rb") as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return PLX_Image(b'')
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return PLX_Image(m)
+		finally:
+			m.close()
+
+
+def main():
+	args = sys.argv[1:]
+	verbose = False
+	if args and args[0] == "-v":
+		verbose = True
+		args = args[1:]
+	if not args:
+		print("usage: eeprom_check.py [-v] image.bin|directory ...")
+		return 2
+
+	nimages = 0
+	nbad = 0
+	for path in image_paths(args):
+		nimages += 1
+		image = check_image(path)
+		if image.errors:
+			nbad += 1
+			for error in image.errors:
+				print("{}: {}".format(path, error))
+		elif verbose:
+			print("{}: {} entries, CRC {}".format(path, len(image.entries),
+				image.crc_enabled and "ok" or "disabled"))
+		if verbose:
+			for (port, addr, value) in image.entries:
+				print("\tport {!r:14} 0x{:03x} = 0x{:08x}".format(port, addr,
+					value))
+
+	print("{} of {} images bad".format(nbad, nimages))
+	return nbad and 1 or 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
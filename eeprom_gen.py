@@ -29,6 +29,12 @@
 
 import struct
 import codecs
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
 
 PLX_port = {0: 0x0,
 	1: 0x1,
@@ -61,142 +67,482 @@ def PLX_RegEntry(port, addr, value):
 	return struct.pack('<HI', RegAddr, value)
 
 
+# PLX_port key of each port encoding
+PLX_PortName = dict((v, k) for (k, v) in PLX_port.items())
+
+def PLX_DecodeRegAddr(RegAddr):
+	"""Return the (port, addr) written by an entry with this RegAddr.
+	port is the PLX_port key, or the raw encoding if it has none."""
+	port = RegAddr >> 10
+	return (PLX_PortName.get(port, port), (RegAddr & 0x3ff) << 2)
+
+
+
+
+# EEPROM CRC, as computed by the PLX SDK for PEX 8000 series switches:
+# a CRC-32 with this polynomial constant and an initial value of
+# 0xffffffff, fed MSB first with each little-endian 32-bit word from
+# byte 0x00 up to the CRC.  A trailing partial word is padded with zeros.
+PLX_CRC_POLY = 0xdb710641
+PLX_CRC_INIT = 0xffffffff
+
+# Byte 0x01 bit that makes the switch check the CRC
+PLX_CRC_ENABLE = 0x80
+
+def PLX_CrcTable():
+	table = []
+	for i in range(256):
+		c = i << 24
+		for j in range(8):
+			if c & 0x80000000:
+				c = ((c << 1) ^ PLX_CRC_POLY) & 0xffffffff
+			else:
+				c = (c << 1) & 0xffffffff
+		table.append(c)
+	return table
+
+PLX_CRC_TABLE = PLX_CrcTable()
+
+def PLX_Crc(buf, length):
+	"""Return the EEPROM CRC of the first length bytes of buf"""
+	table = PLX_CRC_TABLE
+	data = bytearray(buf[:length])
+	data += bytearray(-length % 4)
+	crc = PLX_CRC_INIT
+	for off in range(0, len(data), 4):
+		# each word goes in MSB first, i.e. its bytes in reverse order
+		for i in (3, 2, 1, 0):
+			crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ data[off + i]]
+	return crc
+
+
+# Power-on values of registers written by the options, by RegAddr.
+# Writing one of these values is a no-op that only slows the EEPROM load.
+PLX_POR_DEFAULTS = {
+	PLX_RegAddr(PLX_port[0], 0x30c): 0x010000ff,
+	}
 
 
 class PLX_RegStream(list):
 	def __init__(self):
 		list.__init__(self)
-
-	def serialize(self):
-		buf = bytearray()
-		buf += struct.pack('b', 0x5a)
-		buf += struct.pack('b', 0x00)
-		buf += struct.pack('<H', len(self) * 6)
+		# bytes saved by the optimize() that returned this stream
+		self.saved = 0
+
+	def optimize(self, defaults=PLX_POR_DEFAULTS):
+		"""Return an equivalent stream with one entry per register.
+		Repeated writes to a register are folded into its last write,
+		which keeps the position of that write, and writes of the value
+		given for the register in defaults are dropped.  The bytes
+		saved are recorded in the saved attribute of the new stream."""
+		entries = [struct.unpack('<HI', bytes(e)) for e in self]
+		last = {}
+		for (i, (regaddr, value)) in enumerate(entries):
+			last[regaddr] = i
+		rs = PLX_RegStream()
+		for (i, (regaddr, value)) in enumerate(entries):
+			if last[regaddr] == i and defaults.get(regaddr) != value:
+				rs.append(self[i])
+		rs.saved = self.saved + 6 * (len(self) - len(rs))
+		return rs
+
+	def serialize(self, crc=False):
+		"""Return the EEPROM image of the stream as a bytearray.
+		With crc set, CRC checking is enabled in byte 0x01 and the
+		CRC is filled in; otherwise the CRC is left as 0."""
+		count = len(self) * 6
+		buf = bytearray(4 + count + 4)
+		struct.pack_into('<BBH', buf, 0, 0x5a,
+			crc and PLX_CRC_ENABLE or 0x00, count)
+		offset = 4
 		for e in self:
-			buf += e
+			buf[offset:offset + 6] = e
+			offset += 6
 		crcval = 0
-		buf += struct.pack('<I', crcval)
+		if crc:
+			crcval = PLX_Crc(buf, offset)
+		struct.pack_into('<I', buf, offset, crcval)
 		return buf
 
 
-rs = PLX_RegStream()
-
-# Enable x4x4x8 Port Config + defaults for port 4
-correct_station_2_lane_reversal = True
-if (correct_station_2_lane_reversal):
-	rs.append(PLX_RegEntry(PLX_port[4], 0x220, # Port 4 to select station 1 (ports 4-7)
-			(1 << 8) 
-			| (1 << 12)
-			| (1 << 13)
-			| (1 << 14)
-			| (1 << 30))) # enable x4x4x8 Port Config
-
-# Disable Port 1
-# Used on VPX1142 carrier in NG chassis to 
-# disable port designated for NT bridge
-# between processor domains
-disable_port_1 = False
-if (disable_port_1):
-	rs.append(PLX_RegEntry(PLX_port[0], 0x208,
-		(1 << 1) # Port 1 Disable
-		)) 
-	rs.append(PLX_RegEntry(PLX_port[0], 0x30c, # Port 0
-		0x010000ff # Default POR value
-		& ~(1 << 1) # Port 1 Disable clock
-		)) 
-
-# Disable Port 4
-# Used on VPX7664 CPU B in NG Chassis
-# disable port designated for NT bridge
-# between processor domains
-disable_port_4 = False
-if (disable_port_4):
-	rs.append(PLX_RegEntry(PLX_port[4], 0x208, # Port 4 to select station 1 (ports 4-7)
-		(1 << 0) # Port 0 Disable RX termination
-		)) 
-	rs.append(PLX_RegEntry(PLX_port[0], 0x30c, # Port 0
-		0x010000ff # 
-		& ~(1 << 4) # Port 4 Disable clock
-		)) 
-
-
-upstream_port_1 = True
-if (upstream_port_1):
-	rs.append(PLX_RegEntry(PLX_port[0], 0x360,
-		(0x1 << 0) # Upstream Port
-		| (0x1a << 8) # NT0 port (0x1a = disabled)
-		& ~(1 << 13) # NT0 1 = Enable
-		| (0x1a << 16) # NT1 port (0x1a = disabled)
-		& ~(1 << 21) # NT1 1 = Enable
-		))
-
-NT_port_1 = False
-if (NT_port_1):
-	rs.append(PLX_RegEntry(PLX_port[0], 0x360,
-		(0x0 << 0) # Upstream Port
-		| (0x1 << 8) # NT0 port (0x1a = disabled)
-		| (1 << 13) # NT0 1 = Enable
-		| (0x1a << 16) # NT1 port (0x1a = disabled)
-		& ~(1 << 21) # NT1 1 = Enable
-		))
-
-NT_port_4 = False
-if (NT_port_4):
-	rs.append(PLX_RegEntry(PLX_port[0], 0x360,
-		((0 << 0) & 0xf) # Upstream Port
-		| (0x4 << 8) # NT0 port (0x1a = disabled)
-		| (1 << 13) # NT0 1 = Enable
-		| (0x1a << 16) # NT1 port (0x1a = disabled)
-		& ~(1 << 21) # NT1 1 = Enable
-		))
-
-# If an NT port is configured, setup the Link and Virtual interfaces
-if False and (NT_port_1 or NT_port_4):
-	rs.append(PLX_RegEntry(PLX_port['NT0 Link'], 0x04, # NT Link Interface BAR0/1 Setup
-		(1 << 1) # Memory Access Enable
-		| (1 << 10) # Disable INTx from NT Link Interface
-		))
-	rs.append(PLX_RegEntry(PLX_port['NT0 Virtual'], 0x04, # NT Virtual Interface BAR0/1 Setup
-		(1 << 1) # Memory Access Enable
-		| (1 << 10) # Disable INTx from NT Virtual Interface
-		))
-
+PLX_IMAGE_SIGNATURE = 0x5a
+PLX_IMAGE_HEADER = struct.Struct('<BBH')
+PLX_IMAGE_ENTRY = struct.Struct('<HI')
+PLX_IMAGE_CRC = struct.Struct('<I')
+
+
+class PLX_Image(object):
+	"""An EEPROM image parsed back into its register entries.
+
+	buf is anything struct.unpack_from accepts, such as bytes or an mmap.
+	Problems found are listed in errors rather than raised; an image is
+	valid when errors is empty.  entries holds (port, addr, value) in
+	image order, and index maps each (port, addr) to the list of its
+	entry numbers."""
+	def __init__(self, buf):
+		self.errors = []
+		self.entries = []
+		self.index = {}
+		self.crc_enabled = False
+		self.crc = None
+		self.crc_ok = None
+
+		if len(buf) < PLX_IMAGE_HEADER.size:
+			self.errors.append("image too short ({} bytes)".format(len(buf)))
+			return
+		(signature, flags, count) = PLX_IMAGE_HEADER.unpack_from(buf, 0)
+		self.crc_enabled = bool(flags & PLX_CRC_ENABLE)
+		self.count = count
+		if signature != PLX_IMAGE_SIGNATURE:
+			self.errors.append("bad signature 0x{:02x}".format(signature))
+			return
+		if count % PLX_IMAGE_ENTRY.size:
+			self.errors.append("byte count {} is not a whole number of entries"
+				.format(count))
+		end = PLX_IMAGE_HEADER.size + count
+		if end > len(buf):
+			self.errors.append("byte count {} runs past the end of the image"
+				.format(count))
+			end = len(buf)
+
+		for offset in range(PLX_IMAGE_HEADER.size,
+				end - PLX_IMAGE_ENTRY.size + 1, PLX_IMAGE_ENTRY.size):
+			(RegAddr, value) = PLX_IMAGE_ENTRY.unpack_from(buf, offset)
+			(port, addr) = PLX_DecodeRegAddr(RegAddr)
+			self.index.setdefault((port, addr), []).append(len(self.entries))
+			self.entries.append((port, addr, value))
+
+		if end + PLX_IMAGE_CRC.size <= len(buf):
+			self.crc = PLX_IMAGE_CRC.unpack_from(buf, end)[0]
+		if self.crc_enabled:
+			if self.crc is None:
+				self.errors.append("CRC missing")
+			else:
+				expected = PLX_Crc(buf, end)
+				self.crc_ok = (self.crc == expected)
+				if not self.crc_ok:
+					self.errors.append("CRC 0x{:08x}, expected 0x{:08x}"
+						.format(self.crc, expected))
+
+	def value(self, port, addr):
+		"""Return the value the image leaves in a register, or None"""
+		entries = self.index.get((port, addr))
+		if not entries:
+			return None
+		return self.entries[entries[-1]][2]
 
 
 PortCfg = {'x16': 0x1,
 	'x8x8': 0x2,
 	'x8x4x4': 0x3,
 	'x4x4x4x4': 0x4 }
-PortCfg_x4x4x4x4 = False
-if (PortCfg_x4x4x4x4):
-	rs.append(PLX_RegEntry(PLX_port[0], 0x300,
-		(PortCfg['x4x4x4x4'] << 0)
-		| (PortCfg['x8x4x4'] << 3)
-		))
-
-PortCfg_x8x8 = True
-if (PortCfg_x8x8):
-	rs.append(PLX_RegEntry(PLX_port[0], 0x300,
-		(PortCfg['x8x8'] << 0)
-		| (PortCfg['x8x4x4'] << 3)
-		))
-
-print("Data:")
-print(codecs.encode(rs.serialize(), "hex_codec"))
-
-filename = "plx8732"
-if (correct_station_2_lane_reversal): filename += "_stn2rev"
-if (PortCfg_x4x4x4x4): filename += "_x4x4x4x4"
-if (PortCfg_x8x8): filename += "_x8x8"
-if (disable_port_1): filename += "_port1dis"
-if (disable_port_4): filename += "_port4dis"
-if (NT_port_1): filename += "_port1NT"
-if (NT_port_4): filename += "_port4NT"
-if (upstream_port_1): filename += "_port1Upst"
-
-filename += ".bin"
-with open(filename, mode="wb") as f:
-	print("to File {}".format(filename))
-	f.write(rs.serialize())
 
+# Build options and their default values
+DEFAULT_OPTIONS = {
+	'correct_station_2_lane_reversal': True,
+	'disable_port_1': False,
+	'disable_port_4': False,
+	'upstream_port_1': True,
+	'NT_port_1': False,
+	'NT_port_4': False,
+	'PortCfg_x4x4x4x4': False,
+	'PortCfg_x8x8': True,
+	}
 
+# Image filename suffix of each option when enabled, in filename order
+OPTION_SUFFIXES = [
+	('correct_station_2_lane_reversal', '_stn2rev'),
+	('PortCfg_x4x4x4x4', '_x4x4x4x4'),
+	('PortCfg_x8x8', '_x8x8'),
+	('disable_port_1', '_port1dis'),
+	('disable_port_4', '_port4dis'),
+	('NT_port_1', '_port1NT'),
+	('NT_port_4', '_port4NT'),
+	('upstream_port_1', '_port1Upst'),
+	]
+
+
+def build_options(**options):
+	"""Return DEFAULT_OPTIONS updated with the given options"""
+	opts = dict(DEFAULT_OPTIONS)
+	for name in options:
+		if name not in opts:
+			raise ValueError("unknown option {}".format(name))
+	opts.update(options)
+	return opts
+
+
+def build_regstream(**options):
+	"""Build the PLX_RegStream for the given options, see DEFAULT_OPTIONS"""
+	opts = build_options(**options)
+	rs = PLX_RegStream()
+
+	# Enable x4x4x8 Port Config + defaults for port 4
+	if (opts['correct_station_2_lane_reversal']):
+		rs.append(PLX_RegEntry(PLX_port[4], 0x220, # Port 4 to select station 1 (ports 4-7)
+				(1 << 8) 
+				| (1 << 12)
+				| (1 << 13)
+				| (1 << 14)
+				| (1 << 30))) # enable x4x4x8 Port Config
+
+	# Disable Port 1
+	# Used on VPX1142 carrier in NG chassis to 
+	# disable port designated for NT bridge
+	# between processor domains
+	if (opts['disable_port_1']):
+		rs.append(PLX_RegEntry(PLX_port[0], 0x208,
+			(1 << 1) # Port 1 Disable
+			)) 
+		rs.append(PLX_RegEntry(PLX_port[0], 0x30c, # Port 0
+			0x010000ff # Default POR value
+			& ~(1 << 1) # Port 1 Disable clock
+			)) 
+
+	# Disable Port 4
+	# Used on VPX7664 CPU B in NG Chassis
+	# disable port designated for NT bridge
+	# between processor domains
+	if (opts['disable_port_4']):
+		rs.append(PLX_RegEntry(PLX_port[4], 0x208, # Port 4 to select station 1 (ports 4-7)
+			(1 << 0) # Port 0 Disable RX termination
+			)) 
+		rs.append(PLX_RegEntry(PLX_port[0], 0x30c, # Port 0
+			0x010000ff # 
+			& ~(1 << 4) # Port 4 Disable clock
+			)) 
+
+	if (opts['upstream_port_1']):
+		rs.append(PLX_RegEntry(PLX_port[0], 0x360,
+			(0x1 << 0) # Upstream Port
+			| (0x1a << 8) # NT0 port (0x1a = disabled)
+			& ~(1 << 13) # NT0 1 = Enable
+			| (0x1a << 16) # NT1 port (0x1a = disabled)
+			& ~(1 << 21) # NT1 1 = Enable
+			))
+
+	if (opts['NT_port_1']):
+		rs.append(PLX_RegEntry(PLX_port[0], 0x360,
+			(0x0 << 0) # Upstream Port
+			| (0x1 << 8) # NT0 port (0x1a = disabled)
+			| (1 << 13) # NT0 1 = Enable
+			| (0x1a << 16) # NT1 port (0x1a = disabled)
+			& ~(1 << 21) # NT1 1 = Enable
+			))
+
+	if (opts['NT_port_4']):
+		rs.append(PLX_RegEntry(PLX_port[0], 0x360,
+			((0 << 0) & 0xf) # Upstream Port
+			| (0x4 << 8) # NT0 port (0x1a = disabled)
+			| (1 << 13) # NT0 1 = Enable
+			| (0x1a << 16) # NT1 port (0x1a = disabled)
+			& ~(1 << 21) # NT1 1 = Enable
+			))
+
+	# If an NT port is configured, setup the Link and Virtual interfaces
+	if False and (opts['NT_port_1'] or opts['NT_port_4']):
+		rs.append(PLX_RegEntry(PLX_port['NT0 Link'], 0x04, # NT Link Interface BAR0/1 Setup
+			(1 << 1) # Memory Access Enable
+			| (1 << 10) # Disable INTx from NT Link Interface
+			))
+		rs.append(PLX_RegEntry(PLX_port['NT0 Virtual'], 0x04, # NT Virtual Interface BAR0/1 Setup
+			(1 << 1) # Memory Access Enable
+			| (1 << 10) # Disable INTx from NT Virtual Interface
+			))
+
+	if (opts['PortCfg_x4x4x4x4']):
+		rs.append(PLX_RegEntry(PLX_port[0], 0x300,
+			(PortCfg['x4x4x4x4'] << 0)
+			| (PortCfg['x8x4x4'] << 3)
+			))
+
+	if (opts['PortCfg_x8x8']):
+		rs.append(PLX_RegEntry(PLX_port[0], 0x300,
+			(PortCfg['x8x8'] << 0)
+			| (PortCfg['x8x4x4'] << 3)
+			))
+
+	return rs
+
+
+def image_filename(**options):
+	"""Return the image filename for the given options"""
+	opts = build_options(**options)
+	filename = "plx8732"
+	for (name, suffix) in OPTION_SUFFIXES:
+		if (opts[name]): filename += suffix
+	return filename + ".bin"
+
+
+def PLX_PortNumber(port):
+	"""Return the PLX_port encoding of a config file port: a PLX_port key
+	such as 4 or 'NT0 Link', or a number string like '4'"""
+	if port not in PLX_port and not isinstance(port, int):
+		port = int(port, 0)
+	return PLX_port[port]
+
+
+def PLX_Value(value):
+	"""Return a config file number, given as an int or a string like '0x1f'"""
+	if isinstance(value, int):
+		return value
+	return int(value, 0)
+
+
+def compile_config(config):
+	"""Compile a board config into (filename, EEPROM image, bytes saved
+	by the optimizer).
+
+	config is a dict, usually loaded from a JSON board file:
+	  "name"      image filename without .bin (default: image_filename())
+	  "options"   dict of build options, see DEFAULT_OPTIONS
+	  "registers" list of extra {"port", "addr", "value"} entries,
+	              appended after those of the options
+	  "crc"       generate and enable the CRC (default: true)
+	  "optimize"  fold repeated writes, see PLX_RegStream.optimize
+	              (default: true)
+	"""
+	options = config.get("options", {})
+	rs = build_regstream(**options)
+	for reg in config.get("registers", []):
+		rs.append(PLX_RegEntry(PLX_PortNumber(reg["port"]),
+			PLX_Value(reg["addr"]), PLX_Value(reg["value"])))
+	if config.get("optimize", True):
+		rs = rs.optimize()
+
+	if "name" in config:
+		filename = config["name"] + ".bin"
+	else:
+		filename = image_filename(**options)
+	return (filename, rs.serialize(crc=config.get("crc", True)), rs.saved)
+
+
+def compile_config_file(path):
+	"""Compile the JSON board config file at path, see compile_config"""
+	with open(path) as f:
+		config = json.load(f)
+	return compile_config(config)
+
+
+def variant_matrix(vary=None, **fixed):
+	"""Return the options of every combination of the boolean options
+	named in vary (default: every option not given in fixed); the
+	other options are taken from fixed or DEFAULT_OPTIONS"""
+	if vary is None:
+		vary = sorted(name for name in DEFAULT_OPTIONS if name not in fixed)
+	variants = []
+	for bits in range(1 << len(vary)):
+		opts = dict(fixed)
+		for (i, name) in enumerate(vary):
+			opts[name] = bool((bits >> i) & 1)
+		variants.append(build_options(**opts))
+	return variants
+
+
+def stream_key(rs, crc):
+	"""Return the content address of the image of register stream rs"""
+	h = hashlib.sha256()
+	h.update(crc and b'crc' or b'nocrc')
+	for e in rs:
+		h.update(e)
+	return h.hexdigest()
+
+
+def build_variant(args):
+	"""Build the image of one variant into the cache unless an identical
+	register stream is already there.  args is (options, cache_dir, crc);
+	returns (image filename, stream key, image sha256, bytes saved by
+	the optimizer)"""
+	(options, cache_dir, crc) = args
+	rs = build_regstream(**options).optimize()
+	key = stream_key(rs, crc)
+	path = os.path.join(cache_dir, key + ".bin")
+	if os.path.exists(path):
+		with open(path, mode="rb") as f:
+			image = f.read()
+	else:
+		image = bytes(rs.serialize(crc=crc))
+		tmp = "{}.{}.tmp".format(path, os.getpid())
+		with open(tmp, mode="wb") as f:
+			f.write(image)
+		try:
+			os.rename(tmp, path)
+		except OSError:
+			# another worker cached the same stream first
+			os.remove(tmp)
+	return (image_filename(**options), key, hashlib.sha256(image).hexdigest(),
+		rs.saved)
+
+
+def build_matrix(variants, outdir, cache_dir=None, crc=True, processes=None):
+	"""Build the image of every variant in a process pool and write it to
+	outdir, along with manifest.json mapping each image filename to its
+	sha256, register stream key, options and bytes saved by the
+	optimizer.  Images are built once per
+	distinct register stream and kept in cache_dir (default:
+	outdir/cache) for later runs.  Returns the manifest dict."""
+	if cache_dir is None:
+		cache_dir = os.path.join(outdir, "cache")
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		results = pool.map(build_variant,
+			[(variant, cache_dir, crc) for variant in variants])
+	finally:
+		pool.close()
+		pool.join()
+
+	manifest = {}
+	for (variant, (filename, key, digest, saved)) in zip(variants, results):
+		shutil.copyfile(os.path.join(cache_dir, key + ".bin"),
+			os.path.join(outdir, filename))
+		manifest[filename] = {"sha256": digest, "stream": key,
+			"options": variant, "saved": saved}
+
+	with open(os.path.join(outdir, "manifest.json"), mode="w") as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	return manifest
+
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == "--matrix":
+		# eeprom_gen.py --matrix [outdir]
+		outdir = len(sys.argv) > 2 and sys.argv[2] or "images"
+		manifest = build_matrix(variant_matrix(), outdir)
+		streams = set(entry["stream"] for entry in manifest.values())
+		saved = sum(entry["saved"] for entry in manifest.values())
+		print("{} variants, {} distinct images in {}, {} bytes saved".format(
+			len(manifest), len(streams), outdir, saved))
+		return
+
+	if len(sys.argv) > 1:
+		# eeprom_gen.py board.json ...
+		for path in sys.argv[1:]:
+			(filename, image, saved) = compile_config_file(path)
+			with open(filename, mode="wb") as f:
+				print("{} to File {}, {} bytes saved".format(path, filename,
+					saved))
+				f.write(image)
+		return
+
+	rs = build_regstream()
+	optimized = rs.optimize()
+	print("Optimized {} entries to {}, {} bytes saved".format(len(rs),
+		len(optimized), optimized.saved))
+	rs = optimized
+
+	# the CRC lets the switch reject a corrupted EEPROM at load time
+	image = rs.serialize(crc=True)
+	print("Data:")
+	print(codecs.encode(image, "hex_codec"))
+
+	filename = image_filename()
+	with open(filename, mode="wb") as f:
+		print("to File {}".format(filename))
+		f.write(image)
+
+
+if __name__ == "__main__":
+	main()
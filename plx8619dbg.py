@@ -11,6 +11,8 @@
 # IMPORTS
 #==========================================================================
 import sys
+import time
+import threading
 
 from aardvark_py import *
 
@@ -40,64 +42,379 @@ PLX_PORTSEL_DMA_DESCRIPTORS = 0x13
 num_lanes = 16
 num_ports = 16
 
+# Clock for measuring poll intervals: monotonic where python has one, as
+# the wall clock can step backwards
+plx_clock = getattr(time, 'monotonic', time.time)
+
+# Register volatility classes used by PLX_RegCache
+PLX_REG_STATIC = 'static'      # changes only on reset or an explicit write
+PLX_REG_SLOW = 'slow'          # link state, changes on link events
+PLX_REG_VOLATILE = 'volatile'  # counters, always read from the switch
+
+# Default cache lifetime in seconds of each class (None = until invalidated)
+PLX_REG_TTLS = {
+    PLX_REG_STATIC: None,
+    PLX_REG_SLOW: 1.0,
+    PLX_REG_VOLATILE: 0,
+    }
+
+# Volatility of known registers by address.  Registers not listed here
+# are treated as volatile.
+PLX_REG_VOLATILITY = {
+    0x574: PLX_REG_STATIC,    # portcfg
+    0x1dc: PLX_REG_STATIC,    # debug control
+    0x668: PLX_REG_STATIC,    # ports enabled
+    0x098: PLX_REG_SLOW,      # link status and control 2
+    0x200: PLX_REG_SLOW,      # receiver detected, lanes 0-7
+    0x204: PLX_REG_SLOW,      # receiver detected, lanes 8-15
+    0x1f4: PLX_REG_SLOW,      # lanes up
+    0x66c: PLX_REG_SLOW,      # link widths and speeds, ports 0-7
+    0x670: PLX_REG_SLOW,      # link widths and speeds, ports 8-15
+    0x078: PLX_REG_SLOW,      # link status
+    0x160: PLX_REG_SLOW,      # vc0 status
+    0xb88: PLX_REG_VOLATILE,  # receive error counts
+    0xb8c: PLX_REG_VOLATILE,
+    0xb90: PLX_REG_VOLATILE,
+    0xb94: PLX_REG_VOLATILE,
+    0x1e8: PLX_REG_VOLATILE,  # bad TLP count
+    0x1ec: PLX_REG_VOLATILE,  # bad DLLP count
+    }
+
 #==========================================================================
 # FUNCTIONS
 #==========================================================================
 
-def plx_validate_read(count, data_in):
-    ''' detect errors after an aardvark read and prin errors accordingly'''
-    if (count < 0):
-        print "error: %s" % aa_status_string(count)
+def plx_i2c_status_string(status):
+    ''' return a readable name for an AardvarkI2cStatus value '''
+    names = {
+        AA_I2C_STATUS_OK: "ok",
+        AA_I2C_STATUS_BUS_ERROR: "bus error",
+        AA_I2C_STATUS_SLA_ACK: "slave address acked",
+        AA_I2C_STATUS_SLA_NACK: "slave address nacked",
+        AA_I2C_STATUS_DATA_NACK: "data nacked",
+        AA_I2C_STATUS_ARB_LOST: "arbitration lost",
+        AA_I2C_STATUS_BUS_LOCKED: "bus locked",
+        AA_I2C_STATUS_LAST_DATA_ACK: "last data byte acked",
+        }
+    return names.get(status, "unknown status %d" % status)
+
+def plx_validate_write_read(status, num_written, num_read):
+    ''' detect errors after an aardvark write+read and print errors for
+    whichever phase (command write or data read) failed.
+    <status> is (read_status << 8) | write_status, or a negative
+    aardvark status code if the transaction could not be issued. '''
+    if (status < 0):
+        print("error: %s" % aa_status_string(status))
         return -1
-    elif (count == 0):
-        print "error: no bytes read"
-        print "  are you sure you have the right slave address?"
-        return -2 
-    elif (count != 4):
-        print "error: read %d bytes (expected %d)" % (count, length)
+
+    write_status = status & 0xff
+    read_status = (status >> 8) & 0xff
+
+    if (write_status != AA_I2C_STATUS_OK):
+        print("error: command write failed: %s" % plx_i2c_status_string(write_status))
+        if (write_status == AA_I2C_STATUS_SLA_NACK):
+            print("  are you sure you have the right slave address?")
+        return -4
+    elif (num_written != 4):
+        print("error: wrote %d command bytes (expected 4)" % num_written)
+        return -4
+    elif (read_status != AA_I2C_STATUS_OK):
+        print("error: data read failed: %s" % plx_i2c_status_string(read_status))
+        return -5
+    elif (num_read == 0):
+        print("error: no bytes read")
+        print("  are you sure you have the right slave address?")
+        return -2
+    elif (num_read != 4):
+        print("error: read %d bytes (expected 4)" % num_read)
         return -3
-    
+
     return 0
 
 
-def plx_read4 (handle, device, port, addr):
-    ''' Read the 4 bytes that comrise a register value '''
-    cmd = PLX_CMD_READ
-
-    command = array('B', [
-        cmd,
-        (port >> 1) & 0xf,
-	((port & 0x01) << 7) | ((addr >> 10) & 0x3),
-	(addr >> 2) & 0xff
-	])
-	
-    #print("writing {0:s}]n".format(str(command)))
+def plx_fill_command (buf, cmd, port, addr, byte_enables=0):
+    ''' put the 4 byte PLX I2C command frame for <cmd> at <port>:<addr>
+    in the first 4 bytes of <buf> '''
+    buf[0] = cmd
+    buf[1] = (port >> 1) & 0xf
+    buf[2] = ((port & 0x01) << 7) | ((byte_enables & 0xf) << 2) | ((addr >> 10) & 0x3)
+    buf[3] = (addr >> 2) & 0xff
+
+def plx_command (cmd, port, addr, byte_enables=0):
+    ''' build the 4 byte PLX I2C command frame for <cmd> at <port>:<addr> '''
+    command = array('B', [0, 0, 0, 0])
+    plx_fill_command(command, cmd, port, addr, byte_enables)
+    return command
+
+def plx_decode_command (frame):
+    ''' decode a PLX I2C command frame, the inverse of plx_command.
+    Returns (cmd, port, addr, byte_enables). '''
+    return (frame[0] & 0x7,
+        ((frame[1] & 0xf) << 1) | (frame[2] >> 7),
+        ((frame[2] & 0x3) << 10) | (frame[3] << 2),
+        (frame[2] >> 2) & 0xf)
 
-    # Write the register address
-    aa_i2c_write(handle, device, AA_I2C_NO_STOP, command)
+# Per-thread command and data buffers reused by every plx_read4
+plx_read4_buffers = threading.local()
 
-    (count, data_in) = aa_i2c_read(handle, device, AA_I2C_NO_FLAGS, 4)
+def plx_read4 (handle, device, port, addr):
+    ''' Read the 4 bytes that comrise a register value.
+    The command frame and the data phase are issued as one atomic
+    write+read (repeated start), so each register costs a single round
+    trip to the adapter.
+    Returns (status, num_written, data_in, num_read) as given by
+    aa_i2c_write_read.  data_in is a per-thread buffer that the next
+    plx_read4 on the same thread overwrites. '''
+    buffers = plx_read4_buffers
+    try:
+        command = buffers.command
+        data_in = buffers.data_in
+    except AttributeError:
+        command = buffers.command = array_u08(4)
+        data_in = buffers.data_in = array_u08(4)
+
+    plx_fill_command(command, PLX_CMD_READ, port, addr)
+
+    #print("writing {0:s}]n".format(str(command)))
 
-    #print("read {0}: {1}".format(count, data_in))
-    return (count, data_in)
+    (status, num_written, num_read) = aa_i2c_write_read_into(handle, device,
+        AA_I2C_NO_FLAGS, command, 4, data_in, 4)
+
+    #print("read {0}: {1}".format(num_read, data_in))
+    return (status, num_written, data_in, num_read)
+
+class PLX_RegCache(object):
+    ''' Cache of register values read by plx_read_qword.
+    Each register is cached according to its volatility class from
+    PLX_REG_VOLATILITY for the lifetime given in <ttls> (defaults to
+    PLX_REG_TTLS).  Volatile registers are never cached.
+    Entries are dropped by plx_write_qword when their register is written,
+    and slow-changing entries can be dropped on a link event with
+    link_event().
+    Entries may be stored and dropped from another thread, such as a
+    PLX_RegSniffer's, so each is dropped with pop() rather than del. '''
+    def __init__(self, ttls=None, clock=time.time):
+        self.ttls = dict(PLX_REG_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.clock = clock
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, handle, device, port, addr):
+        ''' return the cached value of <port>:<addr>, or None '''
+        key = (handle, device, port, addr)
+        entry = self.entries.get(key)
+        if entry is not None:
+            (val, expires) = entry
+            if expires is None or self.clock() < expires:
+                self.hits += 1
+                return val
+            self.entries.pop(key, None)
+        self.misses += 1
+        return None
+
+    def store(self, handle, device, port, addr, val):
+        ''' cache <val> as the value of <port>:<addr> if its class allows '''
+        ttl = self.ttls[PLX_REG_VOLATILITY.get(addr, PLX_REG_VOLATILE)]
+        if ttl == 0:
+            return
+        expires = None
+        if ttl is not None:
+            expires = self.clock() + ttl
+        self.entries[(handle, device, port, addr)] = (val, expires)
+
+    def invalidate(self, handle, device, port=None, addr=None, volatility=None):
+        ''' drop the cached values of <device>, optionally only those of
+        <port>, <addr> or registers of class <volatility> '''
+        for key in list(self.entries):
+            (h, d, p, a) = key
+            if h != handle or d != device:
+                continue
+            if port is not None and p != port:
+                continue
+            if addr is not None and a != addr:
+                continue
+            if volatility is not None and \
+                    PLX_REG_VOLATILITY.get(a, PLX_REG_VOLATILE) != volatility:
+                continue
+            self.entries.pop(key, None)
+
+    def link_event(self, handle, device, port=None):
+        ''' drop the slow-changing (link state) values of <device>, or only
+        those of <port>, after a link up/down or retrain '''
+        self.invalidate(handle, device, port, volatility=PLX_REG_SLOW)
+
+    def clear(self):
+        ''' drop every cached value, e.g. after a switch reset '''
+        self.entries.clear()
+
+# Set to a PLX_RegCache to cache register reads in plx_read_qword
+plx_reg_cache = None
 
 def plx_read_qword (handle, device, port, addr):
     ''' read a qword register and addemble it in to an int value '''
-    (count, data_in) = plx_read4(handle, device, port, addr)
+    cache = plx_reg_cache
+    if cache is not None:
+        val = cache.lookup(handle, device, port, addr)
+        if val is not None:
+            return val
 
-    errval = plx_validate_read(count, data_in)
+    (status, num_written, data_in, num_read) = plx_read4(handle, device, port, addr)
+
+    errval = plx_validate_write_read(status, num_written, num_read)
     if(errval < 0):
         return errval
 
     qword = data_in[3] + (data_in[2] << 8) + (data_in[1] << 16) + (data_in[0] << 24) 
 
+    if cache is not None:
+        cache.store(handle, device, port, addr, qword)
+
     return qword
 
+def plx_write_qword (handle, device, port, addr, val):
+    ''' write the int <val> to a qword register.
+    Returns 0, or a negative value if the write failed. '''
+    command = plx_command(PLX_CMD_WRITE, port, addr, 0xf)
+    command.extend([
+        (val >> 24) & 0xff,
+        (val >> 16) & 0xff,
+        (val >> 8) & 0xff,
+        val & 0xff
+        ])
+
+    count = aa_i2c_write(handle, device, AA_I2C_NO_FLAGS, command)
+
+    # The register may not read back as written, so drop it rather
+    # than caching <val>
+    if plx_reg_cache is not None:
+        plx_reg_cache.invalidate(handle, device, port, addr)
+
+    if (count < 0):
+        print("error: %s" % aa_status_string(count))
+        return -1
+    elif (count != len(command)):
+        print("error: wrote %d bytes (expected %d)" % (count, len(command)))
+        return -3
+
+    return 0
+
+def plx_read_regs (handle, device, regs):
+    ''' read a list of (port, addr) registers and return a list of their values '''
+    return [plx_read_qword(handle, device, port, addr) for (port, addr) in regs]
+
+
+class PLX_RegValues(object):
+    ''' Raw register values returned by PLX_ReadPlan.read.
+    <regs> is the list of (port, addr) registers in the order they were
+    read and <values> is an array('L') of their values. '''
+    def __init__(self, regs, values):
+        self.regs = regs
+        self.values = values
+        self.index = dict((reg, i) for (i, reg) in enumerate(regs))
+
+    def value(self, port, addr):
+        ''' return the raw value of <port>:<addr> '''
+        return int(self.values[self.index[(port, addr)]])
+
+    def values_of(self, regs):
+        ''' return a list of the raw values of <regs>, in order, for the
+        plx_decode_* functions '''
+        return [int(self.values[self.index[reg]]) for reg in regs]
+
+
+class PLX_ReadPlan(object):
+    ''' A set of (port, addr) registers to be read from the switch as one
+    batch.  Callers add the registers their decoders need; duplicates are
+    dropped and the reads are issued in (port, addr) order in a single
+    loop by read(). '''
+    def __init__(self, regs=None):
+        self.regs = set()
+        if regs:
+            self.extend(regs)
+
+    def add(self, port, addr):
+        ''' add register <port>:<addr> to the plan '''
+        self.regs.add((port, addr))
+
+    def extend(self, regs):
+        ''' add a list of (port, addr) registers to the plan '''
+        self.regs.update(regs)
+
+    def schedule(self):
+        ''' return the list of (port, addr) registers in the order they
+        will be read '''
+        return sorted(self.regs)
+
+    def read(self, handle, device):
+        ''' read every register in the plan.
+        Returns (errval, PLX_RegValues); errval is the negative value
+        returned by plx_read_qword for the first failed read, in which
+        case no values are returned. '''
+        regs = self.schedule()
+        values = array('L', [0]) * len(regs)
+        read_qword = plx_read_qword
+        for i in range(len(regs)):
+            (port, addr) = regs[i]
+            val = read_qword(handle, device, port, addr)
+            if val < 0:
+                return (val, None)
+            values[i] = val
+        return (0, PLX_RegValues(regs, values))
+
+
+def plx_decode_fields(fields, val):
+    ''' decode the register value <val> into a dict of subvalues.
+    <fields> is a list of (name, shift, width, enum) tuples; enum is None
+    or a dict mapping raw subvalues to decoded ones. '''
+    decoded = {}
+    for (name, shift, width, enum) in fields:
+        raw = (val >> shift) & ((1 << width) - 1)
+        if enum is not None:
+            raw = enum.get(raw, raw)
+        decoded[name] = raw
+    return decoded
+
+def plx_decode_fields_array(fields, values):
+    ''' decode a whole sequence of raw values of one register in a single
+    vectorized pass per field.  Returns a dict mapping each field name to
+    a NumPy array of subvalues.  Enumerated fields are float arrays, with
+    NaN for raw subvalues missing from the enum.
+    Without NumPy, the dict holds lists built by plx_decode_fields. '''
+    # imported here so the tools that never decode arrays start fast
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is None:
+        decoded = [plx_decode_fields(fields, val) for val in values]
+        return dict((name, [d[name] for d in decoded])
+            for (name, shift, width, enum) in fields)
+
+    vals = numpy.asarray(values, dtype=numpy.uint32)
+    decoded = {}
+    for (name, shift, width, enum) in fields:
+        raw = (vals >> shift) & ((1 << width) - 1)
+        if enum is not None:
+            table = numpy.full(1 << width, numpy.nan)
+            for (k, v) in enum.items():
+                table[k] = v
+            raw = table[raw]
+        decoded[name] = raw
+    return decoded
+
+
+PLX_PORTCFG_REGS = [(0, 0x574)]
+
+def plx_decode_portconfig(vals):
+    ''' decode the portcfg value from the values of PLX_PORTCFG_REGS '''
+    return vals[0] & 0xf
+
 def plx_get_portconfig(handle, device):
     ''' read the portcfg register '''
-    val = plx_read_qword(handle, device, 0, 0x574)
-    portcfg = val & 0xf
-    return portcfg
+    return plx_decode_portconfig(plx_read_regs(handle, device, PLX_PORTCFG_REGS))
 
 def plx_8619_get_portmap(portcfg):
     ''' decode the port lane allocations from the pex8619 portcfg value '''
@@ -148,12 +465,12 @@ def plx_8619_get_portmap(portcfg):
 
     return portmap
 
-def plx_get_recv_errcounts(handle, device):
-    ''' return a list of the receive error counts per lane '''
-    even_0246_counts = plx_read_qword(handle, device, 0, 0xb88)
-    odd_1357_counts = plx_read_qword(handle, device, 0, 0xb8c)
-    even_8ace_counts = plx_read_qword(handle, device, 0, 0xb90)
-    odd_9bdf_counts = plx_read_qword(handle, device, 0, 0xb94)
+PLX_RECV_ERRCOUNT_REGS = [(0, 0xb88), (0, 0xb8c), (0, 0xb90), (0, 0xb94)]
+
+def plx_decode_recv_errcounts(vals):
+    ''' decode the per-lane receive error counts from the values of
+    PLX_RECV_ERRCOUNT_REGS '''
+    (even_0246_counts, odd_1357_counts, even_8ace_counts, odd_9bdf_counts) = vals
 
     recv_errcounts = num_lanes * [0]
     recv_errcounts[0] = (even_0246_counts >> 0) & 0xff
@@ -175,19 +492,31 @@ def plx_get_recv_errcounts(handle, device):
 
     return recv_errcounts
 
-def plx_get_ports_enabled(handle, device):
-    ''' return a list of port enabled (1) or disabled (0) statuses '''
-    val = plx_read_qword(handle, device, 0, 0x668)
+def plx_get_recv_errcounts(handle, device):
+    ''' return a list of the receive error counts per lane '''
+    return plx_decode_recv_errcounts(plx_read_regs(handle, device, PLX_RECV_ERRCOUNT_REGS))
+
+PLX_PORTS_ENABLED_REGS = [(0, 0x668)]
+
+def plx_decode_ports_enabled(vals):
+    ''' decode the port enabled statuses from the values of PLX_PORTS_ENABLED_REGS '''
+    val = vals[0]
     en = num_ports * [0]
     for i in range(num_ports):
         if val & 1 << i:
             en[i] = 1
     return en
 
-def plx_get_receiver_detected(handle, device):
-    ''' return a list whether a receiver was detected on each lane '''
-    rd_low = plx_read_qword(handle, device, 0, 0x200)
-    rd_high = plx_read_qword(handle, device, 0, 0x204)
+def plx_get_ports_enabled(handle, device):
+    ''' return a list of port enabled (1) or disabled (0) statuses '''
+    return plx_decode_ports_enabled(plx_read_regs(handle, device, PLX_PORTS_ENABLED_REGS))
+
+PLX_RECEIVER_DETECTED_REGS = [(0, 0x200), (0, 0x204)]
+
+def plx_decode_receiver_detected(vals):
+    ''' decode the per-lane receiver detected statuses from the values of
+    PLX_RECEIVER_DETECTED_REGS '''
+    (rd_low, rd_high) = vals
 
     rd = num_lanes * [0]
     for i in range(8):
@@ -198,19 +527,31 @@ def plx_get_receiver_detected(handle, device):
 
     return rd
 
-def plx_get_lanes_up(handle, device):
-    ''' return a list of software lane-up status '''
-    val = plx_read_qword(handle, device, 0, 0x1f4)
+def plx_get_receiver_detected(handle, device):
+    ''' return a list whether a receiver was detected on each lane '''
+    return plx_decode_receiver_detected(plx_read_regs(handle, device, PLX_RECEIVER_DETECTED_REGS))
+
+PLX_LANES_UP_REGS = [(0, 0x1f4)]
+
+def plx_decode_lanes_up(vals):
+    ''' decode the software lane-up statuses from the values of PLX_LANES_UP_REGS '''
+    val = vals[0]
     lanes_up = num_lanes * [0]
     for i in range(num_lanes):
         lanes_up[i] = (val >> i) & 0x1
 
     return lanes_up
 
-def plx_get_linkandspeed(handle, device):
-    ''' returns a tuple (widths, speeds) of port widths and speeds '''
-    widths_low = plx_read_qword(handle, device, 0, 0x66c)
-    widths_high = plx_read_qword(handle, device, 0, 0x670)
+def plx_get_lanes_up(handle, device):
+    ''' return a list of software lane-up status '''
+    return plx_decode_lanes_up(plx_read_regs(handle, device, PLX_LANES_UP_REGS))
+
+PLX_LINKANDSPEED_REGS = [(0, 0x66c), (0, 0x670)]
+
+def plx_decode_linkandspeed(vals):
+    ''' decode a tuple (widths, speeds) of port widths and speeds from the
+    values of PLX_LINKANDSPEED_REGS '''
+    (widths_low, widths_high) = vals
     widths = num_ports * [0]
     speeds = num_ports * [0]
 
@@ -231,82 +572,127 @@ def plx_get_linkandspeed(handle, device):
         speeds[8 + i] = s_map[s]
     return (widths, speeds)
 
-def plx_get_debug_control(handle, device):
-    ''' return a dict of decoded Debug Control register subvalues '''
-    val = plx_read_qword(handle, device, 0, 0x1dc)
-    debug_control = {}
+def plx_get_linkandspeed(handle, device):
+    ''' returns a tuple (widths, speeds) of port widths and speeds '''
+    return plx_decode_linkandspeed(plx_read_regs(handle, device, PLX_LINKANDSPEED_REGS))
+
+PLX_DEBUG_CONTROL_REGS = [(0, 0x1dc)]
+
+# See PEX8619 Databook Register 14-64 (1DCh)
+PLX_DEBUG_CONTROL_FIELDS = [
+    ("UPCFG Timer Enable", 4, 1, None),
+    ("SMBus Enable", 5, 1, None),
+    ("NT P2P Enable", 6, 1, None),
+    ("Upstream Port ID", 8, 4, None),
+    ("Interrupt Fencing Mode", 12, 2, None),
+    ("Hardware/Software Configuration Mode Control", 15, 1, None),
+    ("Upstream Hot Reset Control", 16, 1, None),
+    ("Disable Serial EEPROM Load on Hot Reset", 17, 1, None),
+    ("NT Mode Enable", 18, 1, None),
+    ("NT Port DL_Down Porpagation Disable", 19, 1, None),
+    ("Upstream Port DL_Down Porpagation Disable", 20, 1, None),
+    ("Cut-Thru Enable", 21, 1, None),
+    ("NT Port Number", 24, 4, None),
+    ("Virtual Interface Access Enable", 28, 1, None),
+    ("Link Interface Access Enable", 29, 1, None),
+    ("Inhibit EEPROM NT-Link Load on Hot Reset", 30, 1, None),
+    ("Load Only EEPROM NT-Link on Hot Reset", 31, 1, None),
+    ]
+
+def plx_decode_debug_control(vals):
+    ''' decode a dict of Debug Control register subvalues from the values
+    of PLX_DEBUG_CONTROL_REGS '''
+    debug_control = plx_decode_fields(PLX_DEBUG_CONTROL_FIELDS, vals[0])
     debug_control["**note**"] = "See PEX8619 Databook Register 14-64 (1DCh)"
-    debug_control["UPCFG Timer Enable"] = (val >> 4) & 0x1
-    debug_control["SMBus Enable"] = (val >> 5) & 0x1
-    debug_control["NT P2P Enable"] = (val >> 6) & 0x1
-    debug_control["Upstream Port ID"] = (val >> 8) & 0xf
-    debug_control["Interrupt Fencing Mode"] = (val >> 12) & 0x3
-    debug_control["Hardware/Software Configuration Mode Control"] = (val >> 15) & 0x1
-    debug_control["Upstream Hot Reset Control"] = (val >> 16) & 0x1
-    debug_control["Disable Serial EEPROM Load on Hot Reset"] = (val >> 17) & 0x1
-    debug_control["NT Mode Enable"] = (val >> 18) & 0x1
-    debug_control["NT Port DL_Down Porpagation Disable"] = (val >> 19) & 0x01
-    debug_control["Upstream Port DL_Down Porpagation Disable"] = (val >> 20) & 0x01
-    debug_control["Cut-Thru Enable"] = (val >> 21) & 0x1
-    debug_control["NT Port Number"] = (val >> 24) & 0xf
-    debug_control["Virtual Interface Access Enable"] = (val >> 28) & 0x1
-    debug_control["Link Interface Access Enable"] = (val >> 29) & 0x1
-    debug_control["Inhibit EEPROM NT-Link Load on Hot Reset"] = (val >> 30) & 0x1
-    debug_control["Load Only EEPROM NT-Link on Hot Reset"] = (val >> 31) & 0x1
-
     return debug_control
 
-def plx_get_link_status(handle, device, port):
-    ''' return a dict of decoded Link Status register subvalues '''
-    val = plx_read_qword(handle, device, port, 0x78)
-    s_map=[0, 2.5, 5.0]
-    ls = {}
+def plx_get_debug_control(handle, device):
+    ''' return a dict of decoded Debug Control register subvalues '''
+    return plx_decode_debug_control(plx_read_regs(handle, device, PLX_DEBUG_CONTROL_REGS))
+
+PLX_REG_LINK_STATUS = 0x78
+
+# See PEX8619 Databook Register 14-29 (78h)
+PLX_LINK_STATUS_FIELDS = [
+    ("ASPM", 0, 2, None),
+    ("Link Disable", 4, 1, None),
+    ("Common Clock Configuration", 6, 1, None),
+    ("Extended Sync", 7, 1, None),
+    ("Clock Power Management Enable", 8, 1, None),
+    ("Link Bandwidth Management Interrupt Enable", 10, 1, None),
+    ("Link Autonomous Bandwidth Interrupt Enable", 11, 1, None),
+    ("Current Link Speed", 16, 4, {0: 0, 1: 2.5, 2: 5.0}),
+    ("Negotiated Link Width", 20, 6, None),
+    ("Link Training", 27, 1, None),
+    ("Slot Clock Configuration", 28, 1, None),
+    ("Data Link Layer Link Active", 29, 1, None),
+    ("Link Bandwidth Management Status", 30, 1, None),
+    ("Link Autonomous Bandwidth Status", 31, 1, None),
+    ]
+
+def plx_decode_link_status(port, val):
+    ''' decode a dict of Link Status register subvalues from <port>'s 0x78 value '''
+    ls = plx_decode_fields(PLX_LINK_STATUS_FIELDS, val)
     ls["Port"] = port
     ls["**note**"] = "See PEX8619 Databook Register 14-29 (78h)"
-    ls["ASPM"] = (val >> 0) & 0x3
-    ls["Link Disable"] = (val >> 4) & 0x1
-    ls["Common Clock Configuration"] = (val >> 6) & 0x1
-    ls["Extended Sync"] = (val >> 7) & 0x1
-    ls["Clock Power Management Enable"] = (val >> 8) & 0x1
-    ls["Link Bandwidth Management Interrupt Enable"] = (val >> 10) & 0x1
-    ls["Link Autonomous Bandwidth Interrupt Enable"] = (val >> 11) & 0x1
-    ls["Current Link Speed"] = s_map[(val >> 16) & 0xf]
-    ls["Negotiated Link Width"] = (val >> 20) & 0x3f
-    ls["Link Training"] = (val >> 27) & 0x1
-    ls["Slot Clock Configuration"] = (val >> 28) & 0x1
-    ls["Data Link Layer Link Active"] = (val >> 29) & 0x1
-    ls["Link Bandwidth Management Status"] = (val >> 30) & 0x1
-    ls["Link Autonomous Bandwidth Status"] = (val >> 31) & 0x1
     return ls
 
-def plx_get_link_status_and_control2(handle, device, port):
-    ''' returns a dict of decoded Link Status and Control 2 register subvalues '''
-    val = plx_read_qword(handle, device, port, 0x98)
-    s_map=[-1, 2.5, 5.0]
-    lsc2 = {}
+def plx_get_link_status(handle, device, port):
+    ''' return a dict of decoded Link Status register subvalues '''
+    val = plx_read_qword(handle, device, port, PLX_REG_LINK_STATUS)
+    return plx_decode_link_status(port, val)
+
+PLX_REG_LINK_STATUS_AND_CONTROL2 = 0x98
+
+# See PEX8619 Databook Register 14-34. (0x98h)
+PLX_LINK_STATUS_AND_CONTROL2_FIELDS = [
+    ("Target Link Speed", 0, 4, {0: -1, 1: 2.5, 2: 5.0}),
+    ("Enter Compliance", 4, 1, None),
+    ("Selectable De-Emphasis", 6, 1, None),
+    ("Transmit Margin", 7, 2, None),
+    ("Enter Modified Compliance", 10, 1, None),
+    ("Compliance SOS", 11, 1, None),
+    ("Compliance De-Emphasis", 12, 1, None),
+    ("Current De-Emphasis Level", 16, 1, None),
+    ]
+
+def plx_decode_link_status_and_control2(port, val):
+    ''' decode a dict of Link Status and Control 2 register subvalues from
+    <port>'s 0x98 value '''
+    lsc2 = plx_decode_fields(PLX_LINK_STATUS_AND_CONTROL2_FIELDS, val)
     lsc2["**note**"] = "See PEX8619 Databook Register 14-34. (0x98h)"
     lsc2["Port"] = port
-    lsc2["Target Link Speed"] = s_map[(val >> 0) & 0xf]
-    lsc2["Enter Compliance"] = (val >> 4) & 0x1
-    lsc2["Selectable De-Emphasis"] = (val >> 6) & 0x1
-    lsc2["Transmit Margin"] = (val >> 7) & 0x3
-    lsc2["Enter Modified Compliance"] = (val >> 10) & 0x1
-    lsc2["Compliance SOS"] = (val >> 11) & 0x1
-    lsc2["Compliance De-Emphasis"] = (val >> 12) & 0x1
-    lsc2["Current De-Emphasis Level"] = (val >> 16) & 0x1
     return lsc2
 
+# Field tables of the registers that have one, by address
+PLX_REG_FIELDS = {
+    0x1dc: PLX_DEBUG_CONTROL_FIELDS,
+    PLX_REG_LINK_STATUS: PLX_LINK_STATUS_FIELDS,
+    PLX_REG_LINK_STATUS_AND_CONTROL2: PLX_LINK_STATUS_AND_CONTROL2_FIELDS,
+    }
+
+def plx_get_link_status_and_control2(handle, device, port):
+    ''' returns a dict of decoded Link Status and Control 2 register subvalues '''
+    val = plx_read_qword(handle, device, port, PLX_REG_LINK_STATUS_AND_CONTROL2)
+    return plx_decode_link_status_and_control2(port, val)
+
+PLX_REG_VC0_STATUS = 0x160
+
+def plx_decode_vc0_negotiation_pending(val):
+    ''' decode whether vc0 negotiation is pending from a port's 0x160 value '''
+    return (val >> 17) & 0x1
+
 def plx_get_vc0_negotiation_pending(handle, device, port):
     ''' return whether vc0 negotiation is pending on <port>.
     Note that the i2c port appears to hang if a disabled port is read.
     '''
-    val = plx_read_qword(handle, device, port, 0x160)
-    return (val >> 17) & 0x1
+    val = plx_read_qword(handle, device, port, PLX_REG_VC0_STATUS)
+    return plx_decode_vc0_negotiation_pending(val)
 
 def dict_pprint(d, title):
     ''' pretty-print dict d with the given title '''
     print(title)
-    for k, v in d.iteritems():
+    for k, v in d.items():
         print("  {0}: {1}".format(str(k), str(v)))
 
 def plx_for_all_ports(handle, device, plx_func):
@@ -325,14 +711,17 @@ def plx_for_all_enabled_ports(handle, device, enabled, plx_func):
             params.append(plx_func(handle, device, i))
     return params
 
+PLX_REG_BAD_TLP_COUNT = 0x1e8
+PLX_REG_BAD_DLLP_COUNT = 0x1ec
+
 def plx_get_bad_tlp_count(handle, device, port):
     ''' returns <port>'s Bad TLP count '''
-    val = plx_read_qword(handle, device, port, 0x1e8)
+    val = plx_read_qword(handle, device, port, PLX_REG_BAD_TLP_COUNT)
     return val
 
 def plx_get_bad_dllp_count(handle, device, port):
     ''' returns <port>'s bad DLLP count '''
-    val = plx_read_qword(handle, device, port, 0x1ec)
+    val = plx_read_qword(handle, device, port, PLX_REG_BAD_DLLP_COUNT)
     return val
 
 def plx_get_bad_tlp_counts(handle, device):
@@ -355,87 +744,531 @@ def plx_get_vc0_negotiations_pending(handle, device, enabled):
     ''' reuturns a list of all enabled ports' VC0 negotiation pending statuses '''
     return plx_for_all_enabled_ports(handle, device, enabled, plx_get_vc0_negotiation_pending)
 
+def plx_snapshot_plan(enabled):
+    ''' return a PLX_ReadPlan covering every register needed for a full
+    switch snapshot.  Per-port registers are only planned for the ports
+    set in <enabled>, as returned by plx_get_ports_enabled, since reading
+    a disabled port can hang the i2c port. '''
+    plan = PLX_ReadPlan()
+    plan.extend(PLX_PORTCFG_REGS)
+    plan.extend(PLX_RECEIVER_DETECTED_REGS)
+    plan.extend(PLX_LANES_UP_REGS)
+    plan.extend(PLX_LINKANDSPEED_REGS)
+    plan.extend(PLX_RECV_ERRCOUNT_REGS)
+    plan.extend(PLX_DEBUG_CONTROL_REGS)
+    for port in range(num_ports):
+        if enabled[port]:
+            plan.add(port, PLX_REG_BAD_TLP_COUNT)
+            plan.add(port, PLX_REG_BAD_DLLP_COUNT)
+            plan.add(port, PLX_REG_LINK_STATUS)
+            plan.add(port, PLX_REG_LINK_STATUS_AND_CONTROL2)
+            plan.add(port, PLX_REG_VC0_STATUS)
+    return plan
+
+def plx_decode_snapshot(regvals, enabled):
+    ''' decode the PLX_RegValues read for plx_snapshot_plan(<enabled>) into
+    a dict holding the results of each plx_get_* function '''
+    enabled_ports = [port for port in range(num_ports) if enabled[port]]
+    snapshot = {}
+    snapshot["ports_enabled"] = enabled
+    snapshot["portcfg"] = plx_decode_portconfig(regvals.values_of(PLX_PORTCFG_REGS))
+    snapshot["portmap"] = plx_8619_get_portmap(snapshot["portcfg"])
+    snapshot["receivers_detected"] = plx_decode_receiver_detected(regvals.values_of(PLX_RECEIVER_DETECTED_REGS))
+    snapshot["lanes_up"] = plx_decode_lanes_up(regvals.values_of(PLX_LANES_UP_REGS))
+    snapshot["linkandspeed"] = plx_decode_linkandspeed(regvals.values_of(PLX_LINKANDSPEED_REGS))
+    snapshot["recv_errcounts"] = plx_decode_recv_errcounts(regvals.values_of(PLX_RECV_ERRCOUNT_REGS))
+    snapshot["debug_control"] = plx_decode_debug_control(regvals.values_of(PLX_DEBUG_CONTROL_REGS))
+    snapshot["bad_tlp_counts"] = [regvals.value(port, PLX_REG_BAD_TLP_COUNT)
+        for port in enabled_ports]
+    snapshot["bad_dllp_counts"] = [regvals.value(port, PLX_REG_BAD_DLLP_COUNT)
+        for port in enabled_ports]
+    snapshot["links_status"] = [plx_decode_link_status(port,
+        regvals.value(port, PLX_REG_LINK_STATUS)) for port in enabled_ports]
+    snapshot["link_status_and_control2s"] = [plx_decode_link_status_and_control2(port,
+        regvals.value(port, PLX_REG_LINK_STATUS_AND_CONTROL2)) for port in enabled_ports]
+    snapshot["vc0_negotiations_pending"] = [plx_decode_vc0_negotiation_pending(
+        regvals.value(port, PLX_REG_VC0_STATUS)) for port in enabled_ports]
+    return snapshot
+
+def plx_get_snapshot(handle, device):
+    ''' read every register of a full switch snapshot as one batch.
+    Returns (errval, snapshot) where snapshot is the dict built by
+    plx_decode_snapshot; errval is negative if a read failed. '''
+    val = plx_read_qword(handle, device, 0, PLX_PORTS_ENABLED_REGS[0][1])
+    if val < 0:
+        return (val, None)
+    enabled = plx_decode_ports_enabled([val])
+    (errval, regvals) = plx_snapshot_plan(enabled).read(handle, device)
+    if errval < 0:
+        return (errval, None)
+    return (0, plx_decode_snapshot(regvals, enabled))
+
+
+def plx_print_snapshot(snapshot, print_links_status=False,
+        print_status_and_controls2=False):
+    ''' print a snapshot returned by plx_get_snapshot '''
+    portcfg = snapshot["portcfg"]
+    portmap = snapshot["portmap"]
+    print("Port Configuration: {0} - {1}".format(portcfg, str(portmap)))
+
+    ports_enabled = snapshot["ports_enabled"]
+    print("Ports Enabled: {0}".format(str(ports_enabled)))
+
+    receivers_detected = snapshot["receivers_detected"]
+    print("Receivers Detected: {0}".format(str(receivers_detected)))
+
+    vc0_negotiations_pending = snapshot["vc0_negotiations_pending"]
+    print("VC0 Negotiations Pending: {0}".format(str(vc0_negotiations_pending)))
+
+    lanes_up = snapshot["lanes_up"]
+    print("Lanes Up: {0}".format(str(lanes_up)))
+
+    (link_widths, port_speeds) = snapshot["linkandspeed"]
+    print("Negotiated Link Widths: {0}".format(str(link_widths)))
+    print("Negotiated Link Speeds: {0}".format(str(port_speeds)))
+
+    recv_errcounts = snapshot["recv_errcounts"]
+    print("Receive Error Counts: {0}".format(str(recv_errcounts)))
+
+    bad_tlp_counts = snapshot["bad_tlp_counts"]
+    print("Bad TLP Counts: {0}".format(str(bad_tlp_counts)))
+    bad_dllp_counts = snapshot["bad_dllp_counts"]
+    print("Bad DLLP Counts: {0}".format(str(bad_dllp_counts)))
+
+    links_status = snapshot["links_status"]
+    dict_pprint(links_status[0], "Port 0 PCIe Link Status")
+
+    if print_links_status:
+        for s in links_status:
+            dict_pprint(s, "Port {0} PCIe Link Status".format(s["Port"]))
+
+    debug_control = snapshot["debug_control"]
+    dict_pprint(debug_control, "Debug Control Register")
+
+    link_status_and_control2s = snapshot["link_status_and_control2s"]
+    dict_pprint(link_status_and_control2s[0], "Port 0 PCIe Link Status and Controls 2");
+
+    if print_status_and_controls2:
+        for s in link_status_and_control2s:
+            dict_pprint(s, "Port {0} PCIe Link Status and Control2".format(s["Port"]))
+
+def plx_open_adapter(aaport):
+    ''' open and configure the Aardvark on <aaport> for talking to the switch.
+    Returns the handle, or the negative error code from aa_open. '''
+    handle = aa_open(aaport)
+    if (handle <= 0):
+        return handle
+
+    # Ensure that the I2C subsystem is enabled
+    aa_configure(handle,  AA_CONFIG_SPI_I2C)
+
+    # Enable the I2C bus pullup resistors (2.2k resistors).
+    # This command is only effective on v2.0 hardware or greater.
+    # The pullup resistors on the v1.02 hardware are enabled by default.
+    aa_i2c_pullup(handle, AA_I2C_PULLUP_BOTH)
+
+    # Don't turn on aardvark power pin
+    aa_target_power(handle, AA_TARGET_POWER_NONE)
+
+    # Set the bitrate
+    aa_i2c_bitrate(handle, bitrate)
+
+    # Set the bus lock timeout
+    aa_i2c_bus_timeout(handle, BUS_TIMEOUT)
+
+    return handle
+
+def aa_serial_string(unique_id):
+    ''' format an Aardvark unique ID as its printed serial number '''
+    return "%04d-%06d" % (unique_id // 1000000, unique_id % 1000000)
+
+def plx_find_adapters():
+    ''' return a list of (port, unique_id) of all free Aardvark adapters '''
+    nelem = 16
+    while True:
+        (num, ports, unique_ids) = aa_find_devices_ext(nelem, nelem)
+        if num <= nelem:
+            break
+        nelem = num
+
+    adapters = []
+    for i in range(max(0, num)):
+        if not (ports[i] & AA_PORT_NOT_FREE):
+            adapters.append((ports[i], unique_ids[i]))
+    return adapters
+
+
+class PLX_Fleet(object):
+    ''' The PLX switches behind every Aardvark adapter attached to this host.
+    open() opens and configures each adapter in <adapters> (default: all
+    free adapters found by plx_find_adapters); poll() then runs a
+    function on every switch concurrently from a pool of <workers>
+    threads and returns the results keyed by adapter serial number. '''
+    def __init__(self, device, adapters=None, workers=None):
+        self.device = device
+        self.adapters = adapters
+        self.workers = workers
+        self.handles = {}
+        self.errors = {}
+        self.pool = None
+
+    def open(self):
+        ''' open every adapter.  Adapters that fail to open are left out
+        of polling and their error codes kept in self.errors. '''
+        if self.adapters is None:
+            self.adapters = plx_find_adapters()
+        for (aaport, unique_id) in self.adapters:
+            serial = aa_serial_string(unique_id)
+            handle = plx_open_adapter(aaport)
+            if handle <= 0:
+                self.errors[serial] = handle
+            else:
+                self.handles[serial] = handle
+        # imported here so the tools that never poll a fleet start fast
+        from multiprocessing.pool import ThreadPool
+        workers = self.workers or max(1, len(self.handles))
+        self.pool = ThreadPool(workers)
+        return len(self.handles)
+
+    def poll(self, plx_func=None, *args):
+        ''' call plx_func(handle, device, *args) on every open adapter
+        concurrently and return a dict of results keyed by serial number.
+        plx_func defaults to plx_get_snapshot. '''
+        if plx_func is None:
+            plx_func = plx_get_snapshot
+        device = self.device
+        serials = sorted(self.handles)
+        results = self.pool.map(
+            lambda serial: plx_func(self.handles[serial], device, *args),
+            serials)
+        return dict(zip(serials, results))
+
+    def close(self):
+        ''' close every adapter and stop the worker pool '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for handle in self.handles.values():
+            aa_close(handle)
+        self.handles = {}
+
+
+class PLX_LaneErrAccumulator(object):
+    ''' Widens the 8-bit per-lane receive error counters decoded by
+    plx_decode_recv_errcounts into unbounded running totals.
+    Each update() adds the change since the previous counts, taken
+    modulo 256, so a counter that wrapped between polls is still counted
+    correctly as long as it moved by less than 256.  To keep it that way
+    the per-lane error rate is tracked (rising immediately, falling by
+    <decay> per update) and safe_interval() gives the longest poll
+    interval that keeps the busiest lane within <headroom> of a full
+    counter range.
+    A lane that reads 0xff may have saturated rather than wrapped, and
+    then stops counting: <saturated> flags such lanes, whose totals are
+    only a lower bound.  Their rate is held rather than decayed for
+    <saturation_hold> seconds so the poll interval does not relax while
+    counts may be being lost, then decays as usual, since faster polling
+    cannot recover counts from a counter that stays stuck.
+    Times passed to update() should come from plx_clock, which does not
+    step backwards; counts read at the same or an earlier time are still
+    added to the totals, only the rates skip them. '''
+
+    COUNTER_RANGE = 0x100
+    COUNTER_MAX = 0xff
+
+    def __init__(self, nlanes=num_lanes, headroom=0.5, decay=0.8,
+            min_interval=0.01, saturation_hold=10.0):
+        self.nlanes = nlanes
+        self.headroom = headroom
+        self.decay = decay
+        self.min_interval = min_interval
+        self.totals = nlanes * [0]
+        self.rates = nlanes * [0.0]
+        self.saturation_hold = saturation_hold
+        self.saturated = nlanes * [False]
+        self.saturated_since = nlanes * [None]
+        self.prev = None
+        self.prev_time = None
+
+    def update(self, counts, now):
+        ''' add the lane <counts> read at time <now> to the totals '''
+        for i in range(self.nlanes):
+            if counts[i] != self.COUNTER_MAX:
+                self.saturated_since[i] = None
+            elif self.saturated_since[i] is None:
+                self.saturated_since[i] = now
+        if self.prev is not None:
+            dt = now - self.prev_time
+            for i in range(self.nlanes):
+                delta = (counts[i] - self.prev[i]) % self.COUNTER_RANGE
+                self.totals[i] += delta
+                if dt <= 0:
+                    continue
+                decay = self.decay
+                since = self.saturated_since[i]
+                if since is not None and now - since < self.saturation_hold:
+                    decay = 1.0
+                self.rates[i] = max(delta / dt, self.rates[i] * decay)
+        self.saturated = [since is not None for since in self.saturated_since]
+        self.prev = list(counts)
+        self.prev_time = now
+
+    def safe_interval(self):
+        ''' return the longest poll interval in seconds that keeps every
+        lane within the headroom at its current error rate, or None if
+        no lane is seeing errors '''
+        peak = max(self.rates)
+        if peak <= 0:
+            return None
+        return max(self.headroom * self.COUNTER_RANGE / peak, self.min_interval)
+
+    def next_interval(self, interval):
+        ''' return the poll interval to use instead of <interval>: the
+        safe interval if it is shorter, otherwise <interval> '''
+        safe = self.safe_interval()
+        if safe is None or safe > interval:
+            return interval
+        return safe
+
+
+class PLX_ErrCounterMonitor(object):
+    ''' Long-running poller of the switch error counters.
+    Every <interval> seconds the per-lane receive error counts and the
+    per-port Bad TLP and Bad DLLP counts are read as one PLX_ReadPlan
+    batch.  Each sample, with its deltas and rates (counts per second)
+    since the previous one, is kept in a ring buffer of the last <depth>
+    samples which window() and latest() return without touching the bus.
+    The lane counts are also widened into running totals by a
+    PLX_LaneErrAccumulator, which shortens the poll interval when a
+    lane's error rate gets close to wrapping its 8-bit counter.
+    Per-port counters are only read for <ports> (default: the enabled
+    ports), since reading a disabled port can hang the i2c port.
+    Each sample's "time" is the wall clock time; rates are measured with
+    its "clock", from plx_clock.  Deltas are kept even if that has not
+    advanced since the previous sample. '''
+
+    LANE_COUNTER_MASK = 0xff
+    PORT_COUNTER_MASK = 0xffffffff
+
+    def __init__(self, handle, device, interval=1.0, depth=256, ports=None):
+        self.handle = handle
+        self.device = device
+        self.interval = interval
+        self.depth = depth
+        self.ports = ports
+        self.ring = depth * [None]
+        self.head = 0
+        self.count = 0
+        self.prev = None
+        self.errval = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.plan = None
+        self.accumulator = PLX_LaneErrAccumulator()
+        self.current_interval = interval
+
+    def _make_plan(self):
+        ''' return the read plan, or None if the ports enabled could not
+        be read (the error value is kept in self.errval) '''
+        if self.ports is None:
+            # polling disabled ports can hang the i2c port, so don't guess
+            val = plx_read_qword(self.handle, self.device, 0,
+                PLX_PORTS_ENABLED_REGS[0][1])
+            if val < 0:
+                self.errval = val
+                return None
+            enabled = plx_decode_ports_enabled([val])
+            self.ports = [port for port in range(num_ports) if enabled[port]]
+        plan = PLX_ReadPlan(PLX_RECV_ERRCOUNT_REGS)
+        for port in self.ports:
+            plan.add(port, PLX_REG_BAD_TLP_COUNT)
+            plan.add(port, PLX_REG_BAD_DLLP_COUNT)
+        return plan
+
+    def _deltas(self, cur, prev, mask, dt):
+        # the deltas are kept even if the clock has not advanced
+        deltas = [(c - p) & mask for (c, p) in zip(cur, prev)]
+        if dt > 0:
+            rates = [d / dt for d in deltas]
+        else:
+            rates = len(deltas) * [0.0]
+        return (deltas, rates)
+
+    def sample(self):
+        ''' read the counters once and add a sample to the ring buffer.
+        Returns the sample dict, or None if the read failed (the error
+        value is kept in self.errval). '''
+        if self.plan is None:
+            self.plan = self._make_plan()
+            if self.plan is None:
+                return None
+        (errval, regvals) = self.plan.read(self.handle, self.device)
+        now = time.time()
+        clock = plx_clock()
+        if errval < 0:
+            self.errval = errval
+            return None
+
+        sample = {}
+        sample["time"] = now
+        sample["clock"] = clock
+        sample["ports"] = self.ports
+        sample["lanes"] = plx_decode_recv_errcounts(regvals.values_of(PLX_RECV_ERRCOUNT_REGS))
+        sample["bad_tlp"] = [regvals.value(port, PLX_REG_BAD_TLP_COUNT)
+            for port in self.ports]
+        sample["bad_dllp"] = [regvals.value(port, PLX_REG_BAD_DLLP_COUNT)
+            for port in self.ports]
+
+        prev = self.prev
+        if prev is not None:
+            dt = clock - prev["clock"]
+            (sample["lane_deltas"], sample["lane_rates"]) = self._deltas(
+                sample["lanes"], prev["lanes"], self.LANE_COUNTER_MASK, dt)
+            (sample["bad_tlp_deltas"], sample["bad_tlp_rates"]) = self._deltas(
+                sample["bad_tlp"], prev["bad_tlp"], self.PORT_COUNTER_MASK, dt)
+            (sample["bad_dllp_deltas"], sample["bad_dllp_rates"]) = self._deltas(
+                sample["bad_dllp"], prev["bad_dllp"], self.PORT_COUNTER_MASK, dt)
+        else:
+            sample["lane_deltas"] = num_lanes * [0]
+            sample["lane_rates"] = num_lanes * [0.0]
+            sample["bad_tlp_deltas"] = len(self.ports) * [0]
+            sample["bad_tlp_rates"] = len(self.ports) * [0.0]
+            sample["bad_dllp_deltas"] = len(self.ports) * [0]
+            sample["bad_dllp_rates"] = len(self.ports) * [0.0]
+        self.prev = sample
+
+        self.accumulator.update(sample["lanes"], clock)
+        sample["lane_totals"] = list(self.accumulator.totals)
+        sample["lane_saturated"] = list(self.accumulator.saturated)
+
+        with self.lock:
+            self.ring[self.head] = sample
+            self.head = (self.head + 1) % self.depth
+            self.count = min(self.count + 1, self.depth)
+        return sample
+
+    def window(self, n=None):
+        ''' return the last <n> samples (default: all held), oldest first '''
+        with self.lock:
+            if n is None or n > self.count:
+                n = self.count
+            start = self.head - n
+            return [self.ring[i % self.depth] for i in range(start, self.head)]
+
+    def latest(self):
+        ''' return the most recent sample, or None '''
+        window = self.window(1)
+        return window and window[0] or None
+
+    def run(self, nsamples=None):
+        ''' sample every self.interval seconds, or faster if the lane
+        accumulator asks for it, until stop() is called or <nsamples>
+        samples have been taken '''
+        self.running = True
+        self._poll(nsamples)
+
+    def _poll(self, nsamples=None):
+        deadline = plx_clock()
+        taken = 0
+        while self.running and (nsamples is None or taken < nsamples):
+            self.sample()
+            taken += 1
+            self.current_interval = self.accumulator.next_interval(self.interval)
+            deadline += self.current_interval
+            delay = deadline - plx_clock()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, don't try to catch up with a burst
+                deadline = plx_clock()
+        self.running = False
+
+    def start(self):
+        ''' run the poller on a background thread '''
+        # set before the thread starts, so an early stop() is not lost
+        self.running = True
+        self.thread = threading.Thread(target=self._poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        ''' stop the poller and wait for its thread to finish '''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 
 #==========================================================================
 # MAIN PROGRAM
 #==========================================================================
-handle = aa_open(aaport)
-if (handle <= 0):
-    print "Unable to open Aardvark device on port %d" % port
-    print "Error code = %d" % handle
-    sys.exit()
-    
-# Ensure that the I2C subsystem is enabled
-aa_configure(handle,  AA_CONFIG_SPI_I2C)
-    
-# Enable the I2C bus pullup resistors (2.2k resistors).
-# This command is only effective on v2.0 hardware or greater.
-# The pullup resistors on the v1.02 hardware are enabled by default.
-aa_i2c_pullup(handle, AA_I2C_PULLUP_BOTH)
-
-# Don't turn on aardvark power pin
-aa_target_power(handle, AA_TARGET_POWER_NONE)
-
-# Set the bitrate
-bitrate = aa_i2c_bitrate(handle, bitrate)
-#print "Bitrate set to %d kHz" % bitrate
-
-# Set the bus lock timeout
-bus_timeout = aa_i2c_bus_timeout(handle, BUS_TIMEOUT)
-#print "Bus lock timeout set to %d ms" % bus_timeout
-
-portcfg = plx_get_portconfig(handle, device)
-portmap = plx_8619_get_portmap(portcfg) 
-print("Port Configuration: {0} - {1}".format(portcfg, str(portmap)))
-
-ports_enabled = plx_get_ports_enabled(handle, device)
-print("Ports Enabled: {0}".format(str(ports_enabled)))
-
-receivers_detected = plx_get_receiver_detected(handle, device)
-print("Receivers Detected: {0}".format(str(receivers_detected)))
-
-vc0_negotiations_pending = plx_get_vc0_negotiations_pending(handle, device, ports_enabled)
-print("VC0 Negotiations Pending: {0}".format(str(vc0_negotiations_pending)))
-
-lanes_up = plx_get_lanes_up(handle, device)
-print("Lanes Up: {0}".format(str(lanes_up)))
-
-(link_widths, port_speeds) = plx_get_linkandspeed(handle, device)
-print("Negotiated Link Widths: {0}".format(str(link_widths)))
-print("Negotiated Link Speeds: {0}".format(str(port_speeds)))
-
-recv_errcounts = plx_get_recv_errcounts(handle, device)
-print("Receive Error Counts: {0}".format(str(recv_errcounts)))
-
-bad_tlp_counts = plx_get_bad_tlp_counts(handle, device)
-print("Bad TLP Counts: {0}".format(str(bad_tlp_counts)))
-bad_dllp_counts = plx_get_bad_tlp_counts(handle, device)
-print("Bad DLLP Counts: {0}".format(str(bad_dllp_counts)))
-
-links_status = plx_get_links_status(handle, device, ports_enabled)
-dict_pprint(links_status[0], "Port 0 PCIe Link Status")
-
-print_links_status = False
-if print_links_status:
-    for s in links_status:
-        dict_pprint(s, "Port {0} PCIe Link Status".format(s["Port"]))
-
-
-debug_control = plx_get_debug_control(handle, device)
-dict_pprint(debug_control, "Debug Control Register")
-
-link_status_and_control2s = plx_get_link_status_and_control2s(handle, device, ports_enabled)
-dict_pprint(link_status_and_control2s[0], "Port 0 PCIe Link Status and Controls 2");
-
-print_status_and_controls2 = False
-if print_status_and_controls2:
-    for s in link_status_and_control2s:
-        dict_pprint(s, "Port {0} PCIe Link Status and Control2".format(s["Port"]))
-
-
-
-# Close the device
-aa_close(handle)
+def main(argv=None):
+    ''' plx8619dbg [--all | --monitor [interval]] '''
+    if argv is None:
+        argv = sys.argv
+
+    if len(argv) > 1 and argv[1] == "--all":
+        # Snapshot the switch behind every attached Aardvark
+        fleet = PLX_Fleet(device)
+        fleet.open()
+        for serial in sorted(fleet.errors):
+            print("Unable to open Aardvark {0}: error {1}".format(serial, fleet.errors[serial]))
+        results = fleet.poll()
+        fleet.close()
+
+        for serial in sorted(results):
+            (errval, snapshot) = results[serial]
+            print("== Aardvark {0} ==".format(serial))
+            if errval < 0:
+                print("Unable to read switch snapshot: error %d" % errval)
+            else:
+                plx_print_snapshot(snapshot)
+        return
+
+    handle = plx_open_adapter(aaport)
+    if (handle <= 0):
+        print("Unable to open Aardvark device on port %d" % aaport)
+        print("Error code = %d" % handle)
+        return
+
+    if len(argv) > 1 and argv[1] == "--monitor":
+        # Print error counter rates until interrupted
+        interval = 1.0
+        if len(argv) > 2:
+            interval = float(argv[2])
+        monitor = PLX_ErrCounterMonitor(handle, device, interval)
+        monitor.start()
+        try:
+            while True:
+                time.sleep(interval)
+                sample = monitor.latest()
+                if sample is None:
+                    continue
+                print("{0:.3f} lanes {1} tlp {2} dllp {3}".format(sample["time"],
+                    str(sample["lane_deltas"]), str(sample["bad_tlp_deltas"]),
+                    str(sample["bad_dllp_deltas"])))
+        except KeyboardInterrupt:
+            pass
+        monitor.stop()
+        aa_close(handle)
+        return
+
+    # Read every register needed below as one batch
+    (errval, snapshot) = plx_get_snapshot(handle, device)
+    if errval < 0:
+        print("Unable to read switch snapshot: error %d" % errval)
+        aa_close(handle)
+        return
+
+    plx_print_snapshot(snapshot)
+
+    # Close the device
+    aa_close(handle)
+
+if __name__ == "__main__":
+    main()
 
 
 # modeline...
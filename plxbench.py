@@ -0,0 +1,240 @@
+#!/bin/env python
+#
+# plx bench
+#
+# Transaction throughput benchmarks for the register and EEPROM paths.
+#
+# By default the benchmarks run against the simulator in aardvark_sim.py
+# without sleeping: the measured time is then all Python, and the time
+# the hardware would have taken is the simulator's modelled wire time.
+# With --hw they run against the Aardvark on port 0 instead.
+#
+# usage: plxbench [--hw] [--eeprom part] [--json out.json]
+#                 [--compare old.json] [benchmark ...]
+#
+#   --eeprom part   also benchmark programming an EEPROM of this part at
+#                   i2c address 0x50; with --hw this overwrites it
+#
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import json
+import platform
+import sys
+import time
+
+import aardvark_sim
+from aardvark_py import *
+from plx8619dbg import device, plx_open_adapter, plx_read_qword, \
+    plx_for_all_ports, plx_get_bad_tlp_count, plx_get_snapshot
+from plxeeprom import EEPROM_PARTS, eeprom_write, eeprom_update, \
+    eeprom_verify
+import eeprom_gen
+
+
+#==========================================================================
+# CONSTANTS
+#==========================================================================
+aaport = 0
+eeprom_device = 0x50
+
+# Latency percentiles reported
+PLXBENCH_PERCENTILES = (50, 90, 99)
+
+
+#==========================================================================
+# FUNCTIONS
+#==========================================================================
+def plxbench_percentile(sorted_values, p):
+    ''' return the <p>th percentile of a sorted list '''
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))
+    return sorted_values[i]
+
+def plxbench_run(op, n, sim=None, nbytes=0):
+    ''' time <n> calls of <op>.  <sim> is the AardvarkSim in use, if any,
+    to take transaction counts and wire time from; nbytes is the bytes
+    each call transfers, for the throughput.  Returns a dict of
+    results, times in seconds.
+
+    On a simulator that does not sleep, the times reported are those the
+    modelled hardware would take: the Python time measured plus the
+    simulated wire time. '''
+    latencies = []
+    wire = 0.0
+    transactions = 0
+    t0 = time.time()
+    for i in range(n):
+        if sim is not None:
+            (tx, w) = (sim.transactions, sim.wire_time)
+        t = time.time()
+        op()
+        latency = time.time() - t
+        if sim is not None:
+            transactions += sim.transactions - tx
+            wire += sim.wire_time - w
+            if not sim.sleep:
+                latency += sim.wire_time - w
+        latencies.append(latency)
+    elapsed = time.time() - t0
+    latencies.sort()
+
+    python = elapsed
+    if sim is not None:
+        if sim.sleep:
+            python = elapsed - wire
+        else:
+            elapsed += wire
+
+    result = {
+        "n": n,
+        "elapsed": elapsed,
+        "ops_per_s": elapsed > 0 and n / elapsed or None,
+        "latency_max": latencies[-1],
+        }
+    for p in PLXBENCH_PERCENTILES:
+        result["latency_p%d" % p] = plxbench_percentile(latencies, p)
+    if sim is not None:
+        # python is the time spent outside the (simulated) hardware
+        result.update({
+            "transactions": transactions,
+            "wire": wire,
+            "python": python,
+            "tx_per_s": elapsed > 0 and transactions / elapsed or None,
+            "python_fraction": elapsed > 0 and python / elapsed or None,
+            })
+    if nbytes:
+        result["bytes_per_s"] = elapsed > 0 and n * nbytes / elapsed or None
+    return result
+
+def plxbench_cases(handle, eeprom_part=None):
+    ''' return the list of (name, n, op, nbytes) benchmarks '''
+    cases = [
+        ("read_qword", 200,
+            lambda: plx_read_qword(handle, device, 0, 0x78), 4),
+        ("port_sweep", 20,
+            lambda: plx_for_all_ports(handle, device, plx_get_bad_tlp_count), 0),
+        ("snapshot", 10,
+            lambda: plx_get_snapshot(handle, device), 0),
+        ]
+
+    if eeprom_part is not None:
+        size = EEPROM_PARTS[eeprom_part][0]
+        image = bytearray((i * 7) & 0xff for i in range(size))
+        changed = bytearray(image)
+        changed[size // 2] ^= 0xff
+        images = [image, changed]
+
+        def update():
+            # alternate between two images a page apart
+            images.reverse()
+            return eeprom_update(handle, eeprom_device, eeprom_part,
+                images[0])
+
+        cases += [
+            ("eeprom_write", 1,
+                lambda: eeprom_write(handle, eeprom_device, eeprom_part,
+                    image), size),
+            ("eeprom_verify", 5,
+                lambda: eeprom_verify(handle, eeprom_device, eeprom_part,
+                    image), size),
+            ("eeprom_update", 4, update, size),
+            ]
+
+    rs = eeprom_gen.build_regstream(disable_port_1=True, disable_port_4=True,
+        NT_port_4=True)
+    cases.append(("serialize", 1000, lambda: rs.serialize(crc=True), 0))
+    return cases
+
+def plxbench_print(name, result, old=None):
+    line = "%-14s %6d ops %9.1f ops/s  p50 %8.3f ms  p99 %8.3f ms" % (name,
+        result["n"], result["ops_per_s"] or 0,
+        1000 * result["latency_p50"], 1000 * result["latency_p99"])
+    if "transactions" in result:
+        line += "  %5.0f tx/s  python %3.0f%%" % (result["tx_per_s"] or 0,
+            100 * (result["python_fraction"] or 0))
+    if "bytes_per_s" in result:
+        line += "  %8.0f bytes/s" % result["bytes_per_s"]
+    if old is not None and old.get("ops_per_s") and result["ops_per_s"]:
+        line += "  x%.2f" % (result["ops_per_s"] / old["ops_per_s"])
+    print(line)
+
+
+#==========================================================================
+# MAIN PROGRAM
+#==========================================================================
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    args = argv[1:]
+    hw = False
+    eeprom_part = None
+    json_out = None
+    compare = None
+    while args and args[0].startswith("--"):
+        opt = args.pop(0)
+        if opt == "--hw":
+            hw = True
+        elif opt == "--eeprom" and args:
+            eeprom_part = args.pop(0)
+        elif opt == "--json" and args:
+            json_out = args.pop(0)
+        elif opt == "--compare" and args:
+            compare = args.pop(0)
+        else:
+            args = None
+            break
+    if args is None or (eeprom_part is not None
+            and eeprom_part not in EEPROM_PARTS):
+        print("usage: plxbench [--hw] [--eeprom part] [--json out.json]")
+        print("                [--compare old.json] [benchmark ...]")
+        return 1
+
+    sim = None
+    if not hw:
+        eeprom = None
+        if eeprom_part is not None:
+            (size, page_size, addr_bytes) = EEPROM_PARTS[eeprom_part]
+            eeprom = aardvark_sim.AA_SimEeprom(size, page_size, addr_bytes,
+                eeprom_device)
+        sim = aardvark_sim.install(aardvark_sim.AardvarkSim(sleep=False,
+            eeprom=eeprom))
+
+    handle = plx_open_adapter(aaport)
+    if (handle <= 0):
+        print("Unable to open Aardvark device on port %d" % aaport)
+        print("Error code = %d" % handle)
+        return 1
+
+    old = {}
+    if compare is not None:
+        with open(compare) as f:
+            old = json.load(f)["results"]
+
+    results = {}
+    for (name, n, op, nbytes) in plxbench_cases(handle, eeprom_part):
+        if args and name not in args:
+            continue
+        results[name] = plxbench_run(op, n, sim, nbytes)
+        plxbench_print(name, results[name], old.get(name))
+    aa_close(handle)
+
+    if json_out is not None:
+        with open(json_out, "w") as f:
+            json.dump({
+                "backend": hw and "hardware" or "simulator",
+                "python": platform.python_version(),
+                "time": time.time(),
+                "results": results,
+                }, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,183 @@
+#!/bin/env python
+#
+# plx dump diff
+#
+# Compares binary config space dumps written by 'plxread --dump' and
+# reports the registers that differ from the first (reference) dump.
+#
+# usage: plxdiff good.bin bad.bin [more.bin ...]
+#
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import mmap
+import sys
+from array import array
+
+from plxread import plxdump_header
+from plx8619dbg import PLX_REG_FIELDS, PLX_REG_VOLATILITY, PLX_REG_VOLATILE, \
+    plx_decode_fields
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#==========================================================================
+# CONSTANTS
+#==========================================================================
+# Bits that are expected to differ between otherwise identical boards,
+# by register offset.  Registers listed as volatile in
+# PLX_REG_VOLATILITY (the error counters) are ignored entirely.
+PLXDIFF_IGNORE_BITS = {
+    0x078: (1 << 27)    # link status: link training
+        | (1 << 30)     # link bandwidth management status
+        | (1 << 31),    # link autonomous bandwidth status
+    0x160: (1 << 17),   # vc0 negotiation pending
+    }
+
+
+#==========================================================================
+# FUNCTIONS
+#==========================================================================
+class PLX_Dump(object):
+    ''' A dump file written by plxdump, memory-mapped read-only.
+    regs(i) returns the registers of the i'th port in self.ports as a
+    NumPy uint32 array (or an array('I') without NumPy). '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "rb")
+        header = plxdump_header(self.f)
+        if header is None:
+            self.f.close()
+            raise ValueError("%s is not a plx dump file" % filename)
+        self.device = header["device"]
+        self.space_size = header["space_size"]
+        self.ports = header["ports"]
+        self.timestamp = header["timestamp"]
+        self.data_offset = header["data_offset"]
+        self.nregs = self.space_size // 4
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        # an interrupted dump only holds the ports it completed
+        complete = (len(self.map) - self.data_offset) // self.space_size
+        self.ports = self.ports[:complete]
+
+        if numpy is not None:
+            self.data = numpy.frombuffer(self.map, dtype='<u4',
+                count=len(self.ports) * self.nregs,
+                offset=self.data_offset).reshape(len(self.ports), self.nregs)
+
+    def regs(self, i):
+        ''' return the register values of the i'th dumped port '''
+        if numpy is not None:
+            return self.data[i]
+        start = self.data_offset + i * self.space_size
+        regs = array('I', self.map[start:start + self.space_size])
+        if sys.byteorder != 'little':
+            regs.byteswap()
+        return regs
+
+    def close(self):
+        if numpy is not None:
+            del self.data
+        self.map.close()
+        self.f.close()
+
+
+def plxdiff_mask(nregs):
+    ''' return the per-register mask of bits to compare, for a config space
+    of <nregs> registers '''
+    mask = [0xffffffff] * nregs
+    for (addr, volatility) in PLX_REG_VOLATILITY.items():
+        if volatility == PLX_REG_VOLATILE and addr // 4 < nregs:
+            mask[addr // 4] = 0
+    for (addr, bits) in PLXDIFF_IGNORE_BITS.items():
+        if addr // 4 < nregs:
+            mask[addr // 4] &= ~bits & 0xffffffff
+    if numpy is not None:
+        return numpy.array(mask, dtype=numpy.uint32)
+    return mask
+
+def plxdiff_regs(ref, other, mask):
+    ''' return the list of register indexes where <ref> and <other> differ
+    in the bits set in <mask> '''
+    if numpy is not None:
+        return numpy.nonzero((ref ^ other) & mask)[0].tolist()
+    if ref == other:
+        return []
+    return [i for i in range(len(ref)) if (ref[i] ^ other[i]) & mask[i]]
+
+def plxdiff_fields(addr, a, b, mask):
+    ''' describe how register <addr> differs between values <a> and <b>.
+    Returns a list of (field, a, b) tuples, decoded through
+    PLX_REG_FIELDS where the register has a field table. '''
+    diff = (a ^ b) & mask
+    fields = PLX_REG_FIELDS.get(addr, [])
+    entries = []
+    for field in fields:
+        (name, shift, width, enum) = field
+        if diff & (((1 << width) - 1) << shift):
+            entries.append((name,
+                plx_decode_fields([field], a)[name],
+                plx_decode_fields([field], b)[name]))
+            diff &= ~(((1 << width) - 1) << shift)
+    if diff:
+        entries.append(("bits 0x%08x" % diff, "0x%08x" % (a & diff),
+            "0x%08x" % (b & diff)))
+    return entries
+
+def plxdiff(ref, other):
+    ''' compare two PLX_Dumps and return a list of
+    (port, offset, field, ref value, other value) for every difference.
+    Only ports present in both dumps are compared. '''
+    nregs = min(ref.nregs, other.nregs)
+    mask = plxdiff_mask(nregs)
+    diffs = []
+    for (i, port) in enumerate(ref.ports):
+        if port not in other.ports:
+            continue
+        a = ref.regs(i)[:nregs]
+        b = other.regs(other.ports.index(port))[:nregs]
+        for reg in plxdiff_regs(a, b, mask):
+            for (field, va, vb) in plxdiff_fields(4 * reg, int(a[reg]),
+                    int(b[reg]), int(mask[reg])):
+                diffs.append((port, 4 * reg, field, va, vb))
+    return diffs
+
+
+#==========================================================================
+# MAIN PROGRAM
+#==========================================================================
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if len(argv) < 3:
+        print("usage: plxdiff good.bin bad.bin [more.bin ...]")
+        return 1
+
+    ref = PLX_Dump(argv[1])
+    ndiffering = 0
+    for filename in argv[2:]:
+        other = PLX_Dump(filename)
+        diffs = plxdiff(ref, other)
+        other.close()
+        if diffs:
+            ndiffering += 1
+        for (port, offset, field, va, vb) in diffs:
+            print("{0}: port {1} 0x{2:03x} {3}: {4} -> {5}".format(filename,
+                port, offset, field, va, vb))
+    ref.close()
+
+    print("{0} of {1} dumps differ from {2}".format(ndiffering,
+        len(argv) - 2, argv[1]))
+    return ndiffering and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
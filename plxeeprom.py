@@ -0,0 +1,332 @@
+#!/bin/env python
+#
+# plx eeprom
+#
+# Programs the I2C serial EEPROM of a PLX switch board through the
+# Aardvark, from an image built by eeprom_gen.py.
+#
+# usage: plxeeprom write|update|verify|dump part file [i2c address]
+#
+#   write   writes every page of the image
+#   update  reads the EEPROM back and only writes and verifies the
+#           pages that differ from the image
+#   verify  compares the EEPROM with the image
+#   dump    reads the whole EEPROM into the file
+#
+# example: plxeeprom update 24c64 plx8732_stn2rev_x8x8_port1Upst.bin
+#
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import sys
+import time
+
+from aardvark_py import *
+
+
+#==========================================================================
+# CONSTANTS
+#==========================================================================
+BUS_TIMEOUT = 150  # ms
+
+aaport = 0
+bitrate = 400
+# Default i2c address of 24Cxx serial EEPROMs with the address pins low
+device = 0x50
+
+# Serial EEPROM parts: (size in bytes, page size, address bytes).
+# Parts with a single address byte and more than 256 bytes take the
+# upper address bits in the low bits of the i2c address.
+EEPROM_PARTS = {
+    '24c02':  (256, 8, 1),
+    '24c04':  (512, 16, 1),
+    '24c08':  (1024, 16, 1),
+    '24c16':  (2048, 16, 1),
+    '24c32':  (4096, 32, 2),
+    '24c64':  (8192, 32, 2),
+    '24c128': (16384, 64, 2),
+    '24c256': (32768, 64, 2),
+    '24c512': (65536, 128, 2),
+    }
+
+# Largest read transaction, the Aardvark limit
+EEPROM_READ_CHUNK = 65535
+
+# Longest internal write cycle to wait for; parts specify 5 or 10 ms
+EEPROM_WRITE_TIMEOUT = 0.025  # s
+
+# Error values, below the range of the negative Aardvark status codes
+# returned on the same channel
+EEPROM_ERR_TIMEOUT = -1001  # no ack within EEPROM_WRITE_TIMEOUT
+EEPROM_ERR_WRITE = -1002    # page write not fully acked
+EEPROM_ERR_READ = -1003     # read transaction failed or came back short
+EEPROM_ERR_VERIFY = -1004   # page read back differs from what was written
+
+
+#==========================================================================
+# FUNCTIONS
+#==========================================================================
+def eeprom_fill_addr(buf, device, part, addr):
+    ''' put the address bytes for <addr> at the start of <buf> and return
+    the i2c address to use for it '''
+    (size, page_size, addr_bytes) = EEPROM_PARTS[part]
+    if addr_bytes == 1:
+        buf[0] = addr & 0xff
+        return device | ((addr >> 8) & 0x7)
+    buf[0] = (addr >> 8) & 0xff
+    buf[1] = addr & 0xff
+    return device
+
+def eeprom_ack_poll(handle, device, timeout=EEPROM_WRITE_TIMEOUT):
+    ''' wait for the EEPROM to finish its internal write cycle.
+    The EEPROM does not ack its address until the cycle is over, so it
+    is probed with empty writes until it acks.  Returns the number of
+    probes, or EEPROM_ERR_TIMEOUT or the negative Aardvark error. '''
+    empty = (array('B'), 0)
+    deadline = time.time() + timeout
+    polls = 0
+    while True:
+        polls += 1
+        (status, num_written) = aa_i2c_write_ext(handle, device,
+            AA_I2C_NO_FLAGS, empty)
+        if status == AA_I2C_STATUS_OK:
+            return polls
+        if status < 0:
+            return status
+        if time.time() > deadline:
+            return EEPROM_ERR_TIMEOUT
+
+def eeprom_write_page(handle, device, part, addr, data, buf=None):
+    ''' write <data> to the EEPROM at <addr> and wait for the write cycle.
+    data must not cross a page boundary.  buf is an optional array('B')
+    of the address bytes plus the page size, reused between calls.
+    Returns 0 or a negative error value. '''
+    (size, page_size, addr_bytes) = EEPROM_PARTS[part]
+    if buf is None:
+        buf = array('B', [0]) * (addr_bytes + page_size)
+    slave = eeprom_fill_addr(buf, device, part, addr)
+    count = len(data)
+    buf[addr_bytes:addr_bytes + count] = array('B', data)
+    num_written = aa_i2c_write_from(handle, slave, AA_I2C_NO_FLAGS, buf,
+        addr_bytes + count)
+    if num_written < 0:
+        return num_written
+    if num_written != addr_bytes + count:
+        return EEPROM_ERR_WRITE
+    polls = eeprom_ack_poll(handle, slave)
+    if polls < 0:
+        return polls
+    return 0
+
+def eeprom_page_spans(page_size, addr, length):
+    ''' yield (offset, count) for each page of <page_size> bytes touched
+    by <length> bytes at <addr>; the first and last pages may be
+    partial.  Shared with the SPI parts of plxspi. '''
+    n = 0
+    while n < length:
+        count = min(page_size - (addr + n) % page_size, length - n)
+        yield (n, count)
+        n += count
+
+def eeprom_pages(part, addr, length):
+    ''' yield (offset, count) for each page of <part> touched by <length>
+    bytes at <addr> '''
+    return eeprom_page_spans(EEPROM_PARTS[part][1], addr, length)
+
+def eeprom_compare(current, data):
+    ''' compare the array('B') <current> read from a part with <data>.
+    Returns (errval, offset): EEPROM_ERR_VERIFY and the offset of the
+    first byte that differs, or (0, None) if they match. '''
+    if current == data:
+        return (0, None)
+    offset = 0
+    while current[offset] == data[offset]:
+        offset += 1
+    return (EEPROM_ERR_VERIFY, offset)
+
+def eeprom_read(handle, device, part, addr, length, buf=None):
+    ''' read <length> bytes from the EEPROM at <addr> in sequential-read
+    mode: the first EEPROM_READ_CHUNK bytes, all of any part but the
+    last byte of a 24c512, come back in a single write+read transaction
+    straight into the result, and the EEPROM's address counter carries
+    any rest over to plain reads.  buf is an optional array('B') of at
+    least <length> bytes to read into, reused between calls; it is left
+    at its length.  Returns (errval, array('B') of <length> bytes) or,
+    on error, (errval, the bytes read before the failure); the array is
+    buf itself if it is exactly <length> bytes long. '''
+    addr_bytes = EEPROM_PARTS[part][2]
+    if buf is None or len(buf) < length:
+        buf = array('B', [0]) * length
+    out = array('B', [0]) * addr_bytes
+    slave = eeprom_fill_addr(out, device, part, addr)
+
+    count = min(length, EEPROM_READ_CHUNK)
+    (status, num_written, num_read) = aa_i2c_write_read_into(handle, slave,
+        AA_I2C_NO_FLAGS, out, addr_bytes, buf, count)
+    if status != 0 or num_read != count:
+        return (status < 0 and status or EEPROM_ERR_READ, buf[:0])
+
+    n = count
+    if n < length:
+        # the native calls can't read into buf at an offset
+        chunk = array('B', [0]) * min(length - n, EEPROM_READ_CHUNK)
+    while n < length:
+        count = min(length - n, EEPROM_READ_CHUNK)
+        num_read = aa_i2c_read_into(handle, slave, AA_I2C_NO_FLAGS, chunk,
+            count)
+        if num_read != count:
+            return (num_read < 0 and num_read or EEPROM_ERR_READ, buf[:n])
+        buf[n:n + count] = chunk[:count]
+        n += count
+    if len(buf) > length:
+        return (0, buf[:length])
+    return (0, buf)
+
+def eeprom_verify(handle, device, part, image, addr=0, buf=None):
+    ''' compare the EEPROM contents at <addr> with <image>.
+    Returns (errval, offset, seconds): offset is that of the first byte
+    that differs, or None if the EEPROM matches the image. '''
+    data = array('B', bytearray(image))
+    t0 = time.time()
+    (errval, current) = eeprom_read(handle, device, part, addr, len(data),
+        buf)
+    offset = None
+    if errval == 0:
+        (errval, offset) = eeprom_compare(current, data)
+    return (errval, offset, time.time() - t0)
+
+def eeprom_write(handle, device, part, image, addr=0):
+    ''' write <image> to the EEPROM starting at <addr>, a full page per
+    transaction, continuing as soon as each page's write cycle ends.
+    Returns (errval, nbytes, seconds). '''
+    (size, page_size, addr_bytes) = EEPROM_PARTS[part]
+    data = bytearray(image)
+    if addr + len(data) > size:
+        raise ValueError("%d byte image does not fit in a %s at 0x%x"
+            % (len(data), part, addr))
+
+    buf = array('B', [0]) * (addr_bytes + page_size)
+    errval = 0
+    nbytes = 0
+    t0 = time.time()
+    for (n, count) in eeprom_pages(part, addr, len(data)):
+        errval = eeprom_write_page(handle, device, part, addr + n,
+            data[n:n + count], buf)
+        if errval < 0:
+            break
+        nbytes += count
+    return (errval, nbytes, time.time() - t0)
+
+def eeprom_update(handle, device, part, image, addr=0):
+    ''' bring the EEPROM contents at <addr> up to <image>, writing only
+    the pages that differ and reading each back to verify it.
+    Returns (errval, nbytes, seconds), nbytes being the bytes of the
+    pages written; on error, nbytes is the offset of the failing page. '''
+    (size, page_size, addr_bytes) = EEPROM_PARTS[part]
+    data = array('B', bytearray(image))
+    if addr + len(data) > size:
+        raise ValueError("%d byte image does not fit in a %s at 0x%x"
+            % (len(data), part, addr))
+
+    t0 = time.time()
+    (errval, current) = eeprom_read(handle, device, part, addr, len(data))
+    if errval < 0:
+        return (errval, len(current), time.time() - t0)
+
+    buf = array('B', [0]) * (addr_bytes + page_size)
+    nbytes = 0
+    for (n, count) in eeprom_pages(part, addr, len(data)):
+        page = data[n:n + count]
+        if current[n:n + count] == page:
+            continue
+        errval = eeprom_write_page(handle, device, part, addr + n, page, buf)
+        if errval == 0:
+            (errval, readback) = eeprom_read(handle, device, part, addr + n,
+                count)
+            if errval == 0 and readback != page:
+                errval = EEPROM_ERR_VERIFY
+        if errval < 0:
+            return (errval, n, time.time() - t0)
+        nbytes += count
+    return (errval, nbytes, time.time() - t0)
+
+
+#==========================================================================
+# MAIN PROGRAM
+#==========================================================================
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if (len(argv) < 4
+            or argv[1] not in ("write", "update", "verify", "dump")
+            or argv[2] not in EEPROM_PARTS):
+        print("usage: plxeeprom write|update|verify|dump part file "
+            "[i2c address]")
+        print("")
+        print("parts: %s" % " ".join(sorted(EEPROM_PARTS)))
+        return 1
+
+    part = argv[2]
+    if argv[1] != "dump":
+        with open(argv[3], "rb") as f:
+            image = f.read()
+    eeprom = device
+    if len(argv) > 4:
+        eeprom = int(argv[4], base=0)
+
+    handle = aa_open(aaport)
+    if (handle <= 0):
+        print("Unable to open Aardvark device on port %d" % aaport)
+        print("Error code = %d" % handle)
+        return 1
+
+    aa_configure(handle, AA_CONFIG_SPI_I2C)
+    aa_i2c_pullup(handle, AA_I2C_PULLUP_BOTH)
+    aa_target_power(handle, AA_TARGET_POWER_NONE)
+    actual_bitrate = aa_i2c_bitrate(handle, bitrate)
+    print("Bitrate set to %d kHz" % actual_bitrate)
+    aa_i2c_bus_timeout(handle, BUS_TIMEOUT)
+
+    if argv[1] == "dump":
+        t0 = time.time()
+        (errval, data) = eeprom_read(handle, eeprom, part, 0,
+            EEPROM_PARTS[part][0])
+        seconds = time.time() - t0
+        with open(argv[3], "wb") as f:
+            data.tofile(f)
+        if errval < 0:
+            print("Read failed at 0x%x, error %d" % (len(data), errval))
+        print("Read %d bytes in %.3f s" % (len(data), seconds))
+    elif argv[1] == "verify":
+        (errval, offset, seconds) = eeprom_verify(handle, eeprom, part, image)
+        if offset is not None:
+            print("EEPROM differs from the image at 0x%x" % offset)
+        elif errval < 0:
+            print("Read failed, error %d" % errval)
+        else:
+            print("Verified %d bytes in %.3f s" % (len(image), seconds))
+    elif argv[1] == "update":
+        (errval, nbytes, seconds) = eeprom_update(handle, eeprom, part, image)
+        if errval < 0:
+            print("Update failed in the page at 0x%x, error %d" % (nbytes,
+                errval))
+        else:
+            print("Updated %d of %d bytes in %.2f s" % (nbytes, len(image),
+                seconds))
+    else:
+        (errval, nbytes, seconds) = eeprom_write(handle, eeprom, part, image)
+        if errval < 0:
+            print("Write failed at 0x%x, error %d" % (nbytes, errval))
+        print("Wrote %d bytes in %.2f s (%.0f bytes/s)" % (nbytes, seconds,
+            seconds > 0 and nbytes / seconds or 0))
+    aa_close(handle)
+    return errval < 0 and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
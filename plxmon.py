@@ -0,0 +1,517 @@
+#!/bin/env python
+#
+# plx monitor
+#
+# Captures the traffic on the switch's I2C bus with the Aardvark bus
+# monitor, for long unattended captures of BMC to switch traffic, and
+# splits captures into transactions.
+#
+# It can also sniff the register values the BMC reads from the switch,
+# live or from a capture, so they are known without adding any traffic
+# to the bus.
+#
+# usage: plxmon capture file [seconds]
+#        plxmon decode file
+#        plxmon regs file
+#        plxmon sniff [seconds]
+#
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import struct
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from aardvark_py import *
+from plx8619dbg import device, PLX_CMD_READ, PLX_CMD_WRITE, \
+    plx_decode_command
+
+
+#==========================================================================
+# CONSTANTS
+#==========================================================================
+aaport = 0
+
+# Capture files
+#
+# A 16 byte header followed by one record per monitor read.  Each record
+# is a u32 count of words and the f64 time of the read, followed by the
+# words as little-endian u16, exactly as aa_i2c_monitor_read returned
+# them.
+#
+# Header:
+#   0x00  magic 'PLXM'
+#   0x04  u16 format version
+#   0x06  reserved
+#   0x08  f64 time the capture was started (seconds since the epoch)
+PLXMON_MAGIC = b'PLXM'
+PLXMON_VERSION = 1
+PLXMON_HEADER = struct.Struct('<4sHxxd')
+PLXMON_RECORD = struct.Struct('<Id')
+
+# Words per monitor read buffer, and buffers allocated up front
+PLXMON_BUFFER_WORDS = 32768
+PLXMON_BUFFERS = 8
+
+# Longest wait for monitor data before checking for stop()
+PLXMON_POLL_MS = 100
+
+# Words per monitor read when sniffing registers
+PLXMON_SNIFF_WORDS = 4096
+
+
+#==========================================================================
+# FUNCTIONS
+#==========================================================================
+def plxmon_view(words, n):
+    ''' return the first <n> of the array('H') <words> as a buffer to
+    write without copying them '''
+    try:
+        return memoryview(words)[:n]
+    except TypeError:
+        # python 2 arrays have no memoryview
+        return buffer(words, 0, n * words.itemsize)
+
+
+class PLX_MonitorCapture(object):
+    ''' Capture of the bus monitor of the Aardvark <handle> to <filename>.
+    start() enables the monitor and starts a drain thread, which reads
+    the monitor into reusable array('H') buffers as fast as data comes
+    in, and a writer thread, which appends the filled buffers to the
+    file.  Buffers go back to the drain thread once written; if the
+    writer falls behind, more are allocated rather than leaving data in
+    the adapter.  stop() reads what the adapter still holds, then
+    disables the monitor and flushes the file. '''
+    def __init__(self, handle, filename, buffer_words=PLXMON_BUFFER_WORDS,
+            nbuffers=PLXMON_BUFFERS):
+        self.handle = handle
+        self.filename = filename
+        self.buffer_words = buffer_words
+        self.free = queue.Queue()
+        for i in range(nbuffers):
+            self.free.put(array('H', [0]) * buffer_words)
+        self.filled = queue.Queue()
+        self.nbuffers = nbuffers
+        self.words = 0
+        self.records = 0
+        self.errval = 0
+        self.stopping = threading.Event()
+        self.drain_thread = None
+        self.write_thread = None
+
+    def drain(self):
+        handle = self.handle
+        while True:
+            stopping = self.stopping.is_set()
+            # once stopping, empty the adapter without waiting for more
+            ret = aa_async_poll(handle, not stopping and PLXMON_POLL_MS or 0)
+            if ret < 0:
+                self.errval = ret
+                break
+            if not (ret & AA_ASYNC_I2C_MONITOR):
+                if stopping:
+                    break
+                continue
+            try:
+                buf = self.free.get_nowait()
+            except queue.Empty:
+                buf = array('H', [0]) * self.buffer_words
+                self.nbuffers += 1
+            n = aa_i2c_monitor_read_into(handle, buf, self.buffer_words)
+            if n < 0:
+                self.errval = n
+                self.free.put(buf)
+                break
+            self.filled.put((time.time(), buf, n))
+        self.filled.put(None)
+
+    def write(self, f):
+        record = PLXMON_RECORD
+        swap = sys.byteorder != 'little'
+        while True:
+            item = self.filled.get()
+            if item is None:
+                break
+            (timestamp, buf, n) = item
+            if n > 0:
+                f.write(record.pack(n, timestamp))
+                if swap:
+                    words = buf[:n]
+                    words.byteswap()
+                    words.tofile(f)
+                else:
+                    f.write(plxmon_view(buf, n))
+                self.words += n
+                self.records += 1
+            self.free.put(buf)
+        f.close()
+
+    def start(self):
+        f = open(self.filename, "wb")
+        f.write(PLXMON_HEADER.pack(PLXMON_MAGIC, PLXMON_VERSION, time.time()))
+        ret = aa_i2c_monitor_enable(self.handle)
+        if ret < 0:
+            f.close()
+            return ret
+        self.stopping.clear()
+        self.write_thread = threading.Thread(target=self.write, args=(f,))
+        self.drain_thread = threading.Thread(target=self.drain)
+        for t in (self.write_thread, self.drain_thread):
+            t.daemon = True
+            t.start()
+        return 0
+
+    def stop(self):
+        ''' stop capturing; returns the negative error that stopped the
+        drain thread early, or 0 '''
+        self.stopping.set()
+        self.drain_thread.join()
+        aa_i2c_monitor_disable(self.handle)
+        self.write_thread.join()
+        return self.errval
+
+
+def plxmon_records(filename):
+    ''' yield (timestamp, array('H') of words) for each record of the
+    capture file <filename>.  Raises ValueError if it is not one. '''
+    with open(filename, "rb") as f:
+        raw = f.read(PLXMON_HEADER.size)
+        if len(raw) < PLXMON_HEADER.size:
+            raise ValueError("%s is not a plx monitor capture" % filename)
+        (magic, version, start) = PLXMON_HEADER.unpack(raw)
+        if magic != PLXMON_MAGIC or version != PLXMON_VERSION:
+            raise ValueError("%s is not a plx monitor capture" % filename)
+        while True:
+            raw = f.read(PLXMON_RECORD.size)
+            if len(raw) < PLXMON_RECORD.size:
+                break
+            (n, timestamp) = PLXMON_RECORD.unpack(raw)
+            words = array('H')
+            try:
+                words.fromfile(f, n)
+            except EOFError:
+                # a capture cut short mid-record
+                break
+            if sys.byteorder != 'little':
+                words.byteswap()
+            yield (timestamp, words)
+
+
+class PLX_I2cSegment(object):
+    ''' The part of an I2C transaction from a START to the next START or
+    STOP: the 7-bit address, the direction, whether the address was
+    acked, the data bytes and the number of data bytes NACKed (on a read
+    the master NACKs the last byte). '''
+    def __init__(self, addr_word):
+        self.addr = (addr_word >> 1) & 0x7f
+        self.read = bool(addr_word & 0x1)
+        self.acked = not (addr_word & AA_I2C_MONITOR_NACK)
+        self.data = bytearray()
+        self.nacks = 0
+
+    def __repr__(self):
+        return "%02x %s%s %s" % (self.addr, self.read and "R" or "W",
+            not self.acked and " NACK" or "",
+            " ".join("%02x" % b for b in self.data))
+
+
+class PLX_I2cSplitter(object):
+    ''' Splits bus monitor words into transactions, each a list of
+    PLX_I2cSegments from a START to a STOP.  Words can be fed in any
+    pieces; words before the first START are dropped. '''
+    def __init__(self):
+        self.transaction = None
+        self.segment = None
+
+    def feed(self, words):
+        ''' return the list of the transactions completed by <words> '''
+        done = []
+        transaction = self.transaction
+        segment = self.segment
+        for word in words:
+            if word == AA_I2C_MONITOR_CMD_START:
+                if transaction is None:
+                    transaction = []
+                segment = None
+            elif word == AA_I2C_MONITOR_CMD_STOP:
+                if transaction is not None:
+                    done.append(transaction)
+                transaction = None
+                segment = None
+            elif transaction is None:
+                continue
+            elif segment is None:
+                segment = PLX_I2cSegment(word)
+                transaction.append(segment)
+            else:
+                segment.data.append(word & AA_I2C_MONITOR_DATA)
+                if word & AA_I2C_MONITOR_NACK:
+                    segment.nacks += 1
+        self.transaction = transaction
+        self.segment = segment
+        return done
+
+
+def plxmon_transactions(filename):
+    ''' yield (timestamp, transaction) for each transaction in the
+    capture file <filename>, timestamped with the monitor read that
+    completed it '''
+    splitter = PLX_I2cSplitter()
+    for (timestamp, words) in plxmon_records(filename):
+        for transaction in splitter.feed(words):
+            yield (timestamp, transaction)
+
+
+class PLX_SniffedRegs(object):
+    ''' Table of the register values of the switch at <device> seen on
+    the bus.  feed() takes transactions from a PLX_I2cSplitter and picks
+    out PLX command frames: a read command followed by its 4 data bytes,
+    in the same transaction (as plx_read4 issues them) or the next one,
+    gives the value of the register; a write command drops it, as
+    plx_write_qword does, since a register may not read back as written.
+
+    <entries> maps (port, addr) to (value, time seen).  If <cache> is a
+    PLX_RegCache, sniffed values are also stored in it under <handle>,
+    so plx_read_qword on that handle is served from them. '''
+    def __init__(self, device=device, cache=None, handle=None):
+        self.device = device
+        self.cache = cache
+        self.handle = handle
+        self.entries = {}
+        self.pending = None
+        self.reads = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def feed(self, transaction, timestamp=None):
+        ''' decode the segments of <transaction> seen at <timestamp> '''
+        if timestamp is None:
+            timestamp = time.time()
+        for segment in transaction:
+            if segment.addr != self.device or not segment.acked:
+                continue
+            data = segment.data
+            if segment.read:
+                if self.pending is not None and len(data) == 4:
+                    (port, addr) = self.pending
+                    val = (data[0] << 24) | (data[1] << 16) | \
+                        (data[2] << 8) | data[3]
+                    self.seen(port, addr, val, timestamp)
+                self.pending = None
+            elif len(data) < 4 or segment.nacks:
+                self.pending = None
+            else:
+                (cmd, port, addr, byte_enables) = plx_decode_command(data)
+                self.pending = None
+                if cmd == PLX_CMD_READ:
+                    self.pending = (port, addr)
+                elif cmd == PLX_CMD_WRITE:
+                    self.written(port, addr)
+
+    def seen(self, port, addr, val, timestamp):
+        with self.lock:
+            self.entries[(port, addr)] = (val, timestamp)
+            self.reads += 1
+        if self.cache is not None:
+            self.cache.store(self.handle, self.device, port, addr, val)
+
+    def written(self, port, addr):
+        with self.lock:
+            self.entries.pop((port, addr), None)
+            self.writes += 1
+        if self.cache is not None:
+            self.cache.invalidate(self.handle, self.device, port, addr)
+
+    def value(self, port, addr, max_age=None):
+        ''' return the last value seen of <port>:<addr>, or None if it has
+        not been seen, or not in the last <max_age> seconds '''
+        entry = self.entries.get((port, addr))
+        if entry is None:
+            return None
+        (val, timestamp) = entry
+        if max_age is not None and time.time() - timestamp > max_age:
+            return None
+        return val
+
+    def snapshot(self):
+        ''' return a copy of <entries> '''
+        with self.lock:
+            return dict(self.entries)
+
+
+class PLX_RegSniffer(object):
+    ''' Live register sniffing on the bus monitor of the Aardvark
+    <handle>: start() enables the monitor and starts a thread that feeds
+    everything seen on the bus to the PLX_SniffedRegs <regs>.  The
+    monitor only listens, so the adapter adds no transactions.  stop()
+    disables the monitor. '''
+    def __init__(self, handle, regs, buffer_words=PLXMON_SNIFF_WORDS):
+        self.handle = handle
+        self.regs = regs
+        self.buffer_words = buffer_words
+        self.splitter = PLX_I2cSplitter()
+        self.errval = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def sniff(self):
+        handle = self.handle
+        buf = array('H', [0]) * self.buffer_words
+        while not self.stopping.is_set():
+            ret = aa_async_poll(handle, PLXMON_POLL_MS)
+            if ret < 0:
+                self.errval = ret
+                break
+            if not (ret & AA_ASYNC_I2C_MONITOR):
+                continue
+            n = aa_i2c_monitor_read_into(handle, buf, self.buffer_words)
+            if n < 0:
+                self.errval = n
+                break
+            timestamp = time.time()
+            for transaction in self.splitter.feed(buf[:n]):
+                self.regs.feed(transaction, timestamp)
+
+    def start(self):
+        ret = aa_i2c_monitor_enable(self.handle)
+        if ret < 0:
+            return ret
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sniff)
+        self.thread.daemon = True
+        self.thread.start()
+        return 0
+
+    def stop(self):
+        ''' stop sniffing; returns the negative error that stopped the
+        thread early, or 0 '''
+        self.stopping.set()
+        self.thread.join()
+        aa_i2c_monitor_disable(self.handle)
+        return self.errval
+
+
+def plxmon_regs(filename, device=device):
+    ''' return the PLX_SniffedRegs of the register values of <device>
+    read in the capture file <filename> '''
+    regs = PLX_SniffedRegs(device)
+    for (timestamp, transaction) in plxmon_transactions(filename):
+        regs.feed(transaction, timestamp)
+    return regs
+
+def plxmon_print_regs(regs, now=None):
+    entries = regs.snapshot()
+    for (port, addr) in sorted(entries):
+        (val, timestamp) = entries[(port, addr)]
+        line = "port %2d 0x%03x 0x%08x" % (port, addr, val)
+        if now is not None:
+            line += "  %6.1f s ago" % (now - timestamp)
+        print(line)
+    print("%d registers from %d reads, %d writes" % (len(entries),
+        regs.reads, regs.writes))
+
+
+#==========================================================================
+# MAIN PROGRAM
+#==========================================================================
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if (len(argv) < 2
+            or argv[1] not in ("capture", "decode", "regs", "sniff")
+            or (argv[1] != "sniff" and len(argv) < 3)):
+        print("usage: plxmon capture file [seconds]")
+        print("       plxmon decode file")
+        print("       plxmon regs file")
+        print("       plxmon sniff [seconds]")
+        return 1
+
+    if argv[1] == "decode":
+        for (timestamp, transaction) in plxmon_transactions(argv[2]):
+            print("%.6f %s" % (timestamp,
+                " / ".join(repr(s) for s in transaction)))
+        return 0
+
+    if argv[1] == "regs":
+        plxmon_print_regs(plxmon_regs(argv[2]))
+        return 0
+
+    seconds = None
+    if argv[1] == "sniff" and len(argv) > 2:
+        seconds = float(argv[2])
+    elif len(argv) > 3:
+        seconds = float(argv[3])
+
+    handle = aa_open(aaport)
+    if (handle <= 0):
+        print("Unable to open Aardvark device on port %d" % aaport)
+        print("Error code = %d" % handle)
+        return 1
+    aa_configure(handle, AA_CONFIG_SPI_I2C)
+    aa_i2c_pullup(handle, AA_I2C_PULLUP_NONE)
+    aa_target_power(handle, AA_TARGET_POWER_NONE)
+
+    if argv[1] == "sniff":
+        regs = PLX_SniffedRegs()
+        sniffer = PLX_RegSniffer(handle, regs)
+        errval = sniffer.start()
+        if errval < 0:
+            print("Unable to enable the bus monitor, error %d" % errval)
+            aa_close(handle)
+            return 1
+        print("Sniffing registers of 0x%02x, ctrl-c to stop" % regs.device)
+        t0 = time.time()
+        try:
+            while seconds is None or time.time() - t0 < seconds:
+                time.sleep(0.5)
+                if not sniffer.thread.is_alive():
+                    break
+        except KeyboardInterrupt:
+            pass
+        errval = sniffer.stop()
+        aa_close(handle)
+        if errval < 0:
+            print("Sniffing stopped by error %d" % errval)
+        plxmon_print_regs(regs, time.time())
+        return errval < 0 and 1 or 0
+
+    capture = PLX_MonitorCapture(handle, argv[2])
+    errval = capture.start()
+    if errval < 0:
+        print("Unable to enable the bus monitor, error %d" % errval)
+        aa_close(handle)
+        return 1
+
+    t0 = time.time()
+    print("Capturing to %s, ctrl-c to stop" % argv[2])
+    try:
+        while seconds is None or time.time() - t0 < seconds:
+            time.sleep(0.5)
+            if not capture.drain_thread.is_alive():
+                break
+    except KeyboardInterrupt:
+        pass
+    errval = capture.stop()
+    aa_close(handle)
+
+    elapsed = time.time() - t0
+    if errval < 0:
+        print("Capture stopped by error %d" % errval)
+    print("Captured %d words in %d records in %.1f s (%d buffers)" % (
+        capture.words, capture.records, elapsed, capture.nbuffers))
+    return errval < 0 and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
@@ -34,9 +34,15 @@
 #==========================================================================
 # IMPORTS
 #==========================================================================
+import os
+import struct
 import sys
+import time
 
 from aardvark_py import *
+from plx8619dbg import plx_read_qword, plx_fill_command, \
+    PLX_PORTS_ENABLED_REGS, plx_decode_ports_enabled, num_ports
+from plxeeprom import eeprom_ack_poll
 
 
 #==========================================================================
@@ -81,9 +87,9 @@ def _writeMemory (handle, device, addr, length, zero):
         # Truncate the array to the exact data size
         del data_out[i:]
 
-        # Write the address and data
+        # Write the address and data, then wait for the write cycle
         aa_i2c_write(handle, device, AA_I2C_NO_FLAGS, data_out)
-        aa_sleep_ms(10)
+        eeprom_ack_poll(handle, device)
 
 
 PLX_CMD_WRITE = int('00000011', 2)
@@ -96,41 +102,44 @@ PLX_PORTSEL_DMA_DESCRIPTORS = 0x13
 
 
 def plxread_qword (handle, device, port, addr):
-    cmd = PLX_CMD_READ
-
-    command = array('B', [
-        cmd,
-        (port >> 1) & 0xf,
-	((port & 0x01) << 7) | ((addr >> 10) & 0x3),
-	(addr >> 2) & 0xff
-	])
-	
-	
-    #print("writing {0:s}]n".format(str(command)))
+    # The command frame and the 4 data bytes are exchanged in one
+    # atomic write+read, so each register is a single round trip
+    # to the adapter.
+    command = array('B', [0, 0, 0, 0])
+    plx_fill_command(command, PLX_CMD_READ, port, addr)
 
-    # Write the address
-    aa_i2c_write(handle, device, AA_I2C_NO_STOP, command)
+    #print("writing {0:s}]n".format(str(command)))
 
-    (count, data_in) = aa_i2c_read(handle, device, AA_I2C_NO_FLAGS, 4)
+    (status, num_written, data_in, num_read) = \
+        aa_i2c_write_read(handle, device, AA_I2C_NO_FLAGS, command, 4)
 
-    #print("read {0}: {1}".format(count, data_in))
-    return (count, data_in)
+    #print("read {0}: {1}".format(num_read, data_in))
+    return (status, num_written, data_in, num_read)
 
 def plxread (handle, device, port, addr, length):
     # PLX register access is by qword
     for i in range(0,length,4):
         reg = addr + i
-        (count, data_in) = plxread_qword(handle, device, port, reg)
+        (status, num_written, data_in, num_read) = \
+            plxread_qword(handle, device, port, reg)
 
-        if (count < 0):
-            print "error: %s" % aa_status_string(count)
+        # status is (read_status << 8) | write_status
+        if (status < 0):
+            print("error: %s" % aa_status_string(status))
+            return
+        elif ((status & 0xff) != AA_I2C_STATUS_OK):
+            print("error: command write failed (i2c status %d)" % (status & 0xff))
+            print("  are you sure you have the right slave address?")
             return
-        elif (count == 0):
-            print "error: no bytes read"
-            print "  are you sure you have the right slave address?"
+        elif ((status >> 8) != AA_I2C_STATUS_OK):
+            print("error: data read failed (i2c status %d)" % (status >> 8))
             return
-        elif (count != 4):
-            print "error: read %d bytes (expected %d)" % (count, length)
+        elif (num_read == 0):
+            print("error: no bytes read")
+            print("  are you sure you have the right slave address?")
+            return
+        elif (num_read != 4):
+            print("error: read %d bytes (expected %d)" % (num_read, 4))
 
         qword = data_in[0] \
             + data_in[1] << 8 \
@@ -140,51 +149,210 @@ def plxread (handle, device, port, addr, length):
         sys.stdout.write("0x{0:0>4x}: {1[0]:0>2x} {1[1]:0>2x} {1[2]:0>2x} {1[3]:0>2x}\n".format(reg, data_in))
 
 
+# Binary config space dump files
+#
+# A dump file is a 64 byte header followed by the config space of each
+# dumped port in turn, space_size bytes per port, as little-endian 32-bit
+# register values (the values returned by plx_read_qword).
+#
+# Header:
+#   0x00  magic 'PLXD'
+#   0x04  u16 format version
+#   0x06  u16 i2c address of the switch
+#   0x08  u32 bytes of config space dumped per port
+#   0x0c  u32 number of ports dumped
+#   0x10  f64 time the dump was started (seconds since the epoch)
+#   0x18  u8[32] port numbers in file order, unused entries 0xff
+#   0x38  reserved
+PLXDUMP_MAGIC = b'PLXD'
+PLXDUMP_VERSION = 1
+PLXDUMP_HEADER = struct.Struct('<4sHHIId32s8x')
+PLXDUMP_MAX_PORTS = 32
+PLXDUMP_SPACE_SIZE = 0x1000
+
+# Registers read between flushes to disk
+PLXDUMP_CHUNK = 64
+
+def plxdump_header (f):
+    # Read a dump file header from the open file f.
+    # Returns a dict, or None if f does not hold a dump header.
+    raw = f.read(PLXDUMP_HEADER.size)
+    if len(raw) < PLXDUMP_HEADER.size:
+        return None
+    (magic, version, device, space_size, nports, timestamp, ports) = \
+        PLXDUMP_HEADER.unpack(raw)
+    if magic != PLXDUMP_MAGIC or version != PLXDUMP_VERSION:
+        return None
+    return {
+        "device": device,
+        "space_size": space_size,
+        "ports": list(bytearray(ports[:nports])),
+        "timestamp": timestamp,
+        "data_offset": PLXDUMP_HEADER.size,
+        }
+
+def plxdump (handle, device, filename, ports, space_size=PLXDUMP_SPACE_SIZE,
+        overwrite=False):
+    # Dump the config space of each of ports to filename.
+    #
+    # The registers are streamed to the file as they are read.  If
+    # filename already holds a dump of the same device and ports, the
+    # dump resumes after the last complete register in the file.  Any
+    # other existing file is only replaced with overwrite set; otherwise
+    # ValueError is raised before the file is touched.
+    #
+    # Returns (errval, nbytes, seconds): errval is the negative value
+    # returned by plx_read_qword if a read failed, and nbytes the bytes
+    # of config space read in this run.
+    if len(ports) > PLXDUMP_MAX_PORTS:
+        raise ValueError("at most %d ports per dump" % PLXDUMP_MAX_PORTS)
+
+    total = len(ports) * space_size
+    start = 0
+    header = None
+    if os.path.exists(filename):
+        f = open(filename, "r+b")
+        header = plxdump_header(f)
+        if header is not None and (header["device"] != device
+                or header["space_size"] != space_size
+                or header["ports"] != list(ports)):
+            header = None
+        f.seek(0, os.SEEK_END)
+        if header is None and f.tell() > 0 and not overwrite:
+            f.close()
+            raise ValueError("%s exists and is not a dump of these ports "
+                "to resume" % filename)
+        if header is not None:
+            f.seek(0, os.SEEK_END)
+            start = min(f.tell() - PLXDUMP_HEADER.size, total) & ~0x3
+    else:
+        f = open(filename, "w+b")
+
+    if header is None:
+        portbytes = bytearray(ports) + bytearray([0xff] * (PLXDUMP_MAX_PORTS - len(ports)))
+        f.seek(0)
+        f.write(PLXDUMP_HEADER.pack(PLXDUMP_MAGIC, PLXDUMP_VERSION, device,
+            space_size, len(ports), time.time(), bytes(portbytes)))
+
+    f.seek(PLXDUMP_HEADER.size + start)
+    f.truncate()
+
+    chunk = bytearray(4 * PLXDUMP_CHUNK)
+    pack_into = struct.Struct('<I').pack_into
+    errval = 0
+    t0 = time.time()
+    offset = start
+    while offset < total and errval == 0:
+        n = 0
+        while n < PLXDUMP_CHUNK and offset < total:
+            port = ports[offset // space_size]
+            val = plx_read_qword(handle, device, port, offset % space_size)
+            if val < 0:
+                errval = val
+                break
+            pack_into(chunk, 4 * n, val)
+            n += 1
+            offset += 4
+        f.write(chunk[:4 * n])
+        f.flush()
+    seconds = time.time() - t0
+    f.close()
+
+    return (errval, offset - start, seconds)
+
+
 
 
 #==========================================================================
 # MAIN PROGRAM
 #==========================================================================
-if (len(sys.argv) < 2):
-    print "usage: plxread port reg [length]"
-    print ""
-    print "example: plxread 0xa 0x240 106"
-    sys.exit()
-
-port = int(sys.argv[1], base=0)
-addr    = int(sys.argv[2], base=0)
-length  = int(sys.argv[3], base=0)
-
-handle = aa_open(aaport)
-if (handle <= 0):
-    print "Unable to open Aardvark device on port %d" % port
-    print "Error code = %d" % handle
-    sys.exit()
-    
-# Ensure that the I2C subsystem is enabled
-aa_configure(handle,  AA_CONFIG_SPI_I2C)
-    
-# Enable the I2C bus pullup resistors (2.2k resistors).
-# This command is only effective on v2.0 hardware or greater.
-# The pullup resistors on the v1.02 hardware are enabled by default.
-aa_i2c_pullup(handle, AA_I2C_PULLUP_BOTH)
-
-# Don't turn on aardvark power pin
-aa_target_power(handle, AA_TARGET_POWER_NONE)
-
-# Set the bitrate
-bitrate = aa_i2c_bitrate(handle, bitrate)
-print "Bitrate set to %d kHz" % bitrate
-
-# Set the bus lock timeout
-bus_timeout = aa_i2c_bus_timeout(handle, BUS_TIMEOUT)
-print "Bus lock timeout set to %d ms" % bus_timeout
-
-plxread(handle, device, port, addr, length)
-
-    
-# Close the device
-aa_close(handle)
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if (len(argv) < 3):
+        print("usage: plxread port reg [length]")
+        print("       plxread --dump [--force] file [port ...]")
+        print("")
+        print("--dump resumes a dump of the same ports in file; --force")
+        print("overwrites any other existing file")
+        print("")
+        print("example: plxread 0xa 0x240 106")
+        return
+
+    dump = (argv[1] == "--dump")
+    overwrite = False
+    if dump and argv[2] == "--force":
+        overwrite = True
+        argv = argv[:2] + argv[3:]
+    if dump and len(argv) < 3:
+        print("usage: plxread --dump [--force] file [port ...]")
+        return
+    if not dump:
+        port    = int(argv[1], base=0)
+        addr    = int(argv[2], base=0)
+        length  = 4
+        if (len(argv) > 3):
+            length = int(argv[3], base=0)
+
+    handle = aa_open(aaport)
+    if (handle <= 0):
+        print("Unable to open Aardvark device on port %d" % aaport)
+        print("Error code = %d" % handle)
+        return
+
+    # Ensure that the I2C subsystem is enabled
+    aa_configure(handle,  AA_CONFIG_SPI_I2C)
+
+    # Enable the I2C bus pullup resistors (2.2k resistors).
+    # This command is only effective on v2.0 hardware or greater.
+    # The pullup resistors on the v1.02 hardware are enabled by default.
+    aa_i2c_pullup(handle, AA_I2C_PULLUP_BOTH)
+
+    # Don't turn on aardvark power pin
+    aa_target_power(handle, AA_TARGET_POWER_NONE)
+
+    # Set the bitrate
+    actual_bitrate = aa_i2c_bitrate(handle, bitrate)
+    print("Bitrate set to %d kHz" % actual_bitrate)
+
+    # Set the bus lock timeout
+    bus_timeout = aa_i2c_bus_timeout(handle, BUS_TIMEOUT)
+    print("Bus lock timeout set to %d ms" % bus_timeout)
+
+    if dump:
+        filename = argv[2]
+        ports = [int(a, base=0) for a in argv[3:]]
+        if not ports:
+            val = plx_read_qword(handle, device, 0,
+                PLX_PORTS_ENABLED_REGS[0][1])
+            if val < 0:
+                print("Unable to read the ports enabled, error %d" % val)
+                aa_close(handle)
+                return
+            enabled = plx_decode_ports_enabled([val])
+            ports = [i for i in range(num_ports) if enabled[i]]
+        try:
+            (errval, nbytes, seconds) = plxdump(handle, device, filename,
+                ports, overwrite=overwrite)
+        except ValueError as e:
+            print("Unable to dump: %s" % e)
+            if os.path.exists(filename):
+                print("  use --force to overwrite it")
+            aa_close(handle)
+            return
+        if errval < 0:
+            print("Dump stopped by read error %d, run again to resume" % errval)
+        print("Dumped %d bytes in %.2f s (%.0f bytes/s)" % (nbytes, seconds,
+            seconds > 0 and nbytes / seconds or 0))
+    else:
+        plxread(handle, device, port, addr, length)
+
+    # Close the device
+    aa_close(handle)
+
+if __name__ == "__main__":
+    main()
 
 
 
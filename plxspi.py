@@ -0,0 +1,342 @@
+#!/bin/env python
+#
+# plx spi
+#
+# Programs the SPI serial EEPROM or flash of a PLX switch board through
+# the Aardvark SPI master, from an image built by eeprom_gen.py.
+#
+# The bitrate used is the fastest at which the start of the part reads
+# back the same as at the slowest; it is stepped down further if the
+# image then fails to verify.
+#
+# usage: plxspi write|verify|dump|erase part [file]
+#
+#   write   erases a flash part, programs the image and verifies it
+#   verify  compares the part with the image
+#   dump    reads the whole part into the file
+#   erase   bulk erases a flash part
+#
+# example: plxspi write 25lc512 plx8732_stn2rev_x8x8_port1Upst.bin
+#
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+import sys
+import time
+
+from aardvark_py import *
+from plxeeprom import EEPROM_READ_CHUNK, EEPROM_ERR_TIMEOUT, \
+    EEPROM_ERR_WRITE, EEPROM_ERR_READ, EEPROM_ERR_VERIFY, eeprom_page_spans, \
+    eeprom_compare
+
+
+#==========================================================================
+# CONSTANTS
+#==========================================================================
+aaport = 0
+
+# Aardvark SPI master clocks to try, fastest first
+SPI_BITRATES = (8000, 4000, 2000, 1000, 500, 250, 125)  # kHz
+
+# Bytes at the start of the part read back to find a stable bitrate
+SPI_PROBE_BYTES = 4096
+
+# SPI serial EEPROM and flash parts:
+# (size in bytes, page size, address bytes, flash)
+# Flash parts must be erased before programming; EEPROMs erase each
+# byte as it is written.
+SPI_PARTS = {
+    '25aa640':  (8192, 32, 2, False),
+    '25lc256':  (32768, 64, 2, False),
+    '25lc512':  (65536, 128, 2, False),
+    '25lc1024': (131072, 256, 3, False),
+    'm25p16':   (2097152, 256, 3, True),
+    'w25q32':   (4194304, 256, 3, True),
+    }
+
+# Commands common to 25xx EEPROMs and SPI flash
+SPI_CMD_WRITE_ENABLE = 0x06
+SPI_CMD_READ_STATUS = 0x05
+SPI_CMD_READ = 0x03
+SPI_CMD_PAGE_PROGRAM = 0x02
+SPI_CMD_BULK_ERASE = 0xc7
+
+SPI_STATUS_WIP = 0x01  # write in progress
+
+# Longest page program and bulk erase to wait for
+SPI_WRITE_TIMEOUT = 0.025  # s
+SPI_ERASE_TIMEOUT = 80.0   # s
+
+# Largest read, less the command and address bytes of its transaction
+SPI_READ_CHUNK = EEPROM_READ_CHUNK - 4
+
+
+#==========================================================================
+# FUNCTIONS
+#==========================================================================
+def spi_setup(handle, bitrate_khz=SPI_BITRATES[0]):
+    ''' set up the Aardvark as SPI master in mode 0 with an active low
+    slave select, as 25xx parts expect.  Returns the actual bitrate. '''
+    aa_configure(handle, AA_CONFIG_SPI_I2C)
+    aa_target_power(handle, AA_TARGET_POWER_NONE)
+    aa_spi_configure(handle, AA_SPI_POL_RISING_FALLING,
+        AA_SPI_PHASE_SAMPLE_SETUP, AA_SPI_BITORDER_MSB)
+    aa_spi_master_ss_polarity(handle, AA_SPI_SS_ACTIVE_LOW)
+    return aa_spi_bitrate(handle, bitrate_khz)
+
+def spi_fill_cmd(buf, part, cmd, addr):
+    ''' put <cmd> and the address bytes for <addr> at the start of <buf>
+    and return their length '''
+    addr_bytes = SPI_PARTS[part][2]
+    buf[0] = cmd
+    for i in range(addr_bytes):
+        buf[1 + i] = (addr >> (8 * (addr_bytes - 1 - i))) & 0xff
+    return 1 + addr_bytes
+
+def spi_command(handle, cmd):
+    ''' send a single byte command.  Returns 0 or a negative error. '''
+    ret = aa_spi_write_into(handle, array('B', [cmd]), 1, array('B', [0]), 1)
+    if ret < 0:
+        return ret
+    return 0
+
+def spi_wait_ready(handle, timeout):
+    ''' poll the status register until the part is no longer busy.
+    Returns the number of polls, or EEPROM_ERR_TIMEOUT or the negative
+    Aardvark error. '''
+    out = array('B', [SPI_CMD_READ_STATUS, 0])
+    status = array('B', [0, 0])
+    deadline = time.time() + timeout
+    polls = 0
+    while True:
+        polls += 1
+        ret = aa_spi_write_into(handle, out, 2, status, 2)
+        if ret < 0:
+            return ret
+        if not (status[1] & SPI_STATUS_WIP):
+            return polls
+        if time.time() > deadline:
+            return EEPROM_ERR_TIMEOUT
+
+def spi_erase(handle, part):
+    ''' bulk erase a flash part.  Returns 0 or a negative error. '''
+    errval = spi_command(handle, SPI_CMD_WRITE_ENABLE)
+    if errval == 0:
+        errval = spi_command(handle, SPI_CMD_BULK_ERASE)
+    if errval == 0:
+        errval = min(spi_wait_ready(handle, SPI_ERASE_TIMEOUT), 0)
+    return errval
+
+def spi_pages(part, addr, length):
+    ''' yield (offset, count) for each page of <part> touched by <length>
+    bytes at <addr> '''
+    return eeprom_page_spans(SPI_PARTS[part][1], addr, length)
+
+def spi_write(handle, part, image, addr=0):
+    ''' program <image> at <addr>, a full page per program command,
+    polling the status register for the end of each program.  A flash
+    part must have been erased; pages of all 0xff are then skipped.
+    Returns (errval, nbytes, seconds). '''
+    (size, page_size, addr_bytes, flash) = SPI_PARTS[part]
+    data = array('B', bytearray(image))
+    if addr + len(data) > size:
+        raise ValueError("%d byte image does not fit in a %s at 0x%x"
+            % (len(data), part, addr))
+
+    out = array('B', [0]) * (1 + addr_bytes + page_size)
+    dummy = array('B', [0])
+    erased = array('B', [0xff]) * page_size
+    errval = 0
+    nbytes = 0
+    t0 = time.time()
+    for (n, count) in spi_pages(part, addr, len(data)):
+        page = data[n:n + count]
+        if flash and page == erased[:count]:
+            nbytes += count
+            continue
+        errval = spi_command(handle, SPI_CMD_WRITE_ENABLE)
+        if errval < 0:
+            break
+        hdr = spi_fill_cmd(out, part, SPI_CMD_PAGE_PROGRAM, addr + n)
+        out[hdr:hdr + count] = page
+        ret = aa_spi_write_into(handle, out, hdr + count, dummy, 1)
+        if ret < 0:
+            errval = ret
+            break
+        polls = spi_wait_ready(handle, SPI_WRITE_TIMEOUT)
+        if polls < 0:
+            errval = polls
+            break
+        nbytes += count
+    return (errval, nbytes, time.time() - t0)
+
+def spi_read(handle, part, addr, length, buf=None):
+    ''' read <length> bytes at <addr> in transactions of up to
+    SPI_READ_CHUNK bytes.  buf is an optional array('B') of at least
+    <length> bytes to read into, reused between calls; it is left at
+    its length.  Returns (errval, array('B') of <length> bytes) or, on
+    error, (errval, the bytes read before the failure). '''
+    addr_bytes = SPI_PARTS[part][2]
+    if buf is None or len(buf) < length:
+        buf = array('B', [0]) * length
+    size = 1 + addr_bytes + min(length, SPI_READ_CHUNK)
+    out = array('B', [0]) * size
+    data_in = array('B', [0]) * size
+
+    n = 0
+    while n < length:
+        count = min(length - n, SPI_READ_CHUNK)
+        hdr = spi_fill_cmd(out, part, SPI_CMD_READ, addr + n)
+        ret = aa_spi_write_into(handle, out, hdr + count, data_in, hdr + count)
+        if ret != hdr + count:
+            return (ret < 0 and ret or EEPROM_ERR_READ, buf[:n])
+        buf[n:n + count] = data_in[hdr:hdr + count]
+        n += count
+    if len(buf) > length:
+        return (0, buf[:length])
+    return (0, buf)
+
+def spi_verify(handle, part, image, addr=0, buf=None):
+    ''' compare the part's contents at <addr> with <image>.
+    Returns (errval, offset, seconds): offset is that of the first byte
+    that differs, or None if the part matches the image. '''
+    data = array('B', bytearray(image))
+    t0 = time.time()
+    (errval, current) = spi_read(handle, part, addr, len(data), buf)
+    offset = None
+    if errval == 0:
+        (errval, offset) = eeprom_compare(current, data)
+    return (errval, offset, time.time() - t0)
+
+def spi_find_bitrate(handle, part, rates=SPI_BITRATES):
+    ''' set the fastest bitrate of <rates> at which the first
+    SPI_PROBE_BYTES of the part read back the same as at the slowest.
+    Returns the actual bitrate set, or a negative error. '''
+    length = min(SPI_PROBE_BYTES, SPI_PARTS[part][0])
+    aa_spi_bitrate(handle, rates[-1])
+    (errval, reference) = spi_read(handle, part, 0, length)
+    if errval < 0:
+        return errval
+    reference = array('B', reference)
+    buf = array('B', [0]) * length
+    for rate in rates:
+        actual = aa_spi_bitrate(handle, rate)
+        if actual < 0:
+            return actual
+        (errval, data) = spi_read(handle, part, 0, length, buf)
+        if errval == 0 and data == reference:
+            return actual
+    return aa_spi_bitrate(handle, rates[-1])
+
+def spi_slower_bitrate(handle, rates=SPI_BITRATES):
+    ''' step the bitrate down to the next of <rates>.  Returns the actual
+    bitrate set, or None if it is already the slowest. '''
+    current = aa_spi_bitrate(handle, 0)
+    for rate in rates:
+        if rate < current:
+            return aa_spi_bitrate(handle, rate)
+    return None
+
+
+#==========================================================================
+# MAIN PROGRAM
+#==========================================================================
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if (len(argv) < 3
+            or argv[1] not in ("write", "verify", "dump", "erase")
+            or argv[2] not in SPI_PARTS
+            or (argv[1] != "erase" and len(argv) < 4)):
+        print("usage: plxspi write|verify|dump|erase part [file]")
+        print("")
+        print("parts: %s" % " ".join(sorted(SPI_PARTS)))
+        return 1
+
+    part = argv[2]
+    (size, page_size, addr_bytes, flash) = SPI_PARTS[part]
+    if argv[1] in ("write", "verify"):
+        with open(argv[3], "rb") as f:
+            image = f.read()
+
+    handle = aa_open(aaport)
+    if (handle <= 0):
+        print("Unable to open Aardvark device on port %d" % aaport)
+        print("Error code = %d" % handle)
+        return 1
+
+    actual_bitrate = spi_setup(handle)
+    if argv[1] != "erase":
+        actual_bitrate = spi_find_bitrate(handle, part)
+        if actual_bitrate < 0:
+            print("Unable to read the part, error %d" % actual_bitrate)
+            aa_close(handle)
+            return 1
+    print("Bitrate set to %d kHz" % actual_bitrate)
+
+    errval = 0
+    if argv[1] == "erase" and not flash:
+        print("%s is an EEPROM and needs no erase" % part)
+    elif argv[1] == "erase":
+        t0 = time.time()
+        errval = spi_erase(handle, part)
+        if errval < 0:
+            print("Erase failed, error %d" % errval)
+        else:
+            print("Erased in %.1f s" % (time.time() - t0))
+
+    while argv[1] in ("write", "verify"):
+        errval = 0
+        if argv[1] == "write" and flash:
+            t0 = time.time()
+            errval = spi_erase(handle, part)
+            if errval < 0:
+                print("Erase failed, error %d" % errval)
+            else:
+                print("Erased in %.1f s" % (time.time() - t0))
+
+        if argv[1] == "write" and errval == 0:
+            (errval, nbytes, seconds) = spi_write(handle, part, image)
+            if errval < 0:
+                print("Write failed at 0x%x, error %d" % (nbytes, errval))
+            print("Wrote %d bytes in %.2f s (%.0f bytes/s)" % (nbytes,
+                seconds, seconds > 0 and nbytes / seconds or 0))
+
+        if errval == 0:
+            (errval, offset, seconds) = spi_verify(handle, part, image)
+            if offset is not None:
+                print("Part differs from the image at 0x%x" % offset)
+            elif errval < 0:
+                print("Read failed, error %d" % errval)
+            else:
+                print("Verified %d bytes in %.3f s" % (len(image), seconds))
+
+        # a mismatch may be the bitrate rather than the part
+        if errval != EEPROM_ERR_VERIFY:
+            break
+        actual_bitrate = spi_slower_bitrate(handle)
+        if actual_bitrate is None:
+            break
+        print("Retrying at %d kHz" % actual_bitrate)
+
+    if argv[1] == "dump":
+        t0 = time.time()
+        (errval, data) = spi_read(handle, part, 0, size)
+        seconds = time.time() - t0
+        with open(argv[3], "wb") as f:
+            data.tofile(f)
+        if errval < 0:
+            print("Read failed at 0x%x, error %d" % (len(data), errval))
+        print("Read %d bytes in %.3f s" % (len(data), seconds))
+
+    aa_close(handle)
+    return errval < 0 and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
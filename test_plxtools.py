@@ -0,0 +1,245 @@
+#!/bin/env python
+#==========================================================================
+# Regression tests of the plx tools, run against the Aardvark simulator
+# so they need no adapter or switch:
+#
+#   python -m pytest -q test_plxtools.py
+#==========================================================================
+
+#==========================================================================
+# IMPORTS
+#==========================================================================
+from __future__ import division, with_statement, print_function
+
+import pytest
+
+import aardvark_sim
+from aardvark_sim import AardvarkSim
+
+# install the simulator before anything loads the native library
+sim = aardvark_sim.install(AardvarkSim(regs={}, device=0x3c, nadapters=2,
+    sleep=False))
+
+from aardvark_py import *
+import eeprom_gen
+import plx8619dbg
+import plxmon
+import plxread
+from plx8619dbg import plx_command, PLX_CMD_READ, PLX_CMD_WRITE
+
+
+#==========================================================================
+# FIXTURES
+#==========================================================================
+@pytest.fixture
+def handle():
+    sim.regs.clear()
+    handle = plx8619dbg.plx_open_adapter(0)
+    assert handle > 0
+    yield handle
+    aa_close(handle)
+
+
+#==========================================================================
+# EEPROM IMAGES
+#==========================================================================
+def test_image_crc_round_trip():
+    rs = eeprom_gen.build_regstream()
+    image = rs.serialize(crc=True)
+    parsed = eeprom_gen.PLX_Image(bytes(image))
+    assert parsed.errors == []
+    assert parsed.crc_enabled and parsed.crc_ok
+    assert len(parsed.entries) == len(rs)
+
+    image[4] ^= 0x01
+    parsed = eeprom_gen.PLX_Image(bytes(image))
+    assert parsed.crc_ok is False
+    assert parsed.errors
+
+def test_image_without_crc():
+    image = eeprom_gen.build_regstream().serialize()
+    parsed = eeprom_gen.PLX_Image(bytes(image))
+    assert parsed.errors == []
+    assert not parsed.crc_enabled and parsed.crc == 0
+
+def test_optimize_folds_repeated_writes():
+    RegAddr = eeprom_gen.PLX_RegAddr
+    rs = eeprom_gen.PLX_RegStream()
+    rs.append(eeprom_gen.PLX_RegEntry(0, 0x200, 1))
+    rs.append(eeprom_gen.PLX_RegEntry(0, 0x204, 2))
+    rs.append(eeprom_gen.PLX_RegEntry(0, 0x200, 3))
+    rs.append(eeprom_gen.PLX_RegEntry(0, 0x208, 4))
+    defaults = {RegAddr(0, 0x208): 4}
+
+    optimized = rs.optimize(defaults)
+    assert optimized.saved == 12
+    parsed = eeprom_gen.PLX_Image(bytes(optimized.serialize(crc=True)))
+    assert parsed.errors == []
+    assert [(addr, value) for (port, addr, value) in parsed.entries] == \
+        [(0x204, 2), (0x200, 3)]
+
+    # folding the default build changes nothing the switch loads
+    rs = eeprom_gen.build_regstream()
+    before = eeprom_gen.PLX_Image(bytes(rs.serialize()))
+    after = eeprom_gen.PLX_Image(bytes(rs.optimize({}).serialize()))
+    for key in before.index:
+        assert after.value(*key) == before.value(*key)
+
+
+#==========================================================================
+# BUS MONITOR
+#==========================================================================
+def monitor_words(addr, read, data, nack_last=False):
+    words = [AA_I2C_MONITOR_CMD_START, (addr << 1) | int(read)]
+    words.extend(data)
+    if nack_last:
+        words[-1] |= AA_I2C_MONITOR_NACK
+    return words
+
+def test_splitter_pieces():
+    words = monitor_words(0x3c, False, plx_command(PLX_CMD_READ, 1, 0x78))
+    words += monitor_words(0x3c, True, [0x12, 0x34, 0x56, 0x78], True)
+    words += [AA_I2C_MONITOR_CMD_STOP]
+
+    splitter = plxmon.PLX_I2cSplitter()
+    # words before the first START are dropped
+    assert splitter.feed([0x55] + words[:5]) == []
+    done = splitter.feed(words[5:])
+    assert len(done) == 1
+    (write, read) = done[0]
+    assert (write.addr, write.read, write.acked) == (0x3c, False, True)
+    assert list(write.data) == list(plx_command(PLX_CMD_READ, 1, 0x78))
+    assert (read.read, list(read.data), read.nacks) == \
+        (True, [0x12, 0x34, 0x56, 0x78], 1)
+
+def test_sniffed_read_split_across_transactions():
+    splitter = plxmon.PLX_I2cSplitter()
+    regs = plxmon.PLX_SniffedRegs(device=0x3c)
+    words = monitor_words(0x3c, False, plx_command(PLX_CMD_READ, 2, 0x1e8))
+    words += [AA_I2C_MONITOR_CMD_STOP]
+    words += monitor_words(0x3c, True, [0, 0, 1, 2], True)
+    words += [AA_I2C_MONITOR_CMD_STOP]
+    for transaction in splitter.feed(words):
+        regs.feed(transaction, 1.0)
+    assert regs.value(2, 0x1e8) == 0x102
+    assert regs.reads == 1
+
+    words = monitor_words(0x3c, False,
+        list(plx_command(PLX_CMD_WRITE, 2, 0x1e8)) + [0, 0, 0, 0])
+    words += [AA_I2C_MONITOR_CMD_STOP]
+    for transaction in splitter.feed(words):
+        regs.feed(transaction, 2.0)
+    assert regs.value(2, 0x1e8) is None
+    assert regs.writes == 1
+
+def test_sniff_simulated_bus(handle):
+    sim.regs[(0, 0x78)] = 0xdeadbeef
+    monitor = aa_open(1)
+    assert monitor > 0
+    try:
+        assert aa_i2c_monitor_enable(monitor) == AA_OK
+        assert plx8619dbg.plx_read_qword(handle, 0x3c, 0, 0x78) == 0xdeadbeef
+        (count, words) = aa_i2c_monitor_read(monitor, 1024)
+        assert count > 0
+        aa_i2c_monitor_disable(monitor)
+    finally:
+        aa_close(monitor)
+
+    regs = plxmon.PLX_SniffedRegs(device=0x3c)
+    for transaction in plxmon.PLX_I2cSplitter().feed(words[:count]):
+        regs.feed(transaction)
+    assert regs.value(0, 0x78) == 0xdeadbeef
+
+
+#==========================================================================
+# ERROR COUNTERS
+#==========================================================================
+def test_lane_accumulator_same_time():
+    acc = plx8619dbg.PLX_LaneErrAccumulator(1)
+    acc.update([0], 1.0)
+    acc.update([100], 1.0)
+    acc.update([100], 2.0)
+    assert acc.totals == [100]
+
+def test_lane_accumulator_wrap():
+    acc = plx8619dbg.PLX_LaneErrAccumulator(1)
+    acc.update([0xf0], 0.0)
+    acc.update([0x10], 1.0)
+    assert acc.totals == [0x20]
+    assert acc.rates == [0x20]
+    assert acc.next_interval(10.0) == 4.0
+
+def test_lane_accumulator_saturation():
+    acc = plx8619dbg.PLX_LaneErrAccumulator(1, saturation_hold=10.0)
+    acc.update([0], 0.0)
+    acc.update([0xff], 1.0)
+    assert acc.saturated == [True]
+    rate = acc.rates[0]
+    # the rate is held while the counter may be stuck
+    acc.update([0xff], 2.0)
+    assert acc.rates[0] == rate
+    # and decays once the hold has run out
+    acc.update([0xff], 12.0)
+    assert acc.rates[0] < rate
+    acc.update([0], 13.0)
+    assert acc.saturated == [False]
+    assert acc.totals == [0x100]
+
+def test_monitor_stalled_clock(handle, monkeypatch):
+    monkeypatch.setattr(plx8619dbg, "plx_clock", lambda: 5.0)
+    monitor = plx8619dbg.PLX_ErrCounterMonitor(handle, 0x3c, ports=[0])
+    sim.regs[(0, 0xb88)] = 0x01
+    sim.regs[(0, plx8619dbg.PLX_REG_BAD_TLP_COUNT)] = 7
+    assert monitor.sample() is not None
+    sim.regs[(0, 0xb88)] = 0x05
+    sim.regs[(0, plx8619dbg.PLX_REG_BAD_TLP_COUNT)] = 9
+    sample = monitor.sample()
+    assert sample["lane_deltas"][0] == 4
+    assert sample["lane_rates"][0] == 0.0
+    assert sample["bad_tlp_deltas"] == [2]
+    assert monitor.accumulator.totals[0] == 4
+
+def test_monitor_needs_ports_enabled(handle):
+    monitor = plx8619dbg.PLX_ErrCounterMonitor(handle, 0x3d)
+    assert monitor.sample() is None
+    assert monitor.errval < 0
+
+
+#==========================================================================
+# CONFIG SPACE DUMPS
+#==========================================================================
+def test_dump_resume(handle, tmp_path):
+    for addr in range(0, 0x40, 4):
+        sim.regs[(1, addr)] = 0x1000 + addr
+    filename = str(tmp_path / "dump.bin")
+    (errval, nbytes, seconds) = plxread.plxdump(handle, 0x3c, filename,
+        [1], space_size=0x40)
+    assert (errval, nbytes) == (0, 0x40)
+    with open(filename, "rb") as f:
+        complete = f.read()
+
+    # cut the dump short mid-register and resume it
+    with open(filename, "r+b") as f:
+        f.truncate(plxread.PLXDUMP_HEADER.size + 0x22)
+    (errval, nbytes, seconds) = plxread.plxdump(handle, 0x3c, filename,
+        [1], space_size=0x40)
+    assert (errval, nbytes) == (0, 0x20)
+    with open(filename, "rb") as f:
+        assert f.read() == complete
+
+def test_dump_refuses_overwrite(handle, tmp_path):
+    filename = str(tmp_path / "notes.txt")
+    with open(filename, "w") as f:
+        f.write("not a dump\n")
+    with pytest.raises(ValueError):
+        plxread.plxdump(handle, 0x3c, filename, [1], space_size=0x40)
+    with open(filename) as f:
+        assert f.read() == "not a dump\n"
+
+    (errval, nbytes, seconds) = plxread.plxdump(handle, 0x3c, filename,
+        [1], space_size=0x40, overwrite=True)
+    assert (errval, nbytes) == (0, 0x40)
+
+
+# modeline...
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4